@@ -0,0 +1,120 @@
+'''
+Measures the time and memory it takes to create detections: a BoundingBox and
+a DetectedObject per detection, plus a VideoFrame per frame, which is what a
+detector allocates for every frame.
+
+The __slots__ based classes with lazily made up object ids are compared with
+copies of the classes they replaced, which kept every attribute (including the
+derived corners) in a per-instance __dict__ and made up a uuid4 per detection.
+
+    python benchmarks/objects.py --detections 100000
+'''
+import argparse
+import os
+import sys
+import timeit
+import tracemalloc
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from eighttrack import BoundingBox, DetectedObject, VideoFrame
+
+
+class LegacyBoundingBox(object):
+    def __init__(self, x, y, width, height, round_values=True):
+        if round_values:
+            x = int(round(x))
+            y = int(round(y))
+            width = int(round(width))
+            height = int(round(height))
+
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+
+        self.x1 = x
+        self.x2 = x + width
+        self.y1 = y
+        self.y2 = y + height
+
+        self.pt1 = (self.x1, self.y1)
+        self.pt2 = (self.x2, self.y2)
+
+
+class LegacyDetectedObject(object):
+    def __init__(self, label, score, bounding_box, object_id=None):
+        self.label = label
+        self.score = score
+        self.bounding_box = bounding_box
+        self.object_id = object_id if object_id else uuid.uuid4()
+
+
+class LegacyVideoFrame(object):
+    def __init__(self, pixels, detected_objects=set(), tracked_objects=set()):
+        self.pixels = pixels
+        self.detected_objects = detected_objects
+        self.tracked_objects = tracked_objects
+        self.capture_timestamp = 0.0
+        self.detection_skipped = False
+        self.is_static = False
+        self.motion_score = None
+        self.frame_index = None
+        self.media_timestamp = None
+        self._release = None
+
+
+def detect(box_class, detected_object_class, frame_class, detections, per_frame):
+    frames = list()
+    for start in range(0, detections, per_frame):
+        frames.append(frame_class(None, detected_objects=[
+            detected_object_class(
+                'face',
+                0.9,
+                box_class(index * 1.5, index * 0.5, 40.2, 40.7)
+            )
+            for index in range(start, min(start + per_frame, detections))
+        ]))
+    return frames
+
+
+def measure(classes, detections, per_frame, repeat):
+    seconds = min(timeit.repeat(
+        lambda: detect(*(classes + (detections, per_frame))),
+        number=1,
+        repeat=repeat
+    ))
+
+    tracemalloc.start()
+    frames = detect(*(classes + (detections, per_frame)))
+    (current, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del frames
+    return (seconds, current)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--detections', type=int, default=100000)
+    parser.add_argument('--per-frame', type=int, default=10,
+                        help='number of detections per frame')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print("{:>8} {:>16} {:>20}".format(
+        "classes", "us/detection", "bytes/detection"))
+    for (name, classes) in (
+            ('legacy', (LegacyBoundingBox, LegacyDetectedObject, LegacyVideoFrame)),
+            ('slots', (BoundingBox, DetectedObject, VideoFrame))):
+        (seconds, allocated) = measure(
+            classes, args.detections, args.per_frame, args.repeat)
+        print("{:>8} {:>16.3f} {:>20.1f}".format(
+            name,
+            seconds * 1e6 / args.detections,
+            float(allocated) / args.detections
+        ))
+
+
+if __name__ == '__main__':
+    main()
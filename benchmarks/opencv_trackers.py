@@ -0,0 +1,51 @@
+'''
+Compares the OpenCV tracker types OpencvObjectTracker can use: how long each
+takes to initialize and update, and how well it follows the face in a video
+(test/data/clip.m4v by default), as found by a CascadeDetector on every frame.
+
+    python benchmarks/opencv_trackers.py --types KCF MOSSE CSRT --frames 200
+'''
+import argparse
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from eighttrack.opencv import CASCADE_FACE_DETECTOR_DEFAULT_XML_PATH, CascadeDetector, TrackerType, benchmark_trackers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--video', default=os.path.join(
+        os.path.dirname(__file__), '..', 'test', 'data', 'clip.m4v'))
+    parser.add_argument('--haar-path', default=CASCADE_FACE_DETECTOR_DEFAULT_XML_PATH)
+    parser.add_argument('--types', nargs='+', default=list(TrackerType.ALL))
+    parser.add_argument('--frames', type=int, default=None)
+    args = parser.parse_args()
+
+    results = benchmark_trackers(
+        args.video,
+        CascadeDetector(haar_path=args.haar_path),
+        tracker_types=args.types,
+        frame_count=args.frames
+    )
+
+    print("{:>12} {:>10} {:>12} {:>12} {:>9} {:>6}".format(
+        "tracker", "init ms", "update ms", "max ms", "success", "IOU"))
+    for result in results:
+        print("{:>12} {:>10.2f} {:>12.2f} {:>12.2f} {:>9.0%} {:>6.2f}".format(
+            result.tracker_type,
+            result.init_seconds * 1e3,
+            result.update_seconds * 1e3,
+            result.max_update_seconds * 1e3,
+            result.success_rate,
+            result.mean_iou
+        ))
+    missing = set(args.types) - set(result.tracker_type for result in results)
+    if missing:
+        print("not available in this OpenCV build: {}".format(
+            ", ".join(sorted(missing))))
+
+
+if __name__ == '__main__':
+    main()
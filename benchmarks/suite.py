@@ -0,0 +1,414 @@
+'''
+Runs the standard eighttrack workloads and records how fast they go, so that
+versions can be compared and regressions caught.
+
+Every case runs one piece of the library over a workload, frame by frame:
+
+    cascade_detector  CascadeDetector.detect on the pixels of each frame
+    opencv_tracker    OpencvObjectTracker on each frame and its detections
+    iou               BoundingBox.iou between every pair of boxes in a frame
+    pipeline          Pipeline.run decoding (or drawing) frames, detecting
+                      and tracking objects
+
+over these workloads:
+
+    clip              test/data/clip.m4v, faces found by a CascadeDetector
+    animation         test/data/simple_animation.mp4, same
+    synthetic         frames with --boxes boxes moving around, and where they
+                      are (found by thresholding the frame in the pipeline)
+
+Each case runs in a process of its own and reports frames per second, per
+frame latency percentiles, the peak resident set size of the process and,
+from a second run under tracemalloc, the memory allocated (peak above the
+start of the frame) and retained per frame.
+
+    python benchmarks/suite.py --output before.json
+    python benchmarks/suite.py --output after.json --compare before.json
+
+With --compare the results are checked against an earlier run and the exit
+status is 1 when a case lost more than --tolerance of its frame rate or its
+p95 latency grew by more than that.
+'''
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+import cv2
+import numpy
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from eighttrack import BoundingBox, DetectedObject, Detector, Pipeline, VideoCaptureGenerator, VideoFrame
+from eighttrack.opencv import CASCADE_FACE_DETECTOR_DEFAULT_XML_PATH, CascadeDetector, OpencvObjectTracker
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'test', 'data')
+VIDEOS = {
+    'clip': os.path.join(DATA, 'clip.m4v'),
+    'animation': os.path.join(DATA, 'simple_animation.mp4'),
+}
+WORKLOADS = ('clip', 'animation', 'synthetic')
+CASES = {
+    'cascade_detector': WORKLOADS,
+    'opencv_tracker': WORKLOADS,
+    'iou': ('synthetic',),
+    'pipeline': WORKLOADS,
+}
+
+
+class MovingBoxes(object):
+    '''
+    Draws boxes bouncing around a black frame, returning the pixels and the
+    boxes of each frame.
+    '''
+
+    def __init__(self, count, width=640, height=480, seed=0):
+        random = numpy.random.RandomState(seed)
+        self.width = width
+        self.height = height
+        self.sizes = random.uniform(16, 48, (count, 2))
+        self.positions = random.uniform(0, 1, (count, 2)) * (
+            (width, height) - self.sizes)
+        self.velocities = random.uniform(-3, 3, (count, 2))
+
+    def next(self):
+        limits = (self.width, self.height) - self.sizes
+        self.positions = self.positions + self.velocities
+        bounced = (self.positions < 0) | (self.positions > limits)
+        self.velocities[bounced] = -self.velocities[bounced]
+        self.positions = numpy.clip(self.positions, 0, limits)
+
+        pixels = numpy.zeros((self.height, self.width, 3), dtype=numpy.uint8)
+        boxes = list()
+        for ((x, y), (width, height)) in zip(self.positions, self.sizes):
+            box = BoundingBox(x, y, width, height)
+            cv2.rectangle(pixels, box.pt1, box.pt2, (255, 255, 255), -1)
+            boxes.append(box)
+        return (pixels, boxes)
+
+
+class ThresholdDetector(Detector):
+    '''
+    Finds the bright blobs in a frame, which is all it takes to detect the
+    synthetic boxes.
+    '''
+
+    def detect(self, pixels):
+        gray = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+        (_, mask) = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
+        (contours, _) = cv2.findContours(
+            mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return [
+            DetectedObject('box', 1.0, BoundingBox(*cv2.boundingRect(contour)))
+            for contour in contours
+        ]
+
+
+def load_frames(workload, args):
+    '''
+    Returns a list of (pixels, boxes) for the first args.frames frames of
+    workload.
+    '''
+    if workload == 'synthetic':
+        boxes = MovingBoxes(args.boxes)
+        return [boxes.next() for _ in range(args.frames)]
+
+    detector = CascadeDetector(haar_path=args.haar_path)
+    frames = list()
+    for frame in VideoCaptureGenerator(VIDEOS[workload], end=args.frames):
+        frames.append((frame.pixels, [
+            detected.bounding_box for detected in detector.detect(frame.pixels)
+        ]))
+    return frames
+
+
+def detected_frame(pixels, boxes):
+    return VideoFrame(pixels, detected_objects=set(
+        DetectedObject('object', 1.0, box) for box in boxes))
+
+
+def cascade_detector_case(workload, args):
+    frames = load_frames(workload, args)
+
+    def run(timer):
+        detector = CascadeDetector(haar_path=args.haar_path)
+        timer.start()
+        for (pixels, _) in frames:
+            detector.detect(pixels)
+            timer.tick()
+    return run
+
+
+def opencv_tracker_case(workload, args):
+    frames = load_frames(workload, args)
+
+    def run(timer):
+        tracker = OpencvObjectTracker()
+        timer.start()
+        for (pixels, boxes) in frames:
+            tracker(detected_frame(pixels, boxes))
+            timer.tick()
+        tracker.close()
+    return run
+
+
+def iou_case(workload, args):
+    frames = load_frames(workload, args)
+
+    def run(timer):
+        timer.start()
+        for (_, boxes) in frames:
+            for (box, other) in itertools.combinations(boxes, 2):
+                box.iou(other)
+            timer.tick()
+    return run
+
+
+def pipeline_case(workload, args):
+    def run(timer):
+        if workload == 'synthetic':
+            boxes = MovingBoxes(args.boxes)
+            source = (VideoFrame(boxes.next()[0]) for _ in range(args.frames))
+            detector = ThresholdDetector()
+        else:
+            source = VideoCaptureGenerator(VIDEOS[workload], end=args.frames)
+            detector = CascadeDetector(haar_path=args.haar_path)
+        tracker = OpencvObjectTracker()
+
+        def timed(frame):
+            timer.tick()
+            return frame
+
+        timer.start()
+        Pipeline(source).add(detector).add(tracker).add(timed).run()
+        tracker.close()
+    return run
+
+
+class LatencyTimer(object):
+    '''
+    Collects the time between start() and the first tick(), and between
+    every later tick(). Cases call start() once set up and tick() once per
+    frame.
+    '''
+
+    def __init__(self):
+        self.latencies = list()
+        self.seconds = 0.0
+        self._started = None
+        self._last = None
+
+    def start(self):
+        self._started = self._last = time.perf_counter()
+
+    def tick(self):
+        now = time.perf_counter()
+        self.latencies.append(now - self._last)
+        self.seconds = now - self._started
+        self._last = now
+
+
+class AllocationTimer(object):
+    '''
+    Collects, per frame, how many bytes tracemalloc saw allocated at the
+    peak above the start of the frame and how many bytes were still
+    allocated at its end.
+    '''
+
+    def __init__(self):
+        self.allocated = list()
+        self.retained = list()
+        self._current = None
+
+    def start(self):
+        tracemalloc.reset_peak()
+        self._current = tracemalloc.get_traced_memory()[0]
+
+    def tick(self):
+        (current, peak) = tracemalloc.get_traced_memory()
+        self.allocated.append(peak - self._current)
+        self.retained.append(current - self._current)
+        tracemalloc.reset_peak()
+        self._current = current
+
+
+def measure(case, workload, args):
+    '''
+    Runs case over workload twice, once timed and once under tracemalloc,
+    and returns what was measured as a dictionary.
+    '''
+    run = globals()[case + '_case'](workload, args)
+    peak_rss_before = peak_rss()
+
+    timer = LatencyTimer()
+    run(timer)
+    peak_rss_after = peak_rss()
+    seconds = timer.seconds
+
+    memory = AllocationTimer()
+    tracemalloc.start()
+    try:
+        run(memory)
+    finally:
+        tracemalloc.stop()
+    allocated = memory.allocated
+    retained = memory.retained
+
+    latencies = numpy.array(timer.latencies) * 1e3
+    return {
+        'case': case,
+        'workload': workload,
+        'frames': len(latencies),
+        'seconds': seconds,
+        'fps': len(latencies) / seconds if seconds > 0 else None,
+        'latency_ms': dict(zip(
+            ('p50', 'p95', 'p99', 'max'),
+            numpy.percentile(latencies, (50, 95, 99, 100)).tolist()
+        )) if len(latencies) else {},
+        'peak_rss_bytes': peak_rss_after,
+        'peak_rss_growth_bytes': (
+            peak_rss_after - peak_rss_before
+            if peak_rss_after is not None else None),
+        'allocated_bytes_per_frame': (
+            float(numpy.mean(allocated)) if allocated else None),
+        'retained_bytes_per_frame': (
+            float(numpy.mean(retained)) if retained else None),
+    }
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def measure_isolated(case, workload, args):
+    '''
+    Measures case in a fresh process, so that the peak RSS of one case does
+    not hide the next.
+    '''
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(1) as pool:
+        return pool.apply(measure, (case, workload, args))
+
+
+def versions():
+    try:
+        revision = subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'revision': revision,
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+    }
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Prints how results changed against baseline and returns the cases that
+    got slower by more than tolerance.
+    '''
+    before = dict(
+        ((result['case'], result['workload']), result)
+        for result in baseline['results']
+    )
+    print("\ncompared with {}:".format(
+        baseline['versions'].get('revision') or 'baseline'))
+    print("{:>16} {:>10} {:>10} {:>10}".format("case", "workload", "fps", "p95"))
+    regressions = list()
+    for result in results:
+        old = before.get((result['case'], result['workload']))
+        if not old or not old['fps'] or not result['fps']:
+            continue
+        fps = result['fps'] / old['fps'] - 1
+        p95 = result['latency_ms']['p95'] / old['latency_ms']['p95'] - 1 \
+            if old['latency_ms'].get('p95') else 0.0
+        regressed = fps < -tolerance or p95 > tolerance
+        if regressed:
+            regressions.append(result)
+        print("{:>16} {:>10} {:>+10.1%} {:>+10.1%}{}".format(
+            result['case'], result['workload'], fps, p95,
+            "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--cases', nargs='+', default=sorted(CASES),
+                        choices=sorted(CASES))
+    parser.add_argument('--workloads', nargs='+', default=list(WORKLOADS),
+                        choices=WORKLOADS)
+    parser.add_argument('--frames', type=int, default=200,
+                        help='number of frames per workload (at most)')
+    parser.add_argument('--boxes', type=int, default=20,
+                        help='number of moving boxes in synthetic frames')
+    parser.add_argument('--haar-path', default=CASCADE_FACE_DETECTOR_DEFAULT_XML_PATH)
+    parser.add_argument('--in-process', action='store_true',
+                        help='run every case in this process (peak RSS is then cumulative)')
+    parser.add_argument('--output', help='where to write the results as JSON')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    print("{:>16} {:>10} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10} {:>12}".format(
+        "case", "workload", "frames", "fps", "p50 ms", "p95 ms", "p99 ms",
+        "RSS MB", "alloc/frame"))
+    results = list()
+    for case in args.cases:
+        for workload in CASES[case]:
+            if workload not in args.workloads:
+                continue
+            result = (measure if args.in_process else measure_isolated)(
+                case, workload, args)
+            results.append(result)
+            latency = result['latency_ms']
+            print("{:>16} {:>10} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10.1f} {:>12.0f}".format(
+                case,
+                workload,
+                result['frames'],
+                result['fps'] or 0.0,
+                latency.get('p50', 0.0),
+                latency.get('p95', 0.0),
+                latency.get('p99', 0.0),
+                (result['peak_rss_bytes'] or 0) / 1e6,
+                result['allocated_bytes_per_frame'] or 0.0
+            ))
+
+    report = {
+        'versions': versions(),
+        'settings': {'frames': args.frames, 'boxes': args.boxes},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+'''
+Measures the per-frame cost of keeping the OpencvObjectTracker spatial index up
+to date as the number of tracked objects grows.
+
+Every simulated frame a fraction of the tracked objects move and a fixed number
+of detections are matched against the index, which is what the tracker does in
+add() and update(). The incremental TrackedObjectIndex is compared with
+rebuilding an rtree index from scratch on every frame, which is what the
+tracker used to do (only when the rtree package is installed).
+
+    python benchmarks/tracker_index.py --counts 10 100 1000 --frames 200
+'''
+import argparse
+import os
+import random
+import sys
+import timeit
+
+try:
+    import rtree
+except ImportError:
+    rtree = None
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from eighttrack import BoundingBox, TrackedObject
+from eighttrack.opencv import TrackedObjectIndex
+
+
+def random_box(extent):
+    return BoundingBox(
+        random.uniform(0, extent),
+        random.uniform(0, extent),
+        random.uniform(20, 80),
+        random.uniform(20, 80)
+    )
+
+
+def moved(box):
+    return BoundingBox(
+        max(0, box.x + random.randint(-3, 3)),
+        max(0, box.y + random.randint(-3, 3)),
+        box.width,
+        box.height
+    )
+
+
+def simulate(count, frames, moving, queries, incremental):
+    random.seed(count)
+    extent = 40 * (count ** 0.5) + 200
+    tracked_objects = [
+        TrackedObject(str(index), random_box(extent)) for index in range(count)
+    ]
+    detections = [random_box(extent) for _ in range(queries)]
+
+    index = TrackedObjectIndex()
+    for tracked_object in tracked_objects:
+        index.add(tracked_object)
+
+    def frame():
+        for tracked_object in random.sample(tracked_objects, int(count * moving)):
+            tracked_object.set_last_known_location(
+                moved(tracked_object.last_known_location))
+            if incremental:
+                index.move(tracked_object)
+
+        if incremental:
+            for detection in detections:
+                index.intersection(detection.as_left_bottom_right_top())
+            return
+
+        rebuilt = rtree.index.Index(
+            (tracked_index, tracked_object.last_known_location.as_left_bottom_right_top(), None)
+            for (tracked_index, tracked_object) in enumerate(tracked_objects)
+        )
+        for detection in detections:
+            list(rebuilt.intersection(detection.as_left_bottom_right_top()))
+
+    return timeit.timeit(frame, number=frames) / frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--counts', type=int, nargs='+',
+                        default=[10, 30, 100, 300, 1000])
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--moving', type=float, default=0.1,
+                        help='fraction of the objects moving every frame')
+    parser.add_argument('--queries', type=int, default=10,
+                        help='number of detections matched every frame')
+    args = parser.parse_args()
+
+    print("{:>8} {:>18} {:>18} {:>18}".format(
+        "objects", "rebuild us/frame", "in-place us/frame", "in-place us/obj"))
+    for count in args.counts:
+        rebuild = float('nan')
+        if rtree:
+            rebuild = simulate(
+                count, args.frames, args.moving, args.queries, False)
+        in_place = simulate(count, args.frames, args.moving, args.queries, True)
+        print("{:>8} {:>18.1f} {:>18.1f} {:>18.3f}".format(
+            count, rebuild * 1e6, in_place * 1e6, in_place * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,220 @@
 name = "eighttrack"
 __import__('pkg_resources').declare_namespace(__name__)
 
+import collections
+import concurrent.futures
 import cv2
 import datetime
+import functools
+import heapq
+import itertools
+import json
+import logging
 import math
+import multiprocessing
+import numpy
 import os
 import uuid
 import time
+import threading
 import sys
 
+# Clock used to measure how long steps take.
+_now = getattr(time, 'perf_counter', time.time)
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, frames are pickled on their way to worker processes.
+    shared_memory = None
+
 if(sys.version_info[:3] < (3, 0)):
-    import itertools
+    import Queue as queue
+else:
+    import queue
+
+DEFAULT_PIPELINE_QUEUE_SIZE = int(os.environ.get(
+    'EIGHTTRACK_PIPELINE_QUEUE_SIZE',
+    '8'
+))
+'''
+DEFAULT_PIPELINE_QUEUE_SIZE is the default number of frames that may be waiting
+between two consecutive steps of a pipeline running in threaded mode. Once a
+queue is full, the upstream step blocks until the downstream step catches up.
+'''
+
+DEFAULT_DETECTION_INTERVAL = int(os.environ.get(
+    'EIGHTTRACK_DETECTION_INTERVAL',
+    '5'
+))
+'''
+DEFAULT_DETECTION_INTERVAL is the default number of frames between two
+detections when detection is scheduled by a DetectionScheduler.
+'''
+
+DEFAULT_MOTION_THRESHOLD = float(os.environ.get(
+    'EIGHTTRACK_MOTION_THRESHOLD',
+    '2.0'
+))
+'''
+DEFAULT_MOTION_THRESHOLD is the default mean absolute difference (in 0-255
+grayscale levels, measured on a downscaled frame) below which a MotionGate
+considers a frame static.
+'''
+
+DEFAULT_MAX_CONSECUTIVE_STATIC_FRAMES = int(os.environ.get(
+    'EIGHTTRACK_MAX_CONSECUTIVE_STATIC_FRAMES',
+    '30'
+))
+'''
+DEFAULT_MAX_CONSECUTIVE_STATIC_FRAMES is the default number of frames in a row
+a MotionGate may mark as static before letting one through regardless.
+'''
+
+DEFAULT_MAX_DETECTION_INTERVAL = int(os.environ.get(
+    'EIGHTTRACK_MAX_DETECTION_INTERVAL',
+    '30'
+))
+'''
+DEFAULT_MAX_DETECTION_INTERVAL is the largest number of frames between two
+detections an adaptive DetectionScheduler will go to.
+'''
+
+DEFAULT_DETECTION_BATCH_SIZE = int(os.environ.get(
+    'EIGHTTRACK_DETECTION_BATCH_SIZE',
+    '8'
+))
+'''
+DEFAULT_DETECTION_BATCH_SIZE is the default number of frames a BatchingDetector
+hands its detector at once.
+'''
+
+DEFAULT_DETECTION_BATCH_MAX_DELAY_IN_SECONDS = float(os.environ.get(
+    'EIGHTTRACK_DETECTION_BATCH_MAX_DELAY_IN_SECONDS',
+    '0.01'
+))
+'''
+DEFAULT_DETECTION_BATCH_MAX_DELAY_IN_SECONDS is the default longest time a frame
+waits for its BatchingDetector batch to fill up before the batch is sent anyway.
+'''
+
+DEFAULT_KALMAN_TRACKER_IOU_THRESHOLD = float(os.environ.get(
+    'EIGHTTRACK_KALMAN_TRACKER_IOU_THRESHOLD',
+    '0.3'
+))
+'''
+DEFAULT_KALMAN_TRACKER_IOU_THRESHOLD is the default IOU ratio above which a
+KalmanObjectTracker matches a detection to the predicted location of an object.
+'''
+
+DEFAULT_KALMAN_TRACKER_RECOVERY_THRESHOLD_IN_SECONDS = float(os.environ.get(
+    'EIGHTTRACK_KALMAN_TRACKER_RECOVERY_THRESHOLD_IN_SECONDS',
+    '7'
+))
+'''
+DEFAULT_KALMAN_TRACKER_RECOVERY_THRESHOLD_IN_SECONDS indicates how long an
+object can be missing before a KalmanObjectTracker gives up on it.
+'''
+
+DEFAULT_PIPELINE_STATS_WINDOW = int(os.environ.get(
+    'EIGHTTRACK_PIPELINE_STATS_WINDOW',
+    '1000'
+))
+'''
+DEFAULT_PIPELINE_STATS_WINDOW is the default number of most recent latencies
+per pipeline stage that PipelineStats computes percentiles over.
+'''
+
+DEFAULT_PIPELINE_TRACE_CAPACITY = int(os.environ.get(
+    'EIGHTTRACK_PIPELINE_TRACE_CAPACITY',
+    '100000'
+))
+'''
+DEFAULT_PIPELINE_TRACE_CAPACITY is the default number of most recent events a
+PipelineTracer keeps.
+'''
+
+DEFAULT_PIPELINE_TRACE_SAMPLE_EVERY = int(os.environ.get(
+    'EIGHTTRACK_PIPELINE_TRACE_SAMPLE_EVERY',
+    '1'
+))
+'''
+DEFAULT_PIPELINE_TRACE_SAMPLE_EVERY is the default interval, in frames, between
+two frames a PipelineTracer traces. 1 traces every frame.
+'''
+
+_logger = logging.getLogger(__name__)
 
 
 class VideoFrame(object):
     '''
     Represents a single frame of video.
+
+    Each frame owns its detected_objects set, which detectors add to in place
+    as the frame goes through the pipeline, while tracked_objects is set by
+    the tracker (see OpencvObjectTracker).
+
+    detection_skipped is set by steps (such as a DetectionScheduler) that
+    decided not to run detection on the frame, so that its empty
+    detected_objects is not mistaken for a frame without objects.
+
+    is_static is set by a MotionGate when the frame barely differs from the
+    previous one, in which case later steps may reuse their previous results
+    instead of processing it again; motion_score is the measured difference.
+
+    Sources that recycle pixel buffers (see VideoCaptureGenerator) set a
+    release callback, which release() calls once the frame is done with.
+
+    Sources that know where a frame comes from set its frame_index, the
+    position of the frame in the video (counting from 0), and its
+    media_timestamp, the time of the frame in the video in seconds. Unlike
+    capture_timestamp, both do not depend on how fast the video is read.
     '''
 
-    def __init__(self, pixels, detected_objects=set(), tracked_objects=set()):
+    __slots__ = (
+        'pixels',
+        'detected_objects',
+        'tracked_objects',
+        'capture_timestamp',
+        'detection_skipped',
+        'is_static',
+        'motion_score',
+        'frame_index',
+        'media_timestamp',
+        '_release',
+    )
+
+    def __init__(self, pixels, detected_objects=None, tracked_objects=None):
         self.pixels = pixels
-        self.detected_objects = detected_objects
-        self.tracked_objects = tracked_objects
+        self.detected_objects = detected_objects if detected_objects is not None else set()
+        self.tracked_objects = tracked_objects if tracked_objects is not None else set()
         self.capture_timestamp = time.time()
+        self.detection_skipped = False
+        self.is_static = False
+        self.motion_score = None
+        self.frame_index = None
+        self.media_timestamp = None
+        self._release = None
+
+    def release(self):
+        '''
+        Hands the receiver's pixel buffer back to the source that produced it,
+        if it recycles buffers. The pixels must not be used afterwards.
+        '''
+        (callback, self._release) = (self._release, None)
+        if callback:
+            callback()
 
 
 class BoundingBox(object):
+    '''
+    An axis aligned box given by its top left corner (x, y) and its size.
+    Only those four values are stored, the corners (x1, y1, x2, y2, pt1 and
+    pt2) are derived from them when asked for.
+    '''
+
+    __slots__ = ('x', 'y', 'width', 'height')
+
     def __init__(self, x, y, width, height, round_values=True):
         assert width >= 0
         assert height >= 0
@@ -41,13 +230,35 @@ class BoundingBox(object):
         self.width = width
         self.height = height
 
-        self.x1 = x
-        self.x2 = x + width
-        self.y1 = y
-        self.y2 = y + height
+    @property
+    def x1(self):
+        return self.x
+
+    @property
+    def y1(self):
+        return self.y
+
+    @property
+    def x2(self):
+        return self.x + self.width
+
+    @property
+    def y2(self):
+        return self.y + self.height
 
-        self.pt1 = (self.x1, self.y1)
-        self.pt2 = (self.x2, self.y2)
+    @property
+    def pt1(self):
+        return (self.x, self.y)
+
+    @property
+    def pt2(self):
+        return (self.x + self.width, self.y + self.height)
+
+    def __getstate__(self):
+        return (self.x, self.y, self.width, self.height)
+
+    def __setstate__(self, state):
+        (self.x, self.y, self.width, self.height) = state
 
     def __eq__(self, other):
         if not isinstance(other, BoundingBox):
@@ -79,7 +290,7 @@ class BoundingBox(object):
         return (self.x + self.width/2.0, self.y + self.height/2.0)
 
     def as_point_pair(self):
-        return (self.x1, self.y1, self.x2, self.y2)
+        return (self.x, self.y, self.x + self.width, self.y + self.height)
 
     def as_origin_and_size(self):
         return (self.x, self.y, self.width, self.height)
@@ -107,16 +318,18 @@ class BoundingBox(object):
         Returns a float representing the area of intersection between the
         reciever and the given bounding box.
         '''
-        if self.x2 < other.x1 or other.x2 < self.x1:
+        (x1, y1, x2, y2) = self.as_point_pair()
+        (other_x1, other_y1, other_x2, other_y2) = other.as_point_pair()
+        if x2 < other_x1 or other_x2 < x1:
             # No intersection in x
             return 0
-        if self.y2 < other.y1 or other.y2 < self.y1:
+        if y2 < other_y1 or other_y2 < y1:
             # No intersection in y
             return 0
-        minX = max(self.x1, other.x1)
-        minY = max(self.y1, other.y1)
-        maxX = min(self.x2, other.x2)
-        maxY = min(self.y2, other.y2)
+        minX = max(x1, other_x1)
+        minY = max(y1, other_y1)
+        maxX = min(x2, other_x2)
+        maxY = min(y2, other_y2)
         return float(max(0, maxX - minX) * max(0, maxY - minY))
 
     def union(self, other):
@@ -124,19 +337,454 @@ class BoundingBox(object):
         Returns a float representing the area of union between the receiver and
         the given bounding box.
         '''
-        return float((max(other.x2, self.x2) - min(other.x1, self.x1)) * (max(other.y2, self.y2) - min(other.y1, self.y1)))
+        (x1, y1, x2, y2) = self.as_point_pair()
+        (other_x1, other_y1, other_x2, other_y2) = other.as_point_pair()
+        return float((max(other_x2, x2) - min(other_x1, x1)) * (max(other_y2, y2) - min(other_y1, y1)))
+
+
+class BoxArray(object):
+    '''
+    A BoxArray holds many bounding boxes as parallel NumPy arrays of corner
+    coordinates so that pairwise intersections, unions, IOU ratios and center
+    distances are computed for all boxes in a single call. The pairwise methods
+    return len(self) x len(other) matrices and follow the semantics of the
+    BoundingBox methods of the same name.
+    '''
+
+    def __init__(self, x1, y1, x2, y2):
+        self.x1 = numpy.asarray(x1)
+        self.y1 = numpy.asarray(y1)
+        self.x2 = numpy.asarray(x2)
+        self.y2 = numpy.asarray(y2)
+
+    @classmethod
+    def from_boxes(cls, boxes):
+        '''
+        Returns a BoxArray holding the given iterable of BoundingBox instances.
+        '''
+        points = numpy.array(
+            [box.as_point_pair() for box in boxes]
+        ).reshape(-1, 4)
+        return cls(points[:, 0], points[:, 1], points[:, 2], points[:, 3])
+
+    def to_boxes(self):
+        '''
+        Returns the receiver as a list of BoundingBox instances.
+        '''
+        return [
+            BoundingBox(x1, y1, x2 - x1, y2 - y1, round_values=False)
+            for (x1, y1, x2, y2) in zip(
+                self.x1.tolist(),
+                self.y1.tolist(),
+                self.x2.tolist(),
+                self.y2.tolist()
+            )
+        ]
+
+    def __len__(self):
+        return len(self.x1)
+
+    def __getitem__(self, key):
+        '''
+        Returns a BoundingBox for an integer key, and a BoxArray for a slice,
+        boolean mask or array of indices.
+        '''
+        if isinstance(key, (int, numpy.integer)):
+            (x1, y1, x2, y2) = (
+                self.x1[key].item(),
+                self.y1[key].item(),
+                self.x2[key].item(),
+                self.y2[key].item()
+            )
+            return BoundingBox(x1, y1, x2 - x1, y2 - y1, round_values=False)
+        return BoxArray(self.x1[key], self.y1[key], self.x2[key], self.y2[key])
+
+    def widths(self):
+        return self.x2 - self.x1
+
+    def heights(self):
+        return self.y2 - self.y1
+
+    def areas(self):
+        return (self.widths() * self.heights()).astype(numpy.float64)
+
+    def centers(self):
+        '''
+        Returns a len(self) x 2 array of box centers.
+        '''
+        return numpy.stack(
+            (self.x1 + self.widths() / 2.0, self.y1 + self.heights() / 2.0),
+            axis=-1
+        )
+
+    def intersection(self, other):
+        '''
+        Returns the matrix of intersection areas between the receiver's boxes
+        (rows) and the other BoxArray's boxes (columns).
+        '''
+        widths = numpy.minimum(self.x2[:, None], other.x2[None, :]) - \
+            numpy.maximum(self.x1[:, None], other.x1[None, :])
+        heights = numpy.minimum(self.y2[:, None], other.y2[None, :]) - \
+            numpy.maximum(self.y1[:, None], other.y1[None, :])
+        return (
+            numpy.maximum(widths, 0) * numpy.maximum(heights, 0)
+        ).astype(numpy.float64)
+
+    def union(self, other):
+        '''
+        Returns the matrix of union areas (the area of the box enclosing both
+        boxes, as in BoundingBox.union) between the receiver and other.
+        '''
+        widths = numpy.maximum(self.x2[:, None], other.x2[None, :]) - \
+            numpy.minimum(self.x1[:, None], other.x1[None, :])
+        heights = numpy.maximum(self.y2[:, None], other.y2[None, :]) - \
+            numpy.minimum(self.y1[:, None], other.y1[None, :])
+        return (widths * heights).astype(numpy.float64)
+
+    def iou(self, other):
+        '''
+        Returns the matrix of intersection over union ratios between the
+        receiver and other.
+        '''
+        union = self.union(other)
+        intersection = self.intersection(other)
+        return numpy.divide(
+            intersection,
+            union,
+            out=numpy.zeros_like(intersection),
+            where=union != 0
+        )
+
+    def distance(self, other):
+        '''
+        Returns the matrix of distances between the centers of the receiver's
+        boxes and the centers of other's boxes.
+        '''
+        deltas = self.centers()[:, None, :] - other.centers()[None, :, :]
+        return numpy.sqrt((deltas ** 2).sum(axis=-1))
+
 
+def non_max_suppression(boxes, scores, iou_threshold):
+    '''
+    Returns the indices of the boxes (a BoxArray) to keep when any two boxes
+    whose IOU ratio is above iou_threshold are considered the same object, in
+    which case the box with the highest score (then the largest one) is kept.
+    Indices are returned in that order.
+    '''
+    scores = numpy.asarray(scores, dtype=numpy.float64)
+    order = numpy.lexsort((-boxes.areas(), -scores))
+    overlapping = boxes.iou(boxes) > iou_threshold
+    suppressed = numpy.zeros(len(boxes), dtype=bool)
+    kept = list()
+    for index in order.tolist():
+        if suppressed[index]:
+            continue
+        kept.append(index)
+        suppressed |= overlapping[index]
+    return kept
+
+
+class AssignmentMethod(object):
+    '''
+    AssignmentMethod represents the ways detections can be matched to tracks.
+
+    SEQUENTIAL: each detection takes its best matching track in turn, so two
+                detections may claim the same track (see OpencvObjectTracker).
+    GREEDY:     the cheapest detection and track pairs are matched first, and
+                every detection and track is matched at most once.
+    HUNGARIAN:  detections and tracks are matched so that the total cost of
+                all matches is minimal.
+    '''
+    SEQUENTIAL = 'sequential'
+    GREEDY = 'greedy'
+    HUNGARIAN = 'hungarian'
+
+
+class Assignment(object):
+    '''
+    The result of matching detections (the rows of a cost matrix) to tracks
+    (its columns): a list of (detection, track) index pairs, plus the indices
+    of the detections and tracks that were left unmatched.
+    '''
+
+    def __init__(self, matches, unmatched_detections, unmatched_tracks):
+        self.matches = matches
+        self.unmatched_detections = unmatched_detections
+        self.unmatched_tracks = unmatched_tracks
+
+
+class MatchMetric(object):
+    '''
+    MatchMetric represents the ways the cost of matching a detection to a
+    track is measured (see match_cost).
+
+    IOU:              1 - IOU, feasible when the IOU is above a threshold.
+    DISTANCE:         distance between box centers as a fraction of the
+                      track box diagonal, feasible up to a maximum.
+    IOU_AND_DISTANCE: the sum of both, feasible when both are.
+    '''
+    IOU = 'iou'
+    DISTANCE = 'distance'
+    IOU_AND_DISTANCE = 'iou_and_distance'
+
+
+def match_cost(detections, tracks, metric=MatchMetric.IOU, iou_threshold=0.0, max_distance=0.5):
+    '''
+    Returns a (cost, feasible) pair of detections x tracks matrices for the
+    given BoxArray instances, as expected by assign.
+    '''
+    cost = numpy.zeros((len(detections), len(tracks)))
+    feasible = numpy.ones(cost.shape, dtype=bool)
+    if metric not in (MatchMetric.IOU, MatchMetric.DISTANCE, MatchMetric.IOU_AND_DISTANCE):
+        raise ValueError("{} is not a valid match metric.".format(metric))
+
+    if metric in (MatchMetric.IOU, MatchMetric.IOU_AND_DISTANCE):
+        ious = detections.iou(tracks)
+        cost += 1.0 - ious
+        feasible &= ious > iou_threshold
+
+    if metric in (MatchMetric.DISTANCE, MatchMetric.IOU_AND_DISTANCE):
+        diagonals = numpy.sqrt(
+            tracks.widths() ** 2.0 + tracks.heights() ** 2.0)[None, :]
+        distances = numpy.divide(
+            detections.distance(tracks),
+            diagonals,
+            out=numpy.full(cost.shape, numpy.inf),
+            where=diagonals != 0
+        )
+        feasible &= distances <= max_distance
+        cost += numpy.where(feasible, distances, 0.0)
+
+    return (cost, feasible)
+
+
+def assign(cost, feasible=None, method=AssignmentMethod.HUNGARIAN):
+    '''
+    Matches detections to tracks given a detections x tracks cost matrix,
+    with each detection and track matched at most once. Pairs where the
+    feasible boolean matrix is False are never matched.
+
+    Returns an Assignment.
+    '''
+    cost = numpy.asarray(cost, dtype=numpy.float64)
+    if feasible is None:
+        feasible = numpy.ones(cost.shape, dtype=bool)
+
+    if method == AssignmentMethod.GREEDY:
+        matches = _assign_greedy(cost, feasible)
+    elif method == AssignmentMethod.HUNGARIAN:
+        matches = _assign_hungarian(cost, feasible)
+    else:
+        raise ValueError("{} is not a valid assignment method.".format(method))
+
+    matched_detections = set(row for (row, _) in matches)
+    matched_tracks = set(column for (_, column) in matches)
+    return Assignment(
+        matches,
+        [row for row in range(cost.shape[0]) if row not in matched_detections],
+        [column for column in range(cost.shape[1])
+         if column not in matched_tracks]
+    )
+
+
+def _assign_greedy(cost, feasible):
+    (rows, columns) = numpy.nonzero(feasible)
+    order = numpy.argsort(cost[rows, columns], kind='stable')
+    used_rows = set()
+    used_columns = set()
+    matches = list()
+    for (row, column) in zip(rows[order].tolist(), columns[order].tolist()):
+        if row in used_rows or column in used_columns:
+            continue
+        used_rows.add(row)
+        used_columns.add(column)
+        matches.append((row, column))
+    return sorted(matches)
+
+
+def _assign_hungarian(cost, feasible):
+    # Detections and tracks only compete with the ones they could be matched
+    # with, so each group of them linked by feasible pairs is solved on its
+    # own, which keeps the problems small when objects are spread out.
+    matches = list()
+    for (rows, columns) in _feasible_components(feasible):
+        if len(rows) == 1 or len(columns) == 1:
+            # A lone detection (or track) feasible with every member of its
+            # group simply takes the cheapest one.
+            best = int(numpy.argmin(cost[rows[:, None], columns].ravel()))
+            (row, column) = divmod(best, len(columns))
+            matches.append((int(rows[row]), int(columns[column])))
+            continue
+        component = numpy.ix_(rows, columns)
+        for (row, column) in _assign_hungarian_dense(cost[component], feasible[component]):
+            matches.append((int(rows[row]), int(columns[column])))
+    return sorted(matches)
+
+
+def _feasible_components(feasible):
+    '''
+    Returns the connected components of the bipartite graph of feasible
+    (row, column) pairs, as (rows, columns) pairs of index arrays.
+    '''
+    (rows, columns) = numpy.nonzero(feasible)
+    row_count = feasible.shape[0]
+    parents = list(range(row_count + feasible.shape[1]))
+
+    def root(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    for (row, column) in zip(rows.tolist(), columns.tolist()):
+        (row_root, column_root) = (root(row), root(row_count + column))
+        if row_root != column_root:
+            parents[column_root] = row_root
+
+    components = collections.OrderedDict()
+    for node in sorted(set(rows.tolist())) + sorted(set((row_count + columns).tolist())):
+        components.setdefault(root(node), ([], []))[
+            node >= row_count].append(node)
+    return [
+        (numpy.array(component_rows),
+         numpy.array(component_columns) - row_count)
+        for (component_rows, component_columns) in components.values()
+    ]
+
+
+def _assign_hungarian_dense(cost, feasible):
+    if not feasible.any():
+        return list()
+
+    # Infeasible pairs get a cost higher than any full assignment of
+    # feasible pairs, so they are only picked when nothing else is left and
+    # are then dropped.
+    spread = cost[feasible].max() - min(cost[feasible].min(), 0.0) + 1.0
+    padded = numpy.where(feasible, cost, spread * (min(cost.shape) + 1))
+
+    transposed = padded.shape[0] > padded.shape[1]
+    if transposed:
+        padded = padded.T
+
+    pairs = _hungarian(padded)
+    if transposed:
+        pairs = [(row, column) for (column, row) in pairs]
+    return sorted(
+        (row, column) for (row, column) in pairs if feasible[row, column]
+    )
+
+
+def _hungarian(cost):
+    '''
+    Solves the rectangular assignment problem for an n x m cost matrix with
+    n <= m using shortest augmenting paths (O(n^2 m)), with the inner loop
+    over columns vectorized. Returns a list of (row, column) pairs.
+    '''
+    (rows, columns) = cost.shape
+    u = numpy.zeros(rows + 1)
+    v = numpy.zeros(columns + 1)
+    # owner[j] is the (1 based) row matched to column j, column 0 is a
+    # sentinel used while augmenting.
+    owner = numpy.zeros(columns + 1, dtype=int)
+    way = numpy.zeros(columns + 1, dtype=int)
+
+    for row in range(1, rows + 1):
+        owner[0] = row
+        current = 0
+        min_values = numpy.full(columns + 1, numpy.inf)
+        used = numpy.zeros(columns + 1, dtype=bool)
+        while True:
+            used[current] = True
+            current_row = owner[current]
+            free = ~used[1:]
+            reduced = cost[current_row - 1] - u[current_row] - v[1:]
+            improved = free & (reduced < min_values[1:])
+            min_values[1:][improved] = reduced[improved]
+            way[1:][improved] = current
+
+            candidates = numpy.where(free, min_values[1:], numpy.inf)
+            following = int(numpy.argmin(candidates)) + 1
+            delta = candidates[following - 1]
+
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_values[1:][free] -= delta
 
-class DetectedObject(object):
+            current = following
+            if owner[current] == 0:
+                break
+
+        while current:
+            previous = way[current]
+            owner[current] = owner[previous]
+            current = previous
+
+    return [
+        (int(owner[column]) - 1, column - 1)
+        for column in range(1, columns + 1)
+        if owner[column] != 0
+    ]
+
+
+_serials = itertools.count(1)
+
+
+class _Identified(object):
+    '''
+    Base class for objects with an object_id. Objects created without one
+    only get an integer serial (unique within the process); a uuid4 is made
+    up the first time object_id is asked for, or when they are pickled.
+    '''
+
+    __slots__ = ('serial', '_object_id')
+
+    def __init__(self, object_id=None):
+        self.serial = next(_serials)
+        self._object_id = object_id if object_id else None
+
+    @property
+    def object_id(self):
+        if self._object_id is None:
+            self._object_id = uuid.uuid4()
+        return self._object_id
+
+    @object_id.setter
+    def object_id(self, object_id):
+        self._object_id = object_id
+
+    def __getstate__(self):
+        # Serials are only unique within a process, so objects leaving it
+        # take a real object_id with them.
+        self.object_id
+        state = dict(getattr(self, '__dict__', ()))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            setattr(self, name, value)
+
+    def _same_object_id(self, other):
+        if self._object_id is None and other._object_id is None:
+            return self.serial == other.serial
+        return self.object_id == other.object_id
+
+
+class DetectedObject(_Identified):
     '''
     Represents a simple detected object in a given frame of video.
     '''
 
+    __slots__ = ('label', 'score', 'bounding_box')
+
     def __init__(self, label, score, bounding_box, object_id=None):
+        _Identified.__init__(self, object_id)
         self.label = label
         self.score = score
         self.bounding_box = bounding_box
-        self.object_id = object_id if object_id else uuid.uuid4()
 
     def __eq__(self, other):
         if not isinstance(other, DetectedObject):
@@ -145,13 +793,15 @@ class DetectedObject(object):
         return self.label == other.label and \
             self.score == other.score and \
             self.bounding_box == other.bounding_box and \
-            self.object_id == other.object_id
+            self._same_object_id(other)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(self.object_id)
+        # Equal objects have equal labels and boxes; hashing those does not
+        # require making up an object_id.
+        return hash((self.label, self.bounding_box))
 
     def __str__(self):
         return "DetectedObject({}, {}, {}, {})".format(
@@ -176,20 +826,101 @@ class TrackedObjectState(object):
     LOST = 3
 
 
-class TrackedObject(object):
-    def __init__(self, object_id, bounding_box, recovery_threshold_in_seconds=15):
-        self.object_id = object_id if object_id else uuid.uuid4()
+class MonotonicClock(object):
+    '''
+    Clocks tell tracked objects what time it is, in seconds, and are told
+    about every frame a tracker sees (see observe).
+
+    The MonotonicClock is the default clock: it measures real time, so that
+    the outcome of tracking depends on how fast frames are processed.
+    '''
+
+    def now(self):
+        return _now()
+
+    def observe(self, frame):
+        pass
+
+
+class FrameClock(object):
+    '''
+    A FrameClock measures time in frames: the time of a frame is its
+    frame_index divided by fps, and frames without a frame_index come right
+    after the previous one. With the default fps of 1, thresholds in seconds
+    are effectively numbers of frames.
+    '''
+
+    def __init__(self, fps=1.0):
+        if fps <= 0:
+            raise ValueError("fps must be positive.")
+        self.fps = float(fps)
+        self.frame_index = None
+
+    def now(self):
+        return (self.frame_index or 0) / self.fps
+
+    def observe(self, frame):
+        if frame.frame_index is not None:
+            self.frame_index = frame.frame_index
+        elif self.frame_index is None:
+            self.frame_index = 0
+        else:
+            self.frame_index = self.frame_index + 1
+
+
+class MediaClock(object):
+    '''
+    A MediaClock measures time by the media_timestamp of the frames, so that
+    tracking a file gives the same results however fast it is processed.
+    Frames without a media_timestamp do not move the clock.
+    '''
+
+    def __init__(self):
+        self.timestamp = 0.0
+
+    def now(self):
+        return self.timestamp
+
+    def observe(self, frame):
+        if frame.media_timestamp is not None:
+            self.timestamp = frame.media_timestamp
+
+
+_DEFAULT_CLOCK = MonotonicClock()
+
+
+class TrackedObject(_Identified):
+    '''
+    A TrackedObject keeps track of where and when an object was seen. Times
+    are measured by clock (a MonotonicClock when none is given) and the
+    timestamps are in seconds, as returned by the clock's now().
+    '''
+
+    __slots__ = (
+        'recovery_threshold_in_seconds',
+        'state',
+        'clock',
+        'first_known_location',
+        'first_known_location_timestamp',
+        'last_known_location',
+        'last_known_location_timestamp',
+    )
+
+    def __init__(self, object_id, bounding_box, recovery_threshold_in_seconds=15, clock=None):
+        _Identified.__init__(self, object_id)
         self.recovery_threshold_in_seconds = recovery_threshold_in_seconds
         self.state = TrackedObjectState.TRACKING
+        self.clock = clock if clock else _DEFAULT_CLOCK
 
+        now = self.clock.now()
         self.first_known_location = bounding_box
-        self.first_known_location_timestamp = datetime.datetime.utcnow()
+        self.first_known_location_timestamp = now
         self.last_known_location = bounding_box
-        self.last_known_location_timestamp = datetime.datetime.utcnow()
+        self.last_known_location_timestamp = now
 
     def set_last_known_location(self, bounding_box):
         self.last_known_location = bounding_box
-        self.last_known_location_timestamp = datetime.datetime.utcnow()
+        self.last_known_location_timestamp = self.clock.now()
         self.state = TrackedObjectState.TRACKING
 
     def report_missing(self):
@@ -218,23 +949,40 @@ class TrackedObject(object):
         }.get(self.state, "UNKNOWN")
 
     def age_in_seconds(self):
-        current_timestamp = datetime.datetime.utcnow()
-        delta = current_timestamp - self.first_known_location_timestamp
-        return delta.total_seconds()
+        return self.clock.now() - self.first_known_location_timestamp
 
     def seconds_since_last_known_location(self):
-        current_timestamp = datetime.datetime.utcnow()
-        delta = current_timestamp - self.last_known_location_timestamp
-        return delta.total_seconds()
+        return self.clock.now() - self.last_known_location_timestamp
 
     def total_distance_traveled(self):
         return abs(self.last_known_location - self.first_known_location)
 
+    def snapshot(self):
+        '''
+        Returns a plain TrackedObject with the receiver's identity, state and
+        locations as they are now, which later updates of the receiver leave
+        untouched. Trackers hand snapshots to frames that go on to steps
+        running alongside them, in threaded and asyncio pipelines.
+        '''
+        snapshot = TrackedObject.__new__(TrackedObject)
+        snapshot.serial = self.serial
+        # The id is settled here so that the receiver and its snapshots never
+        # make up different ones.
+        snapshot._object_id = self.object_id
+        snapshot.recovery_threshold_in_seconds = self.recovery_threshold_in_seconds
+        snapshot.state = self.state
+        snapshot.clock = self.clock
+        snapshot.first_known_location = _copy_box(self.first_known_location)
+        snapshot.first_known_location_timestamp = self.first_known_location_timestamp
+        snapshot.last_known_location = _copy_box(self.last_known_location)
+        snapshot.last_known_location_timestamp = self.last_known_location_timestamp
+        return snapshot
+
     def __eq__(self, other):
-        if not isinstance(other, DetectedObject):
+        if not isinstance(other, TrackedObject):
             return False
 
-        return self.object_id == other.object_id and \
+        return self._same_object_id(other) and \
             self.state == other.state and \
             self.first_known_location == other.first_known_location and \
             self.last_known_location == other.last_known_location
@@ -243,86 +991,2317 @@ class TrackedObject(object):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(self.object_id)
+        return hash(self.first_known_location)
 
 
-class Pipeline(object):
+def _copy_box(box):
+    return BoundingBox(box.x, box.y, box.width, box.height, round_values=False)
+
+
+class EvictionPolicy(object):
     '''
-    A Pipleline represents a series made up by a video source (in the form of a
-    Python generator of VideoFrame instances) followed by a list of steps
-    (Python callables taking a VideoFrame instance as input).
+    EvictionPolicy represents which tracked objects are given up on first when
+    a tracker tracks more objects than it is allowed to.
+
+    OLDEST:          the objects first seen the longest time ago.
+    LEAST_CONFIDENT: the objects the tracker is least sure about: LOST objects
+                     first, then MISSING ones, then TRACKING ones, each by how
+                     long ago they were last seen.
     '''
+    OLDEST = 'oldest'
+    LEAST_CONFIDENT = 'least_confident'
 
-    def __init__(self, source=None):
+
+_CONFIDENCE_BY_STATE = {
+    TrackedObjectState.LOST: 0,
+    TrackedObjectState.MISSING: 1,
+    TrackedObjectState.TRACKING: 2,
+}
+
+
+def select_for_eviction(tracked_objects, count, policy=EvictionPolicy.OLDEST):
+    '''
+    Returns the count tracked objects that the given EvictionPolicy gives up
+    on first. Objects the policy ranks equally are taken in the order given.
+    '''
+    if policy == EvictionPolicy.OLDEST:
+        def key(tracked_object):
+            return tracked_object.first_known_location_timestamp
+    elif policy == EvictionPolicy.LEAST_CONFIDENT:
+        def key(tracked_object):
+            return (
+                _CONFIDENCE_BY_STATE.get(tracked_object.state, 0),
+                tracked_object.last_known_location_timestamp
+            )
+    else:
+        raise ValueError("{} is not a valid eviction policy.".format(policy))
+
+    if count <= 0:
+        return list()
+    return heapq.nsmallest(count, tracked_objects, key=key)
+
+
+_KALMAN_TRANSITION = numpy.eye(8) + numpy.eye(8, k=4)
+'''
+Moves the (center x, center y, width, height) half of a motion state by its
+velocity half, once per frame.
+'''
+
+# Standard deviations of the process and measurement noise, relative to the
+# width (horizontally) and height (vertically) of a box.
+_KALMAN_POSITION_WEIGHT = 1.0 / 20
+_KALMAN_VELOCITY_WEIGHT = 1.0 / 160
+
+
+def _kalman_noise(means, weights):
+    '''
+    Returns diagonal covariance matrices for the given motion states, with
+    standard deviations of weight times the box width and height for each
+    pair of entries.
+    '''
+    sizes = numpy.maximum(means[:, 2:4], 1.0)
+    deviations = numpy.concatenate([weight * sizes for weight in weights], axis=1)
+    noise = numpy.zeros(deviations.shape + deviations.shape[1:])
+    diagonal = numpy.arange(deviations.shape[1])
+    noise[:, diagonal, diagonal] = deviations ** 2
+    return noise
+
+
+def _kalman_measurements(boxes):
+    return numpy.stack([
+        (boxes.x1 + boxes.x2) / 2.0,
+        (boxes.y1 + boxes.y2) / 2.0,
+        boxes.widths(),
+        boxes.heights(),
+    ], axis=1).astype(numpy.float64).reshape(-1, 4)
+
+
+def _kalman_box_array(means):
+    sizes = numpy.maximum(means[:, 2:4], 0.0)
+    return BoxArray(
+        means[:, 0] - sizes[:, 0] / 2.0,
+        means[:, 1] - sizes[:, 1] / 2.0,
+        means[:, 0] + sizes[:, 0] / 2.0,
+        means[:, 1] + sizes[:, 1] / 2.0
+    )
+
+
+def _kalman_boxes(means):
+    sizes = numpy.maximum(means[:, 2:4], 0.0)
+    return [
+        BoundingBox(center_x - width / 2.0, center_y - height / 2.0, width, height)
+        for ((center_x, center_y), (width, height))
+        in zip(means[:, :2].tolist(), sizes.tolist())
+    ]
+
+
+class KalmanTrackedObject(TrackedObject):
+    '''
+    TrackedObject of a KalmanObjectTracker. Its motion state lives in the
+    tracker's arrays, in the row given by position.
+    '''
+
+    __slots__ = ('position',)
+
+    def __init__(self, object_id, bounding_box, recovery_threshold_in_seconds=15, clock=None):
+        TrackedObject.__init__(
+            self,
+            object_id,
+            bounding_box,
+            recovery_threshold_in_seconds,
+            clock
+        )
+        self.position = None
+
+
+class KalmanObjectTracker(object):
+    '''
+    The KalmanObjectTracker is a lightweight alternative to the
+    OpencvObjectTracker that never looks at pixels: each object's box center
+    and size follow a constant velocity model, predicted on every frame and
+    corrected by the detections matched to it, in the style of SORT. The
+    Kalman filters of all objects are run at once on NumPy arrays, so the cost
+    of a frame barely depends on the number of objects.
+
+    Objects move to their predicted location on every frame. They are only
+    reported missing on frames where detection actually ran (frames with
+    detection_skipped set, see DetectionScheduler, do not count), and go LOST
+    after recovery_threshold_in_seconds as measured by clock. Detections are
+    matched to objects as by OpencvObjectTracker with the given assignment
+    method and match_metric, and evict_lost, max_tracked_objects and eviction
+    work the same way too.
+    '''
+
+    def __init__(self, recovery_threshold_in_seconds=DEFAULT_KALMAN_TRACKER_RECOVERY_THRESHOLD_IN_SECONDS, assignment=AssignmentMethod.HUNGARIAN, match_metric=MatchMetric.IOU, iou_threshold=DEFAULT_KALMAN_TRACKER_IOU_THRESHOLD, max_center_distance=0.5, clock=None, evict_lost=True, max_tracked_objects=0, eviction=EvictionPolicy.OLDEST):
+        if assignment not in (AssignmentMethod.GREEDY, AssignmentMethod.HUNGARIAN):
+            raise ValueError(
+                "{} is not a valid assignment method.".format(assignment))
+        if eviction not in (EvictionPolicy.OLDEST, EvictionPolicy.LEAST_CONFIDENT):
+            raise ValueError(
+                "{} is not a valid eviction policy.".format(eviction))
+        self.recovery_threshold_in_seconds = recovery_threshold_in_seconds
+        self.assignment = assignment
+        self.match_metric = match_metric
+        self.iou_threshold = iou_threshold
+        self.max_center_distance = max_center_distance
+        self.clock = clock if clock else MonotonicClock()
+        self.evict_lost = evict_lost
+        self.max_tracked_objects = max_tracked_objects
+        self.eviction = eviction
+        self.evicted_objects = 0
+        self.last_assignment = None
+        self.tracked_objects = list()
+        # Row i holds the (center x, center y, width, height) of
+        # tracked_objects[i] followed by their velocities, and its covariance.
+        self.means = numpy.zeros((0, 8))
+        self.covariances = numpy.zeros((0, 8, 8))
+
+    def __call__(self, frame):
+        self.clock.observe(frame)
+        if self.evict_lost:
+            self.evicted_objects = self.evicted_objects + \
+                self.remove_lost_objects()
+        # Static frames (see MotionGate) keep the previous frame's results.
+        if not frame.is_static:
+            self.update(frame)
+        frame.tracked_objects = _tracked_objects_for_frame(self.tracked_objects)
+        return frame
+
+    def update(self, frame):
         '''
-        Constructor that takes an optional VideoFrame generator.
+        Moves every object to its predicted location, then, unless detection
+        was skipped on the frame, corrects them with its detected objects and
+        starts tracking the detections that match no object.
         '''
-        self._generator = source
-        self._steps = []
+        self.predict()
+        if not frame.detection_skipped:
+            self.correct(
+                [detected.bounding_box for detected in frame.detected_objects])
+        return self.tracked_objects
 
-    def add(self, step):
+    def predict(self):
         '''
-        Adds a given callable to the pipeline represented by the receiver.
+        Advances the motion state of all objects by one frame.
         '''
-        if None == self._generator:
-            self._generator = step
-        else:
-            self._steps.append(step)
-        return self
-
-    def _assemble(self):
-        # assert self._generator != None
-        # assert len(self._steps) > 0
-        last = self._generator
-        for current in self._steps:
-            if(sys.version_info[:3] < (3, 0)):
-                transformed = itertools.imap(current, last)
-            else:
-                transformed = map(current, last)
-            last = transformed
-        return last
-
-    def run(self):
+        if not self.tracked_objects:
+            return
+        self.means = self.means.dot(_KALMAN_TRANSITION.T)
+        self.covariances = numpy.matmul(
+            numpy.matmul(_KALMAN_TRANSITION, self.covariances),
+            _KALMAN_TRANSITION.T
+        )
+        self.covariances += _kalman_noise(self.means, (
+            _KALMAN_POSITION_WEIGHT,
+            _KALMAN_POSITION_WEIGHT,
+            _KALMAN_VELOCITY_WEIGHT,
+            _KALMAN_VELOCITY_WEIGHT
+        ))
+        for (tracked_object, box) in zip(self.tracked_objects, _kalman_boxes(self.means)):
+            tracked_object.last_known_location = box
+
+    def correct(self, bounding_boxes):
         '''
-        Runs the video source generator and pipeline step callables in series.
+        Matches the given boxes to the objects that are not LOST, corrects the
+        matched objects, reports the others missing and starts tracking the
+        boxes that match no object. Returns the objects created.
         '''
-        generator = self._assemble()
-        while True:
-            try:
-                next(generator)
-            except StopIteration:
-                return self
-            finally:
-                pass
-        return self
+        candidates = [
+            row for (row, tracked_object) in enumerate(self.tracked_objects)
+            if tracked_object.state != TrackedObjectState.LOST
+        ]
+        detections = BoxArray.from_boxes(bounding_boxes)
+        tracks = _kalman_box_array(self.means[candidates])
+        (cost, feasible) = match_cost(
+            detections,
+            tracks,
+            metric=self.match_metric,
+            iou_threshold=self.iou_threshold,
+            max_distance=self.max_center_distance
+        )
+        assignment = assign(cost, feasible, method=self.assignment)
+        self.last_assignment = assignment
+
+        rows = numpy.array(
+            [candidates[column] for (_, column) in assignment.matches], dtype=int)
+        if len(rows):
+            self._correct(rows, detections[numpy.array(
+                [row for (row, _) in assignment.matches], dtype=int)])
+            for (row, box) in zip(rows.tolist(), _kalman_boxes(self.means[rows])):
+                self.tracked_objects[row].set_last_known_location(box)
+        for column in assignment.unmatched_tracks:
+            self.tracked_objects[candidates[column]].report_missing()
+
+        # An unmatched detection overlapping a known object (or one created
+        # for an earlier unmatched detection) is a duplicate of it rather
+        # than a new object.
+        result = list()
+        unmatched = numpy.array(assignment.unmatched_detections, dtype=int)
+        if len(unmatched):
+            leftovers = detections[unmatched]
+            overlaps = leftovers.iou(tracks) > self.iou_threshold
+            duplicates = leftovers.iou(leftovers) > self.iou_threshold
+            created = list()
+            for (index, row) in enumerate(unmatched.tolist()):
+                if overlaps[index].any() or duplicates[index, created].any():
+                    continue
+                result.append(self._append_box(bounding_boxes[row]))
+                created.append(index)
+
+        if self.max_tracked_objects > 0:
+            overflow = len(self.tracked_objects) - self.max_tracked_objects
+            if overflow > 0:
+                self.remove(select_for_eviction(
+                    self.tracked_objects, overflow, self.eviction))
+                self.evicted_objects = self.evicted_objects + overflow
+        return result
+
+    def remove_lost_objects(self):
+        '''
+        Removes the LOST objects and returns how many there were.
+        '''
+        objects_to_remove = [
+            tracked_object for tracked_object in self.tracked_objects
+            if tracked_object.state == TrackedObjectState.LOST
+        ]
+        self.remove(objects_to_remove)
+        return len(objects_to_remove)
+
+    def remove(self, objects_to_remove):
+        for tracked_object in list(objects_to_remove):
+            # The last object (and its motion state) takes the place of the
+            # removed one.
+            position = tracked_object.position
+            last = self.tracked_objects.pop()
+            if last is not tracked_object:
+                self.tracked_objects[position] = last
+                self.means[position] = self.means[-1]
+                self.covariances[position] = self.covariances[-1]
+                last.position = position
+            self.means = self.means[:-1]
+            self.covariances = self.covariances[:-1]
+            tracked_object.position = None
+
+    def close(self):
+        pass
+
+    def _append_box(self, box):
+        tracked_object = KalmanTrackedObject(
+            str(uuid.uuid4()),
+            box,
+            self.recovery_threshold_in_seconds,
+            self.clock
+        )
+        tracked_object.position = len(self.tracked_objects)
+        self.tracked_objects.append(tracked_object)
+
+        mean = numpy.zeros((1, 8))
+        mean[0, :4] = _kalman_measurements(BoxArray.from_boxes([box]))
+        covariance = _kalman_noise(mean, (
+            2 * _KALMAN_POSITION_WEIGHT,
+            2 * _KALMAN_POSITION_WEIGHT,
+            10 * _KALMAN_VELOCITY_WEIGHT,
+            10 * _KALMAN_VELOCITY_WEIGHT
+        ))
+        self.means = numpy.concatenate((self.means, mean))
+        self.covariances = numpy.concatenate((self.covariances, covariance))
+        return tracked_object
+
+    def _correct(self, rows, detections):
+        means = self.means[rows]
+        covariances = self.covariances[rows]
+        # The measurement is the first half of the state, so projecting the
+        # covariance amounts to taking its top left corner.
+        innovation_covariances = covariances[:, :4, :4] + _kalman_noise(
+            means, (_KALMAN_POSITION_WEIGHT, _KALMAN_POSITION_WEIGHT))
+        cross_covariances = covariances[:, :, :4]
+        gains = numpy.linalg.solve(
+            innovation_covariances,
+            cross_covariances.transpose(0, 2, 1)
+        ).transpose(0, 2, 1)
+        innovations = _kalman_measurements(detections) - means[:, :4]
+        self.means[rows] = means + numpy.einsum('nij,nj->ni', gains, innovations)
+        self.covariances[rows] = covariances - numpy.einsum(
+            'nij,nkj->nik', gains, cross_covariances)
+
+
+class PipelineMode(object):
+    '''
+    PipelineMode represents the possible ways of running a Pipeline.
 
+    SERIAL:   the source and every step run one after another on the calling
+              thread.
+    THREADED: the source and every step run on their own worker thread,
+              connected by bounded queues, so that consecutive steps overlap.
+    '''
+    SERIAL = 'serial'
+    THREADED = 'threaded'
 
-class VideoCaptureGenerator(object):
+
+class StepGroup(object):
     '''
-    A VideoCaptureGenerator is the simplest pipeline source. It is meant as an example
-    generator around cv2.VideoCapture#read().
+    A StepGroup runs a list of steps in series as if they were a single step.
+    It is meant to put several cheap steps on the same worker when a Pipeline
+    runs in threaded mode.
     '''
 
-    def __init__(self, url):
-        self.capture = cv2.VideoCapture(url)
+    def __init__(self, *steps):
+        self.steps = list(steps)
 
-    def __del__(self):
-        self.capture.release()
+    def __call__(self, frame):
+        for step in self.steps:
+            frame = step(frame)
+        return frame
 
-    def __iter__(self):
-        return self
 
-    def __next__(self):
-        if not self.capture.isOpened():
-            raise StopIteration()
+class PipelineHook(object):
+    '''
+    A PipelineHook is told how a Pipeline run it was added to (see
+    Pipeline.add_hook) goes. Subclasses override the methods they need. In
+    threaded runs, before, after and queue_depth are called on the thread of
+    the stage concerned, so they may be called concurrently.
 
-        (ok, frame) = self.capture.read()
-        if not ok:
-            raise StopIteration()
+    Stages are named "source" for the source and "<position>:<name of the
+    step>" for steps, for instance "1:CascadeDetector".
+    '''
 
-        return VideoFrame(frame)
+    def start(self, source):
+        '''
+        Called once, with the source of the pipeline, before the run begins.
+        '''
 
-    next = __next__  # for Python 2
+    def before(self, stage, frame):
+        '''
+        Called right before stage handles frame. frame is None for the source
+        and for steps with an imap method, which pick their next frame
+        themselves.
+        '''
+
+    def after(self, stage, frame, started, seconds):
+        '''
+        Called right after stage produced frame, with the time it started at
+        (a perf_counter reading) and the number of seconds it took.
+        '''
+
+    def queue_depth(self, stage, depth):
+        '''
+        Called in threaded runs with the number of frames still waiting in
+        front of stage whenever it takes a frame.
+        '''
+
+    def frame_done(self, frame):
+        '''
+        Called for every frame that came out of the pipeline.
+        '''
+
+    def finish(self):
+        '''
+        Called once the run is over, whether it succeeded or not.
+        '''
+
+
+_SOURCE_STAGE = 'source'
+
+
+class _Hooks(object):
+    '''
+    Calls every hook of a list in turn.
+    '''
+
+    def __init__(self, hooks):
+        self.hooks = list(hooks)
+
+    def start(self, source):
+        for hook in self.hooks:
+            hook.start(source)
+
+    def before(self, stage, frame):
+        for hook in self.hooks:
+            hook.before(stage, frame)
+
+    def after(self, stage, frame, started, seconds):
+        for hook in self.hooks:
+            hook.after(stage, frame, started, seconds)
+
+    def queue_depth(self, stage, depth):
+        for hook in self.hooks:
+            hook.queue_depth(stage, depth)
+
+    def frame_done(self, frame):
+        for hook in self.hooks:
+            hook.frame_done(frame)
+
+    def finish(self):
+        for hook in self.hooks:
+            hook.finish()
+
+
+class StageStats(object):
+    '''
+    Latency and throughput of one stage (the source or a step) of a Pipeline.
+    Percentiles are computed over the last window latencies, the counts and
+    totals over the whole run. queue_depth is the number of frames that were
+    waiting in front of the stage the last time it took one (threaded runs
+    only), max_queue_depth the most there ever were.
+    '''
+
+    def __init__(self, name, window=DEFAULT_PIPELINE_STATS_WINDOW):
+        self.name = name
+        self.count = 0
+        self.total_seconds = 0.0
+        self.queue_depth = None
+        self.max_queue_depth = None
+        self._latencies = collections.deque(maxlen=window)
+        self._first = None
+        self._last = None
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        now = _now()
+        with self._lock:
+            self.count = self.count + 1
+            self.total_seconds = self.total_seconds + seconds
+            self._latencies.append(seconds)
+            if self._first is None:
+                self._first = now - seconds
+            self._last = now
+
+    def record_queue_depth(self, depth):
+        self.queue_depth = depth
+        if self.max_queue_depth is None or depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+
+    def percentiles(self, percents=(50, 95, 99)):
+        '''
+        Returns the given latency percentiles in seconds, or Nones when
+        nothing was recorded yet.
+        '''
+        with self._lock:
+            latencies = list(self._latencies)
+        if not latencies:
+            return [None for _ in percents]
+        return [float(value) for value in numpy.percentile(latencies, percents)]
+
+    def throughput(self):
+        '''
+        Returns the number of frames per second that went through the stage
+        between the first and the last one.
+        '''
+        with self._lock:
+            (count, first, last) = (self.count, self._first, self._last)
+        if not count or last <= first:
+            return None
+        return count / (last - first)
+
+    def to_dict(self):
+        (p50, p95, p99) = self.percentiles()
+        return collections.OrderedDict([
+            ('name', self.name),
+            ('count', self.count),
+            ('mean_seconds', self.total_seconds / self.count if self.count else None),
+            ('p50_seconds', p50),
+            ('p95_seconds', p95),
+            ('p99_seconds', p99),
+            ('throughput', self.throughput()),
+            ('queue_depth', self.queue_depth),
+            ('max_queue_depth', self.max_queue_depth),
+        ])
+
+
+class PipelineStats(PipelineHook):
+    '''
+    PipelineStats is a PipelineHook collecting the StageStats of every stage
+    of a Pipeline (see Pipeline.run and Pipeline.add_hook), plus the number
+    of frames that came out of the pipeline and the number the source dropped
+    (for sources with a dropped_frames count, such as a live
+    VideoCaptureGenerator).
+
+    When report_interval_in_seconds is given, report is called with the
+    to_dict() of the receiver at most that often while frames come out of
+    the pipeline, and once more at the end of the run. By default the stats
+    are logged as JSON (at INFO level, to the eighttrack logger).
+    '''
+
+    def __init__(self, window=DEFAULT_PIPELINE_STATS_WINDOW, report_interval_in_seconds=None, report=None):
+        self.window = window
+        self.report_interval_in_seconds = report_interval_in_seconds
+        self.report = report if report else _log_stats
+        self.frames = 0
+        self.source = None
+        self._stages = collections.OrderedDict()
+        self._started = None
+        self._last_report = None
+
+    @property
+    def stages(self):
+        return list(self._stages.values())
+
+    def stage(self, name):
+        '''
+        Returns the StageStats of the stage with the given name, which is
+        "source" for the source and "<position>:<name of the step>" for steps.
+        '''
+        stage = self._stages.get(name)
+        if stage is None:
+            stage = self._stages.setdefault(name, StageStats(name, self.window))
+        return stage
+
+    @property
+    def dropped_frames(self):
+        return getattr(self.source, 'dropped_frames', 0)
+
+    def throughput(self):
+        '''
+        Returns the number of frames per second that came out of the pipeline.
+        '''
+        if not self.frames or self._started is None:
+            return None
+        elapsed = _now() - self._started
+        return self.frames / elapsed if elapsed > 0 else None
+
+    def to_dict(self):
+        return collections.OrderedDict([
+            ('frames', self.frames),
+            ('throughput', self.throughput()),
+            ('dropped_frames', self.dropped_frames),
+            ('stages', [stage.to_dict() for stage in self.stages]),
+        ])
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def start(self, source):
+        self.source = source
+        if self._started is None:
+            self._started = _now()
+            self._last_report = self._started
+
+    def after(self, stage, frame, started, seconds):
+        self.stage(stage).record(seconds)
+
+    def queue_depth(self, stage, depth):
+        self.stage(stage).record_queue_depth(depth)
+
+    def frame_done(self, frame):
+        self.frames = self.frames + 1
+        if self.report_interval_in_seconds is None:
+            return
+        now = _now()
+        if now - self._last_report >= self.report_interval_in_seconds:
+            self._last_report = now
+            self.report(self.to_dict())
+
+    def finish(self):
+        if self.report_interval_in_seconds is not None:
+            self.report(self.to_dict())
+
+
+def _log_stats(stats):
+    _logger.info("pipeline stats: %s", json.dumps(stats))
+
+
+def _step_name(position, step):
+    return "{}:{}".format(
+        position, getattr(step, '__name__', type(step).__name__))
+
+
+class PipelineTracer(PipelineHook):
+    '''
+    PipelineTracer is a PipelineHook recording, for every sample_every-th
+    frame, a span per stage the frame went through, on the thread the stage
+    ran on, and a span for the whole frame, from the moment the source began
+    reading it to the moment it came out of the pipeline. The spans are
+    Chrome trace events, which chrome://tracing and https://ui.perfetto.dev
+    show on a timeline.
+
+    Only the last capacity events are kept, so a tracer may stay on for as
+    long as a pipeline runs. They are written to path, when given, at the end
+    of every run, and can be written at any time with save. Frames are
+    followed by identity, so steps are expected to return the frame they
+    were given (as the steps of this package do).
+    '''
+
+    def __init__(self, path=None, capacity=DEFAULT_PIPELINE_TRACE_CAPACITY, sample_every=DEFAULT_PIPELINE_TRACE_SAMPLE_EVERY):
+        if sample_every < 1:
+            raise ValueError("sample_every must be at least 1.")
+        self.path = path
+        self.sample_every = sample_every
+        self._events = collections.deque(maxlen=capacity)
+        # Thread idents are reused once a thread is over, so every thread
+        # gets a trace id of its own.
+        self._thread_names = {}
+        self._thread_ids = itertools.count(1)
+        self._local = threading.local()
+        # Sampled frames still in the pipeline, by id, with their number and
+        # the time the source began reading them.
+        self._frames = collections.OrderedDict()
+        self._count = 0
+        self._pid = os.getpid()
+
+    def after(self, stage, frame, started, seconds):
+        if stage == _SOURCE_STAGE:
+            number = self._count
+            self._count = self._count + 1
+            if number % self.sample_every:
+                return
+            self._frames[id(frame)] = (number, started)
+            if len(self._frames) > self._events.maxlen:
+                # Frames some step swallowed never come out.
+                self._frames.popitem(last=False)
+        else:
+            sampled = self._frames.get(id(frame))
+            if sampled is None:
+                return
+            number = sampled[0]
+        self._events.append({
+            'name': stage,
+            'cat': 'step',
+            'ph': 'X',
+            'ts': started * 1e6,
+            'dur': seconds * 1e6,
+            'pid': self._pid,
+            'tid': self._thread_id(),
+            'args': {'frame': number},
+        })
+
+    def frame_done(self, frame):
+        sampled = self._frames.pop(id(frame), None)
+        if sampled is None:
+            return
+        (number, started) = sampled
+        # Frames overlap in threaded runs, so they are async spans.
+        event = {
+            'name': 'frame',
+            'cat': 'frame',
+            'id': number,
+            'pid': self._pid,
+            'tid': self._thread_id(),
+            'args': {'frame': number},
+        }
+        self._events.append(dict(event, ph='b', ts=started * 1e6))
+        self._events.append(dict(event, ph='e', ts=_now() * 1e6))
+
+    def finish(self):
+        if self.path:
+            self.save()
+
+    def events(self):
+        '''
+        Returns the events kept so far, oldest first.
+        '''
+        return list(self._events)
+
+    def to_dict(self):
+        '''
+        Returns the events kept so far in the Chrome trace JSON object format,
+        along with the names of the threads they happened on.
+        '''
+        names = [{
+            'name': 'thread_name',
+            'ph': 'M',
+            'pid': self._pid,
+            'tid': thread_id,
+            'args': {'name': name},
+        } for (thread_id, name) in list(self._thread_names.items())]
+        return {
+            'traceEvents': names + self.events(),
+            'displayTimeUnit': 'ms',
+        }
+
+    def save(self, path=None):
+        '''
+        Writes the events kept so far to path, or to the path the receiver
+        was created with.
+        '''
+        with open(path or self.path, 'w') as output:
+            json.dump(self.to_dict(), output)
+
+    def _thread_id(self):
+        thread_id = getattr(self._local, 'thread_id', None)
+        if thread_id is None:
+            thread_id = self._local.thread_id = next(self._thread_ids)
+            self._thread_names[thread_id] = threading.current_thread().name
+        return thread_id
+
+
+def _hooked_source(generator, hooks):
+    iterator = iter(generator)
+    while True:
+        hooks.before(_SOURCE_STAGE, None)
+        started = _now()
+        try:
+            frame = next(iterator)
+        except StopIteration:
+            return
+        hooks.after(_SOURCE_STAGE, frame, started, _now() - started)
+        yield frame
+
+
+def _hooked_step(step, stage, hooks):
+    def hooked(frame):
+        hooks.before(stage, frame)
+        started = _now()
+        frame = step(frame)
+        hooks.after(stage, frame, started, _now() - started)
+        return frame
+    return hooked
+
+
+def _hooked_imap(step, frames, stage, hooks):
+    # The time a stream step spends waiting for its input is spent upstream
+    # (or in a queue), so it is left out of the step's latency.
+    upstream = [0.0]
+
+    def pull():
+        iterator = iter(frames)
+        while True:
+            started = _now()
+            try:
+                frame = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                upstream[0] = upstream[0] + _now() - started
+            yield frame
+
+    output = iter(step.imap(pull()))
+    while True:
+        hooks.before(stage, None)
+        (started, waited) = (_now(), upstream[0])
+        try:
+            frame = next(output)
+        except StopIteration:
+            return
+        hooks.after(
+            stage, frame, started, _now() - started - (upstream[0] - waited))
+        yield frame
+
+
+class Pipeline(object):
+    '''
+    A Pipleline represents a series made up by a video source (in the form of a
+    Python generator of VideoFrame instances) followed by a list of steps
+    (Python callables taking a VideoFrame instance as input).
+
+    A step may instead provide an imap(frames) method, taking an iterator of
+    VideoFrame instances and returning an iterator of them in the same order.
+    Such steps see the whole stream and can work on several frames at once
+    (see ParallelDetector).
+
+    PipelineHook instances added with add_hook are told when each stage
+    handles each frame (see PipelineStats and PipelineTracer).
+    '''
+
+    def __init__(self, source=None):
+        '''
+        Constructor that takes an optional VideoFrame generator.
+        '''
+        self._generator = source
+        self._steps = []
+        self._hooks = []
+
+    def add(self, step):
+        '''
+        Adds a given callable to the pipeline represented by the receiver.
+        '''
+        if None == self._generator:
+            self._generator = step
+        else:
+            self._steps.append(step)
+        return self
+
+    def add_hook(self, hook):
+        '''
+        Adds a PipelineHook to every later run of the receiver.
+        '''
+        self._hooks.append(hook)
+        return self
+
+    def _assemble(self, hooks=None):
+        # assert self._generator != None
+        # assert len(self._steps) > 0
+        last = self._generator
+        if hooks:
+            last = _hooked_source(last, hooks)
+        for (position, current) in enumerate(self._steps, 1):
+            if hasattr(current, 'imap'):
+                if hooks:
+                    transformed = _hooked_imap(
+                        current, last, _step_name(position, current), hooks)
+                else:
+                    transformed = current.imap(last)
+            else:
+                if hooks:
+                    current = _hooked_step(
+                        current, _step_name(position, current), hooks)
+                if(sys.version_info[:3] < (3, 0)):
+                    transformed = itertools.imap(current, last)
+                else:
+                    transformed = map(current, last)
+            last = transformed
+        return last
+
+    def run(self, mode=PipelineMode.SERIAL, queue_size=DEFAULT_PIPELINE_QUEUE_SIZE, stats=None):
+        '''
+        Runs the video source generator and pipeline step callables.
+
+        In PipelineMode.SERIAL (the default) everything runs in series on the
+        calling thread. In PipelineMode.THREADED each step (or StepGroup) runs
+        on its own thread with at most queue_size frames waiting in front of
+        it; frames keep their order and the first error raised by the source
+        or by any step is raised again by this method.
+
+        When a PipelineStats is given, the source and every step are timed
+        into it, as if it had been added with add_hook for this run only.
+        '''
+        if mode not in (PipelineMode.SERIAL, PipelineMode.THREADED):
+            raise ValueError("{} is not a valid pipeline mode.".format(mode))
+        hooks = None
+        if self._hooks or stats:
+            hooks = _Hooks(self._hooks + ([stats] if stats else []))
+            hooks.start(self._generator)
+        try:
+            if mode == PipelineMode.SERIAL:
+                self._run_serial(hooks)
+            else:
+                _ThreadedRun(self._generator, self._steps,
+                             queue_size, hooks).run()
+        finally:
+            if hooks:
+                hooks.finish()
+        return self
+
+    def _run_serial(self, hooks=None):
+        generator = self._assemble(hooks)
+        while True:
+            try:
+                frame = next(generator)
+            except StopIteration:
+                return
+            if hooks:
+                hooks.frame_done(frame)
+            _release_frame(frame)
+
+
+# Whether the frames of the step running on the current thread go on to
+# steps running on other threads (see _run_handed_off).
+_handoff = threading.local()
+
+
+def _run_handed_off(target, *args):
+    _handoff.active = True
+    try:
+        return target(*args)
+    finally:
+        _handoff.active = False
+
+
+def _tracked_objects_for_frame(tracked_objects):
+    # Frames handed on to steps that run alongside the tracker get snapshots
+    # of its objects, which it keeps updating in place. Others get its list.
+    if getattr(_handoff, 'active', False):
+        return [tracked.snapshot() for tracked in tracked_objects]
+    return tracked_objects
+
+
+def _release_frame(frame):
+    # Frames that made it through every step are done with, so their pixel
+    # buffers can be reused by the source.
+    release = getattr(frame, 'release', None)
+    if release:
+        release()
+
+
+_END_OF_STREAM = object()
+
+_THREADED_POLL_INTERVAL_IN_SECONDS = 0.1
+
+# How long MultiStreamRunner workers wait for a frame when no stream has one.
+_MULTI_STREAM_IDLE_WAIT_IN_SECONDS = 0.005
+
+
+class _StageFailure(object):
+    '''
+    Carries an error raised by a source or step down to the calling thread.
+    '''
+
+    def __init__(self, error):
+        self.error = error
+
+
+class _ThreadedRun(object):
+    '''
+    Runs a pipeline source and its steps on one thread each. Consecutive
+    workers are connected by bounded queues which provide backpressure, and
+    since every worker handles its input in FIFO order frames stay in order.
+
+    Whatever a worker raises, KeyboardInterrupt and SystemExit included, is
+    handed down the queues and raised again by run, which would otherwise
+    wait forever for the end of the stream.
+    '''
+
+    def __init__(self, generator, steps, queue_size, hooks=None):
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1.")
+        self._generator = generator
+        self._steps = list(steps)
+        self._hooks = hooks
+        self._stopped = threading.Event()
+        self._queues = [
+            queue.Queue(maxsize=queue_size) for _ in range(len(self._steps) + 1)
+        ]
+        self._threads = []
+
+    def run(self):
+        self._start(
+            _SOURCE_STAGE, self._queues[0], self._read_source, self._queues[0])
+        for (index, step) in enumerate(self._steps):
+            stage = _step_name(index + 1, step)
+            self._start(
+                stage,
+                self._queues[index + 1],
+                self._run_step,
+                step,
+                self._queues[index],
+                self._queues[index + 1],
+                stage
+            )
+
+        try:
+            while True:
+                item = self._get(self._queues[-1])
+                if item is _END_OF_STREAM:
+                    return
+                if isinstance(item, _StageFailure):
+                    raise item.error
+                if self._hooks:
+                    self._hooks.frame_done(item)
+                _release_frame(item)
+        finally:
+            self._stopped.set()
+            for thread in self._threads:
+                thread.join()
+
+    def _start(self, stage, output_queue, target, *args):
+        thread = threading.Thread(
+            target=_run_handed_off,
+            args=(self._work, output_queue, target) + args,
+            name="eighttrack " + stage
+        )
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _work(self, output_queue, target, *args):
+        # Workers hand on the errors of their source or step themselves, any
+        # other error (KeyboardInterrupt, SystemExit...) is handed on here.
+        try:
+            target(*args)
+        except BaseException as error:
+            self._put(output_queue, _StageFailure(error))
+
+    def _put(self, output_queue, item):
+        while not self._stopped.is_set():
+            try:
+                output_queue.put(
+                    item, timeout=_THREADED_POLL_INTERVAL_IN_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, input_queue):
+        while not self._stopped.is_set():
+            try:
+                return input_queue.get(
+                    timeout=_THREADED_POLL_INTERVAL_IN_SECONDS)
+            except queue.Empty:
+                continue
+        return _END_OF_STREAM
+
+    def _read_source(self, output_queue):
+        frames = self._generator
+        if self._hooks:
+            frames = _hooked_source(frames, self._hooks)
+        try:
+            for frame in frames:
+                if not self._put(output_queue, frame):
+                    return
+        except Exception as error:
+            self._put(output_queue, _StageFailure(error))
+            return
+        self._put(output_queue, _END_OF_STREAM)
+
+    def _run_step(self, step, input_queue, output_queue, stage):
+        if hasattr(step, 'imap'):
+            self._run_stream_step(step, input_queue, output_queue, stage)
+            return
+
+        while True:
+            item = self._get(input_queue)
+            if item is _END_OF_STREAM or isinstance(item, _StageFailure):
+                self._put(output_queue, item)
+                return
+            try:
+                if self._hooks:
+                    self._hooks.queue_depth(stage, input_queue.qsize())
+                    self._hooks.before(stage, item)
+                    started = _now()
+                    item = step(item)
+                    self._hooks.after(stage, item, started, _now() - started)
+                else:
+                    item = step(item)
+            except Exception as error:
+                self._put(output_queue, _StageFailure(error))
+                return
+            if not self._put(output_queue, item):
+                return
+
+    def _run_stream_step(self, step, input_queue, output_queue, stage):
+        # The last item read from the input queue is either the end of the
+        # stream or an upstream failure, which is forwarded once the step has
+        # flushed the frames it was still holding on to.
+        last = [_END_OF_STREAM]
+
+        def frames():
+            while True:
+                item = self._get(input_queue)
+                if item is _END_OF_STREAM or isinstance(item, _StageFailure):
+                    last[0] = item
+                    return
+                if self._hooks:
+                    self._hooks.queue_depth(stage, input_queue.qsize())
+                yield item
+
+        if self._hooks:
+            output = _hooked_imap(step, frames(), stage, self._hooks)
+        else:
+            output = step.imap(frames())
+        try:
+            for item in output:
+                if not self._put(output_queue, item):
+                    return
+        except Exception as error:
+            self._put(output_queue, _StageFailure(error))
+            return
+        self._put(output_queue, last[0])
+
+
+class MultiStreamRunner(object):
+    '''
+    A MultiStreamRunner runs the pipelines of many video sources (cameras,
+    files...) on one pool of workers threads, rather than on a thread or a
+    process each.
+
+    Every stream is a Pipeline of its own, with its own steps and hooks: a
+    tracker in particular only follows the objects of one stream. Detectors
+    that load a model should still be created per stream, since detectors
+    may keep per-stream state (see Detector and CascadeDetector); the model
+    itself is what gets shared (CascadeDetector instances loading the same
+    HAAR file share a pool of classifiers, and a single ParallelDetector or
+    BatchingDetector can serve every stream).
+
+    Streams take turns: a worker takes the stream that waited the longest
+    among those with a frame ready (see VideoCaptureGenerator.ready), runs
+    one frame of it through its steps and puts it back in line. The frames
+    of a stream are thus handled one at a time and in order, and a busy
+    stream cannot starve the others.
+    '''
+
+    def __init__(self, workers=None):
+        self.workers = workers if workers else multiprocessing.cpu_count()
+        self.errors = collections.OrderedDict()
+        self._streams = []
+        self._pending = collections.deque()
+        self._active = 0
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+
+    def add(self, pipeline, name=None):
+        '''
+        Adds a Pipeline to the streams of the receiver, under the given name
+        (its position among the streams by default).
+        '''
+        self._streams.append(_Stream(
+            name if name is not None else len(self._streams), pipeline))
+        return self
+
+    @property
+    def streams(self):
+        return [stream.name for stream in self._streams]
+
+    def frames(self, name):
+        '''
+        Returns the number of frames of the stream with the given name that
+        went through all of its steps.
+        '''
+        for stream in self._streams:
+            if stream.name == name:
+                return stream.frames
+        raise KeyError(name)
+
+    def run(self):
+        '''
+        Runs every stream until its source runs out, or until stop is called.
+
+        An error raised by the source or a step of a stream ends that stream
+        only; it is logged and kept in errors, under the name of the stream,
+        and the first one is raised again once the other streams are done.
+        '''
+        self._stopped.clear()
+        self.errors.clear()
+        for stream in self._streams:
+            stream.start()
+        with self._condition:
+            self._pending.extend(self._streams)
+            self._active = len(self._streams)
+
+        threads = list()
+        for index in range(min(self.workers, len(self._streams))):
+            thread = threading.Thread(
+                target=self._work, name="eighttrack worker {}".format(index))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(_THREADED_POLL_INTERVAL_IN_SECONDS)
+        finally:
+            self.stop()
+            for thread in threads:
+                thread.join()
+            with self._condition:
+                self._pending.clear()
+            for stream in self._streams:
+                stream.finish()
+
+        for error in self.errors.values():
+            raise error
+        return self
+
+    def stop(self):
+        '''
+        Makes run return once the frames being handled are done with.
+        '''
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            stream = self._next_stream()
+            if stream is None:
+                return
+            running = self._step(stream)
+            with self._condition:
+                if running:
+                    self._pending.append(stream)
+                else:
+                    self._active = self._active - 1
+                self._condition.notify_all()
+
+    def _next_stream(self):
+        with self._condition:
+            while self._active and not self._stopped.is_set():
+                for _ in range(len(self._pending)):
+                    stream = self._pending.popleft()
+                    if stream.ready():
+                        return stream
+                    self._pending.append(stream)
+                self._condition.wait(_MULTI_STREAM_IDLE_WAIT_IN_SECONDS)
+        return None
+
+    def _step(self, stream):
+        try:
+            stream.next()
+            return True
+        except StopIteration:
+            pass
+        except Exception as error:
+            _logger.exception("Stream %s failed.", stream.name)
+            self.errors[stream.name] = error
+        stream.finish()
+        return False
+
+
+class _Stream(object):
+    '''
+    A pipeline run one frame at a time by a MultiStreamRunner.
+    '''
+
+    def __init__(self, name, pipeline):
+        self.name = name
+        self.pipeline = pipeline
+        self.frames = 0
+        self._ready = getattr(pipeline._generator, 'ready', None)
+        self._hooks = None
+        self._frames = None
+
+    def start(self):
+        self.frames = 0
+        self._hooks = None
+        if self.pipeline._hooks:
+            self._hooks = _Hooks(self.pipeline._hooks)
+            self._hooks.start(self.pipeline._generator)
+        self._frames = self.pipeline._assemble(self._hooks)
+
+    def ready(self):
+        return self._ready is None or self._ready()
+
+    def next(self):
+        frame = next(self._frames)
+        if self._hooks:
+            self._hooks.frame_done(frame)
+        _release_frame(frame)
+        self.frames = self.frames + 1
+
+    def finish(self):
+        # Streams finish once, whether they ran out, failed or were stopped.
+        if self._frames is None:
+            return
+        self._frames = None
+        if self._hooks:
+            self._hooks.finish()
+
+
+class Detector(object):
+    '''
+    A Detector is a pipeline step that finds objects in the pixels of each
+    frame. Subclasses implement detect(pixels), returning an iterable of
+    DetectedObject instances, which are then merged into the frame.
+
+    Frames marked as static (see MotionGate) are not run through detect but
+    get the objects detected in the previous frame.
+
+    detect_batch(images) searches several images at once, by default one after
+    the other; detectors with a cheaper way to handle a batch override it (see
+    BatchingDetector).
+    '''
+    _last_detected_objects = None
+
+    def detect(self, pixels):
+        raise NotImplementedError()
+
+    def detect_batch(self, images):
+        '''
+        Returns a list of the objects detected in each of the given images.
+        '''
+        return [list(self.detect(pixels)) for pixels in images]
+
+    def __call__(self, frame):
+        if frame.is_static and self._last_detected_objects is not None:
+            objects = self._last_detected_objects
+        else:
+            objects = list(self.detect(frame.pixels))
+            self._last_detected_objects = objects
+        frame.detected_objects.update(objects)
+        return frame
+
+
+class ParallelDetector(Detector):
+    '''
+    A ParallelDetector runs a wrapped detector on a pool of worker processes so
+    that detection is not bound by the GIL. The wrapped detector is pickled
+    once per worker, and frames are copied into shared memory instead of being
+    pickled on every call.
+
+    As a pipeline step it keeps up to max_pending frames in flight and hands
+    them downstream in their original order. The receiver may serve several
+    pipelines at once (see MultiStreamRunner): frames in flight beyond the
+    max_pending shared memory buffers it keeps get buffers of their own.
+    '''
+
+    def __init__(self, detector, workers=None, max_pending=None, mp_context=None):
+        self.detector = detector
+        self.workers = workers if workers else multiprocessing.cpu_count()
+        self.max_pending = max_pending if max_pending else 2 * self.workers
+        self.mp_context = mp_context
+        self._executor = None
+        self._lock = threading.Lock()
+        self._buffers = queue.Queue(maxsize=self.max_pending)
+        for _ in range(self.max_pending):
+            self._buffers.put(_SharedFrameBuffer())
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        '''
+        Shuts down the worker processes and frees the shared memory buffers.
+        '''
+        with self._lock:
+            if self._executor:
+                self._executor.shutdown()
+                self._executor = None
+        while True:
+            try:
+                self._buffers.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def detect(self, pixels):
+        return self._finish(self._submit(pixels))
+
+    def detect_batch(self, images):
+        results = list()
+        pending = collections.deque()
+        for pixels in images:
+            # Shared memory buffers are only handed back once results are
+            # collected, so the oldest ones are collected rather than
+            # allocating more buffers.
+            while pending and self._buffers.empty():
+                results.append(self._finish(pending.popleft()))
+            pending.append(self._submit(pixels))
+        while pending:
+            results.append(self._finish(pending.popleft()))
+        return results
+
+    def imap(self, frames):
+        pending = collections.deque()
+        # Static frames get the objects of the frame before them in this
+        # stream, whichever other streams share the receiver.
+        last = None
+        try:
+            for frame in frames:
+                if len(pending) >= self.max_pending:
+                    (merged, last) = self._merge(pending.popleft(), last)
+                    yield merged
+                submitted = None
+                if not frame.is_static:
+                    submitted = self._submit(frame.pixels)
+                pending.append((frame, submitted))
+            while pending:
+                (merged, last) = self._merge(pending.popleft(), last)
+                yield merged
+        finally:
+            # Frames still in flight when the consumer stops early must hand
+            # their shared memory buffers back.
+            for (_, submitted) in pending:
+                try:
+                    if submitted:
+                        self._finish(submitted)
+                except Exception:
+                    pass
+
+    def _merge(self, item, last):
+        # Frames are merged in order, so a static frame gets the objects of
+        # the frame merged right before it.
+        (frame, submitted) = item
+        if submitted:
+            objects = self._finish(submitted)
+        elif last is not None:
+            objects = last
+        else:
+            objects = self.detect(frame.pixels)
+        frame.detected_objects.update(objects)
+        return (frame, objects)
+
+    def _submit(self, pixels):
+        with self._lock:
+            if not self._executor:
+                kwargs = {
+                    'max_workers': self.workers,
+                    'initializer': _parallel_detector_initialize,
+                    'initargs': (self.detector,),
+                }
+                if self.mp_context:
+                    kwargs['mp_context'] = self.mp_context
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    **kwargs)
+                # Workers are forked on the first submit. Doing so here keeps
+                # other callers from creating shared memory at the same time:
+                # a fork while they hold the lock of the resource tracker
+                # leaves the workers waiting for it forever.
+                self._executor.submit(int)
+            executor = self._executor
+
+        # Waiting for a buffer could wait forever, on other callers (or on
+        # results this caller holds), so a new one is made when none is free.
+        try:
+            buffer = self._buffers.get_nowait()
+        except queue.Empty:
+            buffer = _SharedFrameBuffer()
+        try:
+            future = executor.submit(
+                _parallel_detector_detect, *buffer.write(pixels))
+        except Exception:
+            self._recycle(buffer)
+            raise
+        return (buffer, future)
+
+    def _finish(self, submitted):
+        (buffer, future) = submitted
+        try:
+            return future.result()
+        finally:
+            self._recycle(buffer)
+
+    def _recycle(self, buffer):
+        try:
+            self._buffers.put_nowait(buffer)
+        except queue.Full:
+            buffer.close()
+
+
+class _SharedFrameBuffer(object):
+    '''
+    A block of shared memory that frames are copied into before being handed
+    to a ParallelDetector worker. It only grows when a frame does not fit.
+    '''
+
+    def __init__(self):
+        self._memory = None
+
+    def write(self, pixels):
+        '''
+        Returns the arguments _parallel_detector_detect needs to see pixels.
+        '''
+        pixels = numpy.ascontiguousarray(pixels)
+        if shared_memory is None:
+            return (None, pixels.shape, pixels.dtype.str, pixels)
+
+        if self._memory is None or self._memory.size < pixels.nbytes:
+            self.close()
+            self._memory = shared_memory.SharedMemory(
+                create=True, size=max(pixels.nbytes, 1))
+        view = numpy.ndarray(
+            pixels.shape, dtype=pixels.dtype, buffer=self._memory.buf)
+        view[...] = pixels
+        return (self._memory.name, pixels.shape, pixels.dtype.str, None)
+
+    def close(self):
+        if self._memory is not None:
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+
+# State of a ParallelDetector worker process.
+_worker_detector = None
+_worker_memory = collections.OrderedDict()
+_WORKER_MEMORY_CACHE_SIZE = 64
+
+
+def _parallel_detector_initialize(detector):
+    global _worker_detector
+    _worker_detector = detector
+
+
+def _parallel_detector_detect(name, shape, dtype, pixels):
+    if name is None:
+        return list(_worker_detector.detect(pixels))
+
+    memory = _worker_memory.get(name)
+    if memory is None:
+        memory = shared_memory.SharedMemory(name=name)
+        _worker_memory[name] = memory
+        if len(_worker_memory) > _WORKER_MEMORY_CACHE_SIZE:
+            _worker_memory.popitem(last=False)[1].close()
+    pixels = numpy.ndarray(shape, dtype=numpy.dtype(dtype), buffer=memory.buf)
+    try:
+        return list(_worker_detector.detect(pixels))
+    finally:
+        del pixels
+
+
+class BatchingDetector(Detector):
+    '''
+    A BatchingDetector gathers the frames it is asked to search into batches,
+    which it hands to the detect_batch method of the wrapped detector on a
+    pool of workers threads. A batch is sent once it holds batch_size frames,
+    or once its oldest frame waited max_delay_in_seconds, so larger batches
+    and longer delays trade latency for less overhead per frame.
+
+    detect may be called from several threads at once, for instance by the
+    streams of a MultiStreamRunner sharing the receiver, so that frames of
+    different streams end up in the same batch; each call blocks until the
+    batch of its frame is done. As a pipeline step, the receiver keeps up to
+    max_pending frames in flight (by default enough to fill a batch per
+    worker and one more) and hands each downstream, in their original order,
+    as soon as its batch is done.
+
+    With more than one worker, the wrapped detector must allow detect_batch
+    to be called from several threads at once.
+    '''
+    _batcher = None
+
+    def __init__(self, detector, batch_size=DEFAULT_DETECTION_BATCH_SIZE, max_delay_in_seconds=DEFAULT_DETECTION_BATCH_MAX_DELAY_IN_SECONDS, workers=1, max_pending=None):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1.")
+        if workers < 1:
+            raise ValueError("workers must be at least 1.")
+        self.detector = detector
+        self.batch_size = batch_size
+        self.max_delay_in_seconds = max_delay_in_seconds
+        self.workers = workers
+        self.max_pending = max_pending if max_pending else (workers + 1) * batch_size
+        self._batcher = _DetectionBatcher(
+            detector, batch_size, max_delay_in_seconds, workers)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        '''
+        Sends the frames still waiting for a batch and stops the receiver's
+        worker threads once they are done.
+        '''
+        if self._batcher:
+            self._batcher.close()
+
+    def flush(self):
+        '''
+        Sends the frames waiting for a batch to fill up right away.
+        '''
+        self._batcher.flush()
+
+    def detect(self, pixels):
+        return self._batcher.submit(pixels).result()
+
+    def detect_batch(self, images):
+        futures = [self._batcher.submit(pixels) for pixels in images]
+        self._batcher.flush()
+        return [future.result() for future in futures]
+
+    def imap(self, frames):
+        pending = collections.deque()
+        # Static frames get the objects of the frame before them in this
+        # stream, whichever other streams share the receiver.
+        last = None
+        for frame in frames:
+            submitted = None
+            if not frame.is_static:
+                submitted = self._batcher.submit(frame.pixels)
+            pending.append((frame, submitted))
+            # Frames leave as soon as they (and those before them) are done,
+            # and only wait for their batch once max_pending are in flight.
+            while pending and (len(pending) >= self.max_pending or
+                               _merge_ready(pending[0])):
+                (merged, last) = self._merge(pending.popleft(), last)
+                yield merged
+        self._batcher.flush()
+        while pending:
+            (merged, last) = self._merge(pending.popleft(), last)
+            yield merged
+
+    def _merge(self, item, last):
+        (frame, submitted) = item
+        if submitted:
+            objects = submitted.result()
+        elif last is not None:
+            objects = last
+        else:
+            objects = self.detect(frame.pixels)
+        frame.detected_objects.update(objects)
+        return (frame, objects)
+
+
+def _merge_ready(item):
+    (_, submitted) = item
+    return submitted is None or submitted.done()
+
+
+class _DetectionBatcher(object):
+    '''
+    Holds the frames a BatchingDetector is waiting to batch, and sends batches
+    to a pool of worker threads, from the calling thread once they are full
+    or from a thread of its own once they are late.
+
+    The batcher does not reference the BatchingDetector, so that an abandoned
+    detector can still be collected (and close its batcher).
+    '''
+
+    def __init__(self, detector, batch_size, max_delay_in_seconds, workers):
+        self.detector = detector
+        self.batch_size = batch_size
+        self.max_delay_in_seconds = max_delay_in_seconds
+        self.workers = workers
+        self._batch = []
+        self._deadline = None
+        self._condition = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._stopping = False
+
+    def submit(self, pixels):
+        future = concurrent.futures.Future()
+        with self._condition:
+            self._batch.append((pixels, future))
+            if len(self._batch) >= self.batch_size:
+                self._send()
+            elif len(self._batch) == 1:
+                self._deadline = _now() + self.max_delay_in_seconds
+                if not self._thread:
+                    self._thread = threading.Thread(target=self._send_late)
+                    self._thread.daemon = True
+                    self._thread.start()
+                self._condition.notify_all()
+        return future
+
+    def flush(self):
+        with self._condition:
+            self._send()
+
+    def close(self):
+        with self._condition:
+            self._send()
+            self._stopping = True
+            self._condition.notify_all()
+            thread = self._thread
+            executor = self._executor
+            self._thread = None
+            self._executor = None
+        if thread:
+            thread.join()
+        if executor:
+            executor.shutdown()
+        with self._condition:
+            self._stopping = False
+
+    def _send(self):
+        # Called with the condition held.
+        if not self._batch:
+            return
+        (batch, self._batch) = (self._batch, [])
+        self._deadline = None
+        if not self._executor:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers)
+        self._executor.submit(self._detect, batch)
+
+    def _send_late(self):
+        with self._condition:
+            while not self._stopping:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - _now()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                else:
+                    self._send()
+
+    def _detect(self, batch):
+        try:
+            results = self.detector.detect_batch(
+                [pixels for (pixels, _) in batch])
+        except Exception as error:
+            for (_, future) in batch:
+                future.set_exception(error)
+            return
+        for ((_, future), objects) in zip(batch, results):
+            future.set_result(list(objects))
+
+
+class TiledDetector(Detector):
+    '''
+    A TiledDetector runs a wrapped detector on overlapping tiles of each
+    frame, so that small objects in high resolution frames are searched at
+    full resolution, optionally on a pool of worker threads. Boxes are mapped
+    back to frame coordinates and objects found twice in the overlap of two
+    tiles are merged with non-maximum suppression.
+
+    Objects are only found when they fit in a tile, and they are only found
+    whole across a seam when they are smaller than the overlap.
+    '''
+    _executor = None
+
+    def __init__(self, detector, tile_size=(640, 640), overlap=64, workers=None, nms_threshold=0.3):
+        (tile_width, tile_height) = tile_size
+        if overlap >= min(tile_width, tile_height):
+            raise ValueError("overlap must be smaller than the tile size.")
+        self.detector = detector
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.workers = workers
+        self.nms_threshold = nms_threshold
+        self._executor = None
+        if workers and workers > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        '''
+        Shuts down the receiver's worker threads, if any.
+        '''
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
+
+    def tiles(self, width, height):
+        '''
+        Returns the (x1, y1, x2, y2) tiles covering a frame of the given size.
+        '''
+        (tile_width, tile_height) = self.tile_size
+        return [
+            (x, y, min(width, x + tile_width), min(height, y + tile_height))
+            for y in _tile_starts(height, tile_height, self.overlap)
+            for x in _tile_starts(width, tile_width, self.overlap)
+        ]
+
+    def detect(self, pixels):
+        tiles = self.tiles(pixels.shape[1], pixels.shape[0])
+
+        def crop(tile):
+            (x1, y1, x2, y2) = tile
+            return pixels[y1:y2, x1:x2]
+
+        def offset(tile, found):
+            (x1, y1, _, _) = tile
+            return [
+                DetectedObject(
+                    detected.label,
+                    detected.score,
+                    BoundingBox(
+                        detected.bounding_box.x + x1,
+                        detected.bounding_box.y + y1,
+                        detected.bounding_box.width,
+                        detected.bounding_box.height,
+                        round_values=False
+                    ),
+                    detected._object_id
+                )
+                for detected in found
+            ]
+
+        if self._executor and len(tiles) > 1:
+            per_tile = self._executor.map(
+                lambda tile: offset(tile, self.detector.detect(crop(tile))),
+                tiles
+            )
+        else:
+            per_tile = map(offset, tiles, self.detector.detect_batch(
+                [crop(tile) for tile in tiles]))
+        objects = [detected for found in per_tile for detected in found]
+        if len(tiles) < 2 or len(objects) < 2:
+            return objects
+
+        kept = non_max_suppression(
+            BoxArray.from_boxes([detected.bounding_box for detected in objects]),
+            [detected.score for detected in objects],
+            self.nms_threshold
+        )
+        return [objects[index] for index in kept]
+
+
+def _tile_starts(length, tile_length, overlap):
+    # Tiles are spread evenly, so they overlap by at least overlap pixels.
+    if length <= tile_length:
+        return [0]
+    count = int(math.ceil(
+        float(length - tile_length) / (tile_length - overlap))) + 1
+    return [
+        int(round(index * float(length - tile_length) / (count - 1)))
+        for index in range(count)
+    ]
+
+
+class DetectionScheduler(object):
+    '''
+    A DetectionScheduler is a pipeline step that runs a wrapped detector step
+    only on some frames and lets an object tracker carry objects in between.
+    Frames skipping detection flow through untouched, with detection_skipped
+    set.
+
+    Detection runs every interval frames and, when a tracker is given, also on
+    any frame following one where the tracker reported MISSING objects
+    (detect_on_missing) or where the fraction of its objects still TRACKING
+    fell below min_confidence.
+
+    When latency_budget_in_seconds is given, the interval adapts (between 1
+    and max_interval) so that the detector's run time, spread over the frames
+    of an interval, stays within the budget.
+    '''
+
+    def __init__(self, detector, interval=DEFAULT_DETECTION_INTERVAL, tracker=None, detect_on_missing=True, min_confidence=None, latency_budget_in_seconds=None, max_interval=DEFAULT_MAX_DETECTION_INTERVAL):
+        if interval < 1:
+            raise ValueError("interval must be at least 1.")
+        self.detector = detector
+        self.interval = interval
+        self.tracker = tracker
+        self.detect_on_missing = detect_on_missing
+        self.min_confidence = min_confidence
+        self.latency_budget_in_seconds = latency_budget_in_seconds
+        self.max_interval = max_interval
+        self.average_detection_seconds = None
+        self._frames_since_detection = None
+
+    def __call__(self, frame):
+        if not self.should_detect():
+            self._frames_since_detection = self._frames_since_detection + 1
+            frame.detection_skipped = True
+            return frame
+
+        started = _now()
+        frame = self.detector(frame)
+        self._record_detection(_now() - started)
+        self._frames_since_detection = 0
+        return frame
+
+    def should_detect(self):
+        '''
+        Returns whether detection should run on the next frame.
+        '''
+        if self._frames_since_detection is None:
+            return True
+        if self._frames_since_detection + 1 >= self.interval:
+            return True
+        if self.tracker is None:
+            return False
+
+        states = [
+            tracked_object.state
+            for tracked_object in self.tracker.tracked_objects
+            if tracked_object.state != TrackedObjectState.LOST
+        ]
+        if self.detect_on_missing and TrackedObjectState.MISSING in states:
+            return True
+        if self.min_confidence is not None and states:
+            tracking = states.count(TrackedObjectState.TRACKING)
+            if tracking / float(len(states)) < self.min_confidence:
+                return True
+        return False
+
+    def _record_detection(self, seconds):
+        if self.average_detection_seconds is None:
+            self.average_detection_seconds = seconds
+        else:
+            self.average_detection_seconds = \
+                0.8 * self.average_detection_seconds + 0.2 * seconds
+
+        if self.latency_budget_in_seconds:
+            self.interval = int(min(
+                self.max_interval,
+                max(1, math.ceil(
+                    self.average_detection_seconds / self.latency_budget_in_seconds))
+            ))
+
+
+class DropPolicy(object):
+    '''
+    DropPolicy represents what a VideoCaptureGenerator reading ahead does when
+    its queue of decoded frames is full.
+
+    BLOCK:       decoding waits for the pipeline, no frame is dropped.
+    DROP_OLDEST: the oldest queued frame is dropped, so the pipeline always
+                 gets the newest frames (the default for live sources).
+    DROP_NEWEST: the frame just decoded is dropped.
+    '''
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+
+
+class VideoCaptureGenerator(object):
+    '''
+    A VideoCaptureGenerator is the simplest pipeline source. It is meant as an example
+    generator around cv2.VideoCapture#read().
+
+    When prefetch is greater than 0, frames are decoded ahead on a background
+    thread, up to prefetch frames, so that decoding overlaps with the rest of
+    the pipeline. Frames are then decoded into a ring of up to buffers
+    reusable pixel arrays, which come back to the ring when frames are
+    released (see VideoFrame.release, which Pipeline calls once a frame went
+    through every step). A new array is allocated whenever the ring is empty.
+
+    For live sources (webcams, RTSP streams...) live=True keeps reading on a
+    background thread even when the pipeline falls behind, dropping frames
+    according to drop_policy (DROP_OLDEST by default, which with the default
+    prefetch of 1 always hands the pipeline the newest frame). The number of
+    frames dropped so far is available as dropped_frames.
+
+    With a stride greater than 1 only every stride-th frame is decoded, the
+    others are grabbed without being decoded and counted in skipped_frames.
+
+    For files, start and end (exclusive) restrict reading to part of the
+    video. Both are either frame indexes or datetime.timedelta offsets from
+    the beginning of the video, which are converted to frame indexes using
+    the frame rate of the video. Reading begins by seeking to start.
+    '''
+
+    def __init__(self, url, prefetch=0, buffers=None, live=False, drop_policy=None, stride=1, start=None, end=None):
+        self.capture = cv2.VideoCapture(url)
+        self._reader = None
+        self._cursor = _CaptureCursor(self.capture, stride, start, end)
+        self.stride = stride
+        if live:
+            prefetch = max(prefetch, 1)
+            if drop_policy is None:
+                drop_policy = DropPolicy.DROP_OLDEST
+        if prefetch > 0:
+            self._reader = _CaptureReader(
+                self._cursor,
+                prefetch,
+                buffers if buffers is not None else prefetch + 2,
+                drop_policy if drop_policy is not None else DropPolicy.BLOCK
+            )
+
+    def __del__(self):
+        self.close()
+
+    @property
+    def dropped_frames(self):
+        return self._reader.dropped_frames if self._reader else 0
+
+    def ready(self):
+        '''
+        Returns whether next can return without waiting for the background
+        reader to decode a frame, which it always can without one.
+        '''
+        return self._reader.ready() if self._reader else True
+
+    @property
+    def skipped_frames(self):
+        return self._cursor.skipped_frames
+
+    def close(self):
+        '''
+        Stops the background reader, if any, and releases the capture.
+        '''
+        if self._reader:
+            self._reader.close()
+            self._reader = None
+        self.capture.release()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._reader:
+            return self._reader.next()
+
+        frame = self._cursor.read()
+        if frame is None:
+            raise StopIteration()
+        return frame
+
+    next = __next__  # for Python 2
+
+
+class _CaptureCursor(object):
+    '''
+    Reads the frames of a cv2.VideoCapture between a start and an end
+    position, decoding only every stride-th frame and merely grabbing the
+    others, and keeps track of the index of each frame it reads.
+    '''
+
+    def __init__(self, capture, stride=1, start=None, end=None):
+        if stride < 1:
+            raise ValueError("stride must be at least 1.")
+        self.capture = capture
+        self.stride = stride
+        self.position = 0
+        self.end = _frame_position(capture, end)
+        self.skipped_frames = 0
+        self._frames_read = 0
+
+        start = _frame_position(capture, start)
+        if start:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+            self.position = start
+
+    def read(self, image=None):
+        '''
+        Returns the next VideoFrame, decoded into image when it is given, or
+        None once the end is reached.
+        '''
+        if not self.capture.isOpened():
+            return None
+
+        if self._frames_read:
+            for _ in range(self.stride - 1):
+                if self._at_end() or not self.capture.grab():
+                    return None
+                self.position = self.position + 1
+                self.skipped_frames = self.skipped_frames + 1
+
+        if self._at_end():
+            return None
+        if image is None:
+            (ok, pixels) = self.capture.read()
+        else:
+            (ok, pixels) = self.capture.read(image)
+        if not ok:
+            return None
+
+        frame = VideoFrame(pixels)
+        frame.frame_index = self.position
+        frame.media_timestamp = self._media_timestamp()
+        self.position = self.position + 1
+        self._frames_read = self._frames_read + 1
+        return frame
+
+    def _at_end(self):
+        return self.end is not None and self.position >= self.end
+
+    def _media_timestamp(self):
+        # After a read, CAP_PROP_POS_MSEC is the time of the frame just read.
+        milliseconds = self.capture.get(cv2.CAP_PROP_POS_MSEC)
+        if milliseconds > 0 or self.position == 0:
+            return milliseconds / 1000.0
+        fps = self.capture.get(cv2.CAP_PROP_FPS)
+        return self.position / fps if fps > 0 else None
+
+
+def _frame_position(capture, position):
+    '''
+    Converts a frame index or a datetime.timedelta offset into the video of
+    capture into a frame index.
+    '''
+    if position is None:
+        return None
+    if isinstance(position, datetime.timedelta):
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        if fps <= 0:
+            raise ValueError(
+                "The frame rate of the video is unknown, use frame indexes.")
+        position = int(round(position.total_seconds() * fps))
+    if position < 0:
+        raise ValueError("Positions in a video must not be negative.")
+    return int(position)
+
+
+class _CaptureReader(object):
+    '''
+    Decodes frames from a cv2.VideoCapture on a background thread into a
+    bounded queue, reusing the pixel arrays of released frames and dropping
+    frames according to a DropPolicy when the queue is full.
+
+    The thread does not reference the VideoCaptureGenerator, so that an
+    abandoned generator can still be collected (and close its reader).
+    '''
+
+    def __init__(self, cursor, size, buffers, drop_policy):
+        if drop_policy not in (DropPolicy.BLOCK, DropPolicy.DROP_OLDEST, DropPolicy.DROP_NEWEST):
+            raise ValueError("{} is not a valid drop policy.".format(drop_policy))
+        self.drop_policy = drop_policy
+        self.dropped_frames = 0
+        self._cursor = cursor
+        self._frames = queue.Queue(maxsize=size)
+        self._buffers = queue.Queue(maxsize=max(buffers, 1))
+        self._stopped = threading.Event()
+        self._finished = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def next(self):
+        if self._finished:
+            raise StopIteration()
+        item = self._frames.get()
+        if item is _END_OF_STREAM:
+            self._finished = True
+            raise StopIteration()
+        if isinstance(item, _StageFailure):
+            self._finished = True
+            raise item.error
+        return item
+
+    def ready(self):
+        return self._finished or not self._frames.empty()
+
+    def recycle(self, pixels):
+        try:
+            self._buffers.put_nowait(pixels)
+        except queue.Full:
+            pass
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stopped.is_set():
+                try:
+                    frame = self._cursor.read(self._buffers.get_nowait())
+                except queue.Empty:
+                    frame = self._cursor.read()
+                if frame is None:
+                    break
+                frame._release = functools.partial(self.recycle, frame.pixels)
+                self._enqueue(frame)
+        except Exception as error:
+            self._put(_StageFailure(error))
+            return
+        self._put(_END_OF_STREAM)
+
+    def _enqueue(self, frame):
+        if self.drop_policy == DropPolicy.BLOCK:
+            self._put(frame)
+            return
+
+        while True:
+            try:
+                self._frames.put_nowait(frame)
+                return
+            except queue.Full:
+                pass
+            self.dropped_frames = self.dropped_frames + 1
+            if self.drop_policy == DropPolicy.DROP_NEWEST:
+                frame.release()
+                return
+            try:
+                self._frames.get_nowait().release()
+            except queue.Empty:
+                pass
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._frames.put(
+                    item, timeout=_THREADED_POLL_INTERVAL_IN_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+
+def scan(url, process, segments=None, workers=None, stride=1, start=None, end=None, mp_context=None):
+    '''
+    Scans a video file in parallel: the frames between start and end are
+    split into segments of consecutive frames, each segment is read by a
+    VideoCaptureGenerator in a worker process and handed to process, and the
+    results process returns for each segment are yielded in the order of the
+    segments, as if the whole range had been processed in one go.
+
+    process is called with an iterable of VideoFrames (whose frame_index
+    tells where they come from) and returns an iterable of results. Both
+    process and its results have to be picklable, and since every segment is
+    processed on its own, state (such as tracked objects) does not carry over
+    from one segment to the next.
+
+    stride, start and end are the same as for a VideoCaptureGenerator.
+    Segments start on multiples of stride, so that the frames read are the
+    same as when reading the whole range with a single generator.
+    '''
+    if stride < 1:
+        raise ValueError("stride must be at least 1.")
+    workers = workers if workers else multiprocessing.cpu_count()
+    capture = cv2.VideoCapture(url)
+    try:
+        if not capture.isOpened():
+            raise IOError("Could not open {}.".format(url))
+        first = _frame_position(capture, start) or 0
+        last = _frame_position(capture, end)
+        frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        capture.release()
+
+    # The frame count reported by containers is only an estimate, so the last
+    # segment reads until the actual end of the file.
+    ranges = _scan_ranges(
+        first,
+        last if last is not None else max(frame_count, first),
+        segments if segments else workers,
+        stride
+    )
+    if last is None:
+        ranges[-1] = (ranges[-1][0], None)
+
+    # The arguments are checked above, when scan is called, rather than when
+    # the first result is asked for.
+    return _scan(url, process, ranges, workers, stride, mp_context)
+
+
+def _scan(url, process, ranges, workers, stride, mp_context):
+    kwargs = {'max_workers': workers}
+    if mp_context:
+        kwargs['mp_context'] = mp_context
+    with concurrent.futures.ProcessPoolExecutor(**kwargs) as executor:
+        futures = [
+            executor.submit(_scan_segment, url, process,
+                            stride, segment_start, segment_end)
+            for (segment_start, segment_end) in ranges
+        ]
+        try:
+            for future in futures:
+                for result in future.result():
+                    yield result
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def _scan_ranges(start, end, segments, stride):
+    '''
+    Splits [start, end) into up to segments ranges of about the same number
+    of frames, each starting on a frame that reading the whole range with the
+    given stride would decode.
+    '''
+    strides = max(int(math.ceil(float(end - start) / stride)), 1)
+    segments = max(min(segments, strides), 1)
+    bounds = [
+        start + stride * int(round(float(strides) * i / segments))
+        for i in range(segments + 1)
+    ]
+    bounds[-1] = max(end, start)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _scan_segment(url, process, stride, start, end):
+    frames = VideoCaptureGenerator(url, stride=stride, start=start, end=end)
+    try:
+        return list(process(frames))
+    finally:
+        frames.close()
+
+
+class MotionGate(object):
+    '''
+    A MotionGate is a pipeline step, meant to come right after the source,
+    that marks frames which barely differ from the last frame let through as
+    static, so that later steps can skip them and reuse their previous
+    results (see VideoFrame.is_static).
+
+    Frames are compared on a grayscale copy downscaled to width pixels, using
+    the mean absolute difference. At most max_consecutive_skips frames in a
+    row are marked static.
+    '''
+
+    def __init__(self, threshold=DEFAULT_MOTION_THRESHOLD, max_consecutive_skips=DEFAULT_MAX_CONSECUTIVE_STATIC_FRAMES, width=64):
+        self.threshold = threshold
+        self.max_consecutive_skips = max_consecutive_skips
+        self.width = width
+        self.consecutive_skips = 0
+        self._reference = None
+
+    def __call__(self, frame):
+        thumbnail = self._thumbnail(frame.pixels)
+        if self._reference is None or self._reference.shape != thumbnail.shape:
+            self._let_through(frame, thumbnail, None)
+            return frame
+
+        frame.motion_score = float(cv2.absdiff(thumbnail, self._reference).mean())
+        if frame.motion_score < self.threshold and \
+                self.consecutive_skips < self.max_consecutive_skips:
+            frame.is_static = True
+            self.consecutive_skips = self.consecutive_skips + 1
+            return frame
+
+        self._let_through(frame, thumbnail, frame.motion_score)
+        return frame
+
+    def _let_through(self, frame, thumbnail, motion_score):
+        # Frames are compared to the last frame let through rather than to the
+        # previous one, so that slow changes add up.
+        frame.is_static = False
+        frame.motion_score = motion_score
+        self.consecutive_skips = 0
+        self._reference = thumbnail
+
+    def _thumbnail(self, pixels):
+        if pixels.ndim == 3:
+            pixels = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+        (height, width) = pixels.shape[:2]
+        scale = min(1.0, float(self.width) / width)
+        return cv2.resize(
+            pixels,
+            (max(1, int(width * scale)), max(1, int(height * scale))),
+            interpolation=cv2.INTER_AREA
+        )
 
 
 class VideoDisplaySink(object):
@@ -0,0 +1,233 @@
+'''
+An asyncio flavour of eighttrack.Pipeline, for services that already run an
+event loop. It needs Python 3.7 or later, and is thus only imported on demand:
+
+    from eighttrack.aio import AsyncPipeline
+'''
+import asyncio
+import inspect
+
+from .. import DEFAULT_PIPELINE_QUEUE_SIZE, _END_OF_STREAM, _SOURCE_STAGE, _Hooks, _StageFailure, _hooked_source, _hooked_step, _now, _release_frame, _run_handed_off, _step_name
+
+
+class AsyncPipeline(object):
+    '''
+    An AsyncPipeline is the asyncio counterpart of a Pipeline running in
+    threaded mode: its source and each of its steps run as a task of the
+    event loop it runs on, connected by bounded queues, so that consecutive
+    steps overlap and many pipelines can share a single event loop.
+
+    The source may be an async iterator, or a plain iterator of VideoFrame
+    instances (such as a VideoCaptureGenerator) which is then read on an
+    executor. Steps may be coroutine functions (or objects whose __call__ is
+    one), which are awaited on the event loop, or plain callables, which are
+    run on an executor so that they do not block the loop. The executor is
+    the default executor of the loop unless one is given.
+
+    PipelineHook instances added with add_hook are told about every run, as
+    for a Pipeline. Hooks of plain steps are called on the executor.
+    '''
+
+    def __init__(self, source=None, executor=None):
+        '''
+        Constructor that takes an optional source and an optional
+        concurrent.futures.Executor for the plain source and steps.
+        '''
+        self.executor = executor
+        self._source = source
+        self._steps = []
+        self._hooks = []
+        self._stopping = False
+        self._read = None
+
+    def add(self, step):
+        '''
+        Adds a given callable or coroutine function to the pipeline
+        represented by the receiver.
+        '''
+        if self._source is None:
+            self._source = step
+            return self
+        if not callable(step):
+            raise ValueError(
+                "{} is not callable, steps with only an imap method need a "
+                "Pipeline.".format(step))
+        self._steps.append(step)
+        return self
+
+    def add_hook(self, hook):
+        '''
+        Adds a PipelineHook to every later run of the receiver.
+        '''
+        self._hooks.append(hook)
+        return self
+
+    async def run(self, queue_size=DEFAULT_PIPELINE_QUEUE_SIZE):
+        '''
+        Runs the source and steps of the receiver until the source runs out
+        or stop is called, keeping at most queue_size frames waiting in front
+        of each step. Frames keep their order, and the first error raised by
+        the source or by any step is raised again.
+
+        Cancelling the task running this coroutine cancels the source and
+        every step, and closes the source when it is an async generator.
+        '''
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1.")
+        loop = asyncio.get_running_loop()
+        hooks = None
+        if self._hooks:
+            hooks = _Hooks(self._hooks)
+            hooks.start(self._source)
+
+        queues = [
+            asyncio.Queue(maxsize=queue_size)
+            for _ in range(len(self._steps) + 1)
+        ]
+        self._stopping = False
+        tasks = [loop.create_task(self._read_source(loop, queues[0], hooks))]
+        for (index, step) in enumerate(self._steps):
+            tasks.append(loop.create_task(self._run_step(
+                loop,
+                _step_name(index + 1, step),
+                step,
+                queues[index],
+                queues[index + 1],
+                hooks
+            )))
+
+        try:
+            while True:
+                item = await queues[-1].get()
+                if item is _END_OF_STREAM:
+                    break
+                if isinstance(item, _StageFailure):
+                    raise item.error
+                if hooks:
+                    hooks.frame_done(item)
+                _release_frame(item)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if hooks:
+                hooks.finish()
+        return self
+
+    def stop(self):
+        '''
+        Stops reading the source of a running pipeline. The frames already
+        read still go through every step before run returns. A plain source
+        in the middle of reading a frame is let finish, and its frame goes
+        through as well, while the read of an async source is cancelled. Must
+        be called from the event loop thread (see loop.call_soon_threadsafe).
+        '''
+        self._stopping = True
+        if self._read is not None:
+            self._read.cancel()
+
+    async def _read_source(self, loop, output_queue, hooks):
+        try:
+            if hasattr(self._source, '__aiter__'):
+                await self._read_async_source(output_queue, hooks)
+            else:
+                frames = iter(self._source)
+                if hooks:
+                    frames = _hooked_source(frames, hooks)
+                while not self._stopping:
+                    frame = await self._next(loop.run_in_executor(
+                        self.executor, next, frames, _END_OF_STREAM), False)
+                    if frame is _END_OF_STREAM:
+                        break
+                    await output_queue.put(frame)
+        except Exception as error:
+            await output_queue.put(_StageFailure(error))
+            return
+        await output_queue.put(_END_OF_STREAM)
+
+    async def _read_async_source(self, output_queue, hooks):
+        frames = self._source.__aiter__()
+        try:
+            while not self._stopping:
+                if hooks:
+                    hooks.before(_SOURCE_STAGE, None)
+                started = _now()
+                try:
+                    frame = await self._next(
+                        asyncio.ensure_future(frames.__anext__()), True)
+                except StopAsyncIteration:
+                    frame = _END_OF_STREAM
+                if frame is _END_OF_STREAM:
+                    return
+                if hooks:
+                    hooks.after(_SOURCE_STAGE, frame, started, _now() - started)
+                await output_queue.put(frame)
+        finally:
+            aclose = getattr(frames, 'aclose', None)
+            if aclose:
+                await aclose()
+
+    async def _next(self, read, cancellable):
+        # Returns the frame read, or the end of the stream when stop
+        # cancelled the read. Waiting (rather than awaiting the read) keeps
+        # the cancellation of the read apart from the cancellation of the
+        # task reading the source, which only happens when the run is over.
+        # Reads on the executor cannot be stopped once started, so their
+        # frames are released when they are read too late.
+        if cancellable:
+            self._read = read
+        try:
+            await asyncio.wait((read,))
+        except asyncio.CancelledError:
+            if cancellable:
+                read.cancel()
+            else:
+                read.add_done_callback(_release_read)
+            raise
+        finally:
+            self._read = None
+        if read.cancelled():
+            return _END_OF_STREAM
+        return read.result()
+
+    async def _run_step(self, loop, stage, step, input_queue, output_queue, hooks):
+        awaited = _is_coroutine_step(step)
+        if not awaited and hooks:
+            step = _hooked_step(step, stage, hooks)
+
+        while True:
+            item = await input_queue.get()
+            if item is _END_OF_STREAM or isinstance(item, _StageFailure):
+                await output_queue.put(item)
+                return
+            try:
+                if hooks:
+                    hooks.queue_depth(stage, input_queue.qsize())
+                if not awaited:
+                    item = await loop.run_in_executor(
+                        self.executor, _run_handed_off, step, item)
+                elif hooks:
+                    hooks.before(stage, item)
+                    started = _now()
+                    item = await step(item)
+                    hooks.after(stage, item, started, _now() - started)
+                else:
+                    item = await step(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                await output_queue.put(_StageFailure(error))
+                return
+            await output_queue.put(item)
+
+
+def _release_read(read):
+    if not read.cancelled() and read.exception() is None:
+        frame = read.result()
+        if frame is not _END_OF_STREAM:
+            _release_frame(frame)
+
+
+def _is_coroutine_step(step):
+    return inspect.iscoroutinefunction(step) or \
+        inspect.iscoroutinefunction(getattr(step, '__call__', None))
@@ -1,12 +1,26 @@
+import collections
+import concurrent.futures
 import cv2
 import datetime
 import math
+import multiprocessing
+import numpy
 import os
 import random
-import rtree
+import sys
+import threading
+import time
 import uuid
 
-from .. import BoundingBox, DetectedObject, TrackedObject, VideoFrame, TrackedObjectState
+if(sys.version_info[:3] < (3, 0)):
+    import Queue as queue
+else:
+    import queue
+
+# Clock used to measure how long trackers take.
+_now = getattr(time, 'perf_counter', time.time)
+
+from .. import AssignmentMethod, BoundingBox, BoxArray, DetectedObject, Detector, EvictionPolicy, MatchMetric, MonotonicClock, TrackedObject, TrackedObjectState, VideoCaptureGenerator, _tracked_objects_for_frame, assign, match_cost, non_max_suppression, select_for_eviction
 
 CASCADE_FACE_DETECTOR_DEFAULT_XML_PATH = os.environ.get(
     'EIGHTTRACK_CASCADE_FACE_DETECTOR_DEFAULT_XML_PATH',
@@ -40,49 +54,380 @@ DEFAULT_TRACKER_RECOVERY_THRESHOLD_IN_SECONDS indicates how long a tracked
 object can be missing before the object tracker gives up on it.
 '''
 
+DEFAULT_TRACKER_MAX_CENTER_DISTANCE = float(os.environ.get(
+    'EIGHTTRACK_CV2_TRACKER_MAX_CENTER_DISTANCE',
+    '0.5'
+))
+'''
+DEFAULT_TRACKER_MAX_CENTER_DISTANCE is the default maximum distance between the
+centers of a detected object and a tracked object, as a fraction of the tracked
+object's box diagonal, for the two to be matched when matching by distance.
+'''
+
+DEFAULT_DETECTION_NMS_THRESHOLD = float(os.environ.get(
+    'EIGHTTRACK_CV2_DETECTION_NMS_THRESHOLD',
+    '0.5'
+))
+'''
+DEFAULT_DETECTION_NMS_THRESHOLD is the IOU ratio above which two boxes found by
+a detector that searches several overlapping areas are considered the same
+object.
+'''
+
+DEFAULT_TRACKER_UPDATE_WORKERS = int(os.environ.get(
+    'EIGHTTRACK_CV2_TRACKER_UPDATE_WORKERS',
+    '1'
+))
+'''
+DEFAULT_TRACKER_UPDATE_WORKERS is the default number of threads the object
+tracker uses to update the objects it tracks. 1 updates them on the calling
+thread.
+'''
+
+DEFAULT_TRACKER_MAX_TRACKED_OBJECTS = int(os.environ.get(
+    'EIGHTTRACK_CV2_TRACKER_MAX_TRACKED_OBJECTS',
+    '0'
+))
+'''
+DEFAULT_TRACKER_MAX_TRACKED_OBJECTS is the default maximum number of objects
+the object tracker keeps track of at once. 0 means there is no limit.
+'''
+
+DEFAULT_TRACKER_TYPE = os.environ.get(
+    'EIGHTTRACK_CV2_TRACKER_TYPE',
+    'KCF'
+)
+'''
+DEFAULT_TRACKER_TYPE is the default type of OpenCV tracker (see TrackerType)
+the object tracker follows each object with.
+'''
+
+DEFAULT_TRACKER_INDEX_CELL_SIZE = int(os.environ.get(
+    'EIGHTTRACK_CV2_TRACKER_INDEX_CELL_SIZE',
+    '128'
+))
+'''
+DEFAULT_TRACKER_INDEX_CELL_SIZE is the width, in pixels, of the square cells
+the object tracker uses to spatially index the objects it tracks.
+'''
+
+DEFAULT_CASCADE_FULL_SEARCH_INTERVAL = int(os.environ.get(
+    'EIGHTTRACK_CV2_CASCADE_FULL_SEARCH_INTERVAL',
+    '30'
+))
+'''
+DEFAULT_CASCADE_FULL_SEARCH_INTERVAL is how often (in frames) a CascadeDetector
+given a tracker searches the whole frame rather than around tracked objects.
+'''
 
-class CascadeDetector(object):
+DEFAULT_CASCADE_CLASSIFIERS = int(os.environ.get(
+    'EIGHTTRACK_CV2_CASCADE_CLASSIFIERS',
+    str(multiprocessing.cpu_count())
+))
+'''
+DEFAULT_CASCADE_CLASSIFIERS is the maximum number of classifiers loaded from
+the same HAAR file, and thus of frames CascadeDetector instances search with
+it at once.
+'''
+
+
+class CascadeDetector(Detector):
     '''
     A CascadeDetector is a simple wrapper around OpenCV's CascadeClassifier
     initialized with one of the included a face detection XML files.
+
+    Since the cost of detection grows with the number of pixels searched, the
+    detector can search a copy of the frame downscaled by scale (min_size then
+    applies to the downscaled copy) and converted to grayscale, and can be
+    restricted to regions of interest: the given regions (BoundingBox
+    instances), and when a tracker is given, the areas around its objects
+    (grown by track_margin times their size on each side) plus a band of
+    border pixels along the edges of the frame where new objects come in. A
+    region should be larger than the objects it is meant to find. Detected
+    boxes are always in full-resolution frame coordinates.
+
+    Objects that show up away from the edges, such as faces turning towards
+    the camera, are only found by full searches, which ignore the tracker:
+    every full_search_interval-th frame is searched as if no tracker was
+    given (a full_search_interval of 0 turns them off).
+
+    CascadeDetector instances can be pickled (e.g. to be sent to the workers
+    of a ParallelDetector), in which case the classifier is loaded again from
+    haar_path on the receiving end and the tracker is left behind.
+
+    All the CascadeDetector instances of a process loading the same HAAR file
+    share a pool of classifiers (see MultiStreamRunner), loaded as more frames
+    are searched at once, up to DEFAULT_CASCADE_CLASSIFIERS of them; classifier
+    is the first of them.
     '''
 
-    def __init__(self, scale_factor=1.5, min_neighbors=8, min_size=(16, 16), flags=cv2.CASCADE_SCALE_IMAGE, haar_path=CASCADE_FACE_DETECTOR_DEFAULT_XML_PATH):
+    def __init__(self, scale_factor=1.5, min_neighbors=8, min_size=(16, 16), flags=cv2.CASCADE_SCALE_IMAGE, haar_path=CASCADE_FACE_DETECTOR_DEFAULT_XML_PATH, scale=1.0, grayscale=False, regions=None, tracker=None, track_margin=0.5, border=0, full_search_interval=DEFAULT_CASCADE_FULL_SEARCH_INTERVAL):
         if not os.path.isfile(haar_path):
             raise ValueError(
                 "{} is not a valid HAAR xml file.".format(haar_path))
+        if scale <= 0:
+            raise ValueError("scale must be positive.")
         self.scale_factor = scale_factor
         self.min_neighbors = min_neighbors
         self.min_size = min_size
         self.flags = flags
-        self.classifier = cv2.CascadeClassifier(haar_path)
+        self.haar_path = haar_path
+        self.scale = scale
+        self.grayscale = grayscale
+        self.regions = regions
+        self.tracker = tracker
+        self.track_margin = track_margin
+        self.border = border
+        self.full_search_interval = full_search_interval
+        self._searches = 0
+        self._classifiers = _shared_classifiers(haar_path)
+        self.classifier = self._classifiers.first
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['classifier']
+        del state['_classifiers']
+        state['tracker'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._classifiers = _shared_classifiers(self.haar_path)
+        self.classifier = self._classifiers.first
 
     def detect(self, frame):
-        objects = self.classifier.detectMultiScale(
-            frame,
-            scaleFactor=self.scale_factor,
-            minNeighbors=self.min_neighbors,
-            minSize=self.min_size,
-            flags=self.flags
+        if self.grayscale and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        regions = self.regions_of_interest(
+            frame.shape[1], frame.shape[0], self._full_search_due())
+        if regions is None:
+            return self._detect_region(frame, 0, 0)
+
+        objects = list()
+        for (x1, y1, x2, y2) in regions:
+            objects.extend(self._detect_region(frame[y1:y2, x1:x2], x1, y1))
+        if len(regions) < 2:
+            return objects
+
+        # Objects in the overlap of two regions are found twice.
+        kept = non_max_suppression(
+            BoxArray.from_boxes([detected.bounding_box for detected in objects]),
+            [detected.score for detected in objects],
+            DEFAULT_DETECTION_NMS_THRESHOLD
         )
-        return map(
-            lambda rect: DetectedObject(
+        return [objects[index] for index in kept]
+
+    def regions_of_interest(self, width, height, full_search=False):
+        '''
+        Returns the list of (x1, y1, x2, y2) regions of a frame of the given
+        size that detection should search, with overlapping regions merged, or
+        None if the whole frame should be searched. A full search ignores the
+        tracker.
+        '''
+        regions = list()
+        if self.regions:
+            regions.extend(box.as_point_pair() for box in self.regions)
+
+        if self.tracker is not None and not full_search:
+            boxes = [
+                tracked_object.last_known_location
+                for tracked_object in self.tracker.tracked_objects
+                if tracked_object.state != TrackedObjectState.LOST
+            ]
+            if not boxes and not self.regions:
+                # Nothing is being tracked yet, so objects could be anywhere.
+                return None
+            for box in boxes:
+                x_margin = box.width * self.track_margin
+                y_margin = box.height * self.track_margin
+                regions.append((
+                    box.x1 - x_margin,
+                    box.y1 - y_margin,
+                    box.x2 + x_margin,
+                    box.y2 + y_margin
+                ))
+            if self.border > 0:
+                regions.extend([
+                    (0, 0, width, self.border),
+                    (0, height - self.border, width, height),
+                    (0, self.border, self.border, height - self.border),
+                    (width - self.border, self.border, width, height - self.border),
+                ])
+        elif not self.regions:
+            return None
+
+        clipped = list()
+        for (x1, y1, x2, y2) in regions:
+            (x1, y1) = (max(0, int(x1)), max(0, int(y1)))
+            (x2, y2) = (min(width, int(math.ceil(x2))), min(height, int(math.ceil(y2))))
+            if x2 > x1 and y2 > y1:
+                clipped.append((x1, y1, x2, y2))
+        return _merge_regions(clipped)
+
+    def _full_search_due(self):
+        if self.tracker is None or not self.full_search_interval:
+            return False
+        self._searches = (self._searches + 1) % self.full_search_interval
+        return self._searches == 0
+
+    def _detect_region(self, image, x_offset, y_offset):
+        if self.scale != 1.0:
+            image = cv2.resize(
+                image,
+                (0, 0),
+                fx=self.scale,
+                fy=self.scale,
+                interpolation=cv2.INTER_AREA
+            )
+        if image.size == 0:
+            return list()
+
+        classifier = self._classifiers.get()
+        try:
+            objects = classifier.detectMultiScale(
+                image,
+                scaleFactor=self.scale_factor,
+                minNeighbors=self.min_neighbors,
+                minSize=self.min_size,
+                flags=self.flags
+            )
+        finally:
+            self._classifiers.put(classifier)
+        return [
+            DetectedObject(
                 label='face',
                 score=0.99,
                 bounding_box=BoundingBox(
-                    rect[0],
-                    rect[1],
-                    rect[2],
-                    rect[3]
+                    rect[0] / self.scale + x_offset,
+                    rect[1] / self.scale + y_offset,
+                    rect[2] / self.scale,
+                    rect[3] / self.scale
                 )
-            ),
-            objects
-        )
+            )
+            for rect in objects
+        ]
 
-    def __call__(self, frame):
-        objects = self.detect(frame.pixels)
-        frame.detected_objects = frame.detected_objects.union(objects)
-        return frame
+
+class _ClassifierPool(object):
+    '''
+    The cv2.CascadeClassifier instances loaded from a HAAR file. detectMultiScale
+    keeps per-call state in the classifier, so a classifier cannot detect in two
+    frames at once: each search takes one out of the pool with get and hands it
+    back with put. A classifier is loaded when all the others are in use, and
+    get waits for one once size of them are.
+    '''
+
+    def __init__(self, haar_path, size):
+        self.haar_path = haar_path
+        self.size = max(size, 1)
+        self.first = cv2.CascadeClassifier(haar_path)
+        self._loaded = 1
+        self._idle = queue.Queue()
+        self._idle.put(self.first)
+        self._lock = threading.Lock()
+
+    def get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            load = self._loaded < self.size
+            if load:
+                self._loaded = self._loaded + 1
+        if load:
+            return cv2.CascadeClassifier(self.haar_path)
+        return self._idle.get()
+
+    def put(self, classifier):
+        self._idle.put(classifier)
+
+
+_classifier_pools = {}
+_classifier_pools_lock = threading.Lock()
+
+
+def _shared_classifiers(haar_path):
+    '''
+    Returns the _ClassifierPool of haar_path, creating it on first use.
+    '''
+    key = os.path.realpath(haar_path)
+    with _classifier_pools_lock:
+        pool = _classifier_pools.get(key)
+        if pool is None:
+            pool = _ClassifierPool(haar_path, DEFAULT_CASCADE_CLASSIFIERS)
+            _classifier_pools[key] = pool
+        return pool
+
+
+def _merge_regions(regions):
+    '''
+    Replaces pairs of overlapping (x1, y1, x2, y2) regions by the region
+    enclosing them as long as that does not add to the area to search.
+    '''
+    merged = list(regions)
+    changed = True
+    while changed:
+        changed = False
+        for first in range(len(merged)):
+            for second in range(first + 1, len(merged)):
+                (ax1, ay1, ax2, ay2) = merged[first]
+                (bx1, by1, bx2, by2) = merged[second]
+                if ax2 <= bx1 or bx2 <= ax1 or ay2 <= by1 or by2 <= ay1:
+                    continue
+                enclosing = (
+                    min(ax1, bx1), min(ay1, by1), max(ax2, bx2), max(ay2, by2))
+                if _region_area(enclosing) > \
+                        _region_area(merged[first]) + _region_area(merged[second]):
+                    continue
+                merged[first] = enclosing
+                del merged[second]
+                changed = True
+                break
+            if changed:
+                break
+    return merged
+
+
+def _region_area(region):
+    (x1, y1, x2, y2) = region
+    return (x2 - x1) * (y2 - y1)
+
+
+class TrackerType(object):
+    '''
+    TrackerType names the OpenCV tracker algorithms that OpencvObjectTracker
+    can follow objects with, from the cheapest to the most expensive to update
+    (roughly, see benchmark_trackers). Which ones are available depends on the
+    OpenCV build: some only come with opencv-contrib, in cv2.legacy.
+    '''
+    MEDIAN_FLOW = 'MedianFlow'
+    MOSSE = 'MOSSE'
+    KCF = 'KCF'
+    TLD = 'TLD'
+    CSRT = 'CSRT'
+    MIL = 'MIL'
+    BOOSTING = 'Boosting'
+
+    ALL = (MEDIAN_FLOW, MOSSE, KCF, TLD, CSRT, MIL, BOOSTING)
+
+
+def tracker_factory(tracker_type):
+    '''
+    Returns a function creating OpenCV trackers of the given TrackerType, or
+    tracker_type itself if it already is such a function. Raises a ValueError
+    when this OpenCV build does not provide the tracker.
+    '''
+    if callable(tracker_type):
+        return tracker_type
+    name = 'Tracker{}_create'.format(tracker_type)
+    for module in (cv2, getattr(cv2, 'legacy', None)):
+        factory = getattr(module, name, None)
+        if factory:
+            return factory
+    raise ValueError(
+        "{} is not a tracker type this OpenCV build provides.".format(tracker_type))
 
 
 class OpencvTrackedObject(TrackedObject):
@@ -92,24 +437,38 @@ class OpencvTrackedObject(TrackedObject):
     messaging and time tracking.
     '''
 
-    def __init__(self, object_id, bounding_box, frame, recovery_threshold_in_seconds=DEFAULT_TRACKER_RECOVERY_THRESHOLD_IN_SECONDS):
+    __slots__ = ('_tracker', '_tracker_factory')
+
+    def __init__(self, object_id, bounding_box, frame, recovery_threshold_in_seconds=DEFAULT_TRACKER_RECOVERY_THRESHOLD_IN_SECONDS, clock=None, tracker_factory=None):
         TrackedObject.__init__(
             self,
             object_id,
             bounding_box,
-            recovery_threshold_in_seconds
+            recovery_threshold_in_seconds,
+            clock
         )
+        self._tracker_factory = tracker_factory if tracker_factory else cv2.TrackerKCF_create
         self._initialize_tracker(frame.pixels)
 
     def _initialize_tracker(self, frame):
-        self._tracker = cv2.TrackerKCF_create()
+        self._tracker = self._tracker_factory()
         self._tracker.init(
             image=frame,
             boundingBox=self.first_known_location.as_origin_and_size()
         )
 
     def update(self, frame):
-        ok, updated_box = self._tracker.update(frame.pixels)
+        return self._apply_tracking_result(self._track(frame))
+
+    def _track(self, frame):
+        '''
+        Runs the wrapped OpenCV tracker on the given frame without changing the
+        receiver's state, so that it can safely run on a worker thread.
+        '''
+        return self._tracker.update(frame.pixels)
+
+    def _apply_tracking_result(self, result):
+        ok, updated_box = result
         if not ok:
             self.report_missing()
             return (False, self.last_known_location)
@@ -132,77 +491,280 @@ class OpencvTrackedObject(TrackedObject):
         return (True, self.last_known_location)
 
 
+class TrackedObjectIndex(object):
+    '''
+    An in-memory spatial index of tracked objects that is updated in place as
+    objects move, are added or are removed. Each object is keyed by a stable
+    integer assigned when it is added.
+
+    The index is a uniform grid of square cells (cell_size pixels wide): an
+    object is registered in every cell its box overlaps, so moving within the
+    same cells only updates its coordinates and a query only looks at the
+    objects near the queried box.
+    '''
+
+    def __init__(self, cell_size=DEFAULT_TRACKER_INDEX_CELL_SIZE):
+        self.cell_size = cell_size
+        self._next_key = 0
+        self._keys = dict()
+        self._entries = dict()
+        self._cells = collections.defaultdict(set)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, tracked_object):
+        return tracked_object in self._keys
+
+    def add(self, tracked_object):
+        '''
+        Indexes the given object at its last known location and returns the
+        key assigned to it.
+        '''
+        key = self._next_key
+        self._next_key = self._next_key + 1
+        coordinates = tracked_object.last_known_location.as_left_bottom_right_top()
+        cells = self._cell_range(coordinates)
+        self._keys[tracked_object] = key
+        self._entries[key] = [tracked_object, coordinates, cells]
+        self._register(key, cells)
+        return key
+
+    def move(self, tracked_object):
+        '''
+        Re-indexes the given object at its current last known location.
+        '''
+        key = self._keys[tracked_object]
+        entry = self._entries[key]
+        coordinates = tracked_object.last_known_location.as_left_bottom_right_top()
+        if coordinates == entry[1]:
+            return
+        entry[1] = coordinates
+        cells = self._cell_range(coordinates)
+        if cells == entry[2]:
+            return
+        self._unregister(key, entry[2])
+        self._register(key, cells)
+        entry[2] = cells
+
+    def remove(self, tracked_object):
+        key = self._keys.pop(tracked_object)
+        (_, _, cells) = self._entries.pop(key)
+        self._unregister(key, cells)
+
+    def intersection(self, coordinates):
+        '''
+        Returns the indexed objects whose boxes intersect (or touch) the given
+        (left, bottom, right, top) coordinates, in the order they were added.
+        '''
+        (left, bottom, right, top) = coordinates
+        (min_column, min_row, max_column, max_row) = self._cell_range(
+            coordinates)
+        keys = set()
+        for column in range(min_column, max_column + 1):
+            for row in range(min_row, max_row + 1):
+                cell = self._cells.get((column, row))
+                if cell:
+                    keys.update(cell)
+
+        result = list()
+        for key in sorted(keys):
+            (tracked_object, (other_left, other_bottom, other_right, other_top), _) = \
+                self._entries[key]
+            if other_right < left or right < other_left:
+                continue
+            if other_top < bottom or top < other_bottom:
+                continue
+            result.append(tracked_object)
+        return result
+
+    def _cell_range(self, coordinates):
+        (left, bottom, right, top) = coordinates
+        return (
+            int(left // self.cell_size),
+            int(bottom // self.cell_size),
+            int(right // self.cell_size),
+            int(top // self.cell_size)
+        )
+
+    def _register(self, key, cells):
+        (min_column, min_row, max_column, max_row) = cells
+        for column in range(min_column, max_column + 1):
+            for row in range(min_row, max_row + 1):
+                self._cells[(column, row)].add(key)
+
+    def _unregister(self, key, cells):
+        (min_column, min_row, max_column, max_row) = cells
+        for column in range(min_column, max_column + 1):
+            for row in range(min_row, max_row + 1):
+                cell = self._cells[(column, row)]
+                cell.discard(key)
+                if not cell:
+                    del self._cells[(column, row)]
+
+
 class OpencvObjectTracker(object):
     '''
     The OpencvObjectTracker is similar to Open CV's multitracker but in this
     case contains TrackedObject instances that allow keeping track of time.
     '''
+    _update_executor = None
 
-    def __init__(self, recovery_threshold_in_seconds=DEFAULT_TRACKER_RECOVERY_THRESHOLD_IN_SECONDS):
+    def __init__(self, recovery_threshold_in_seconds=DEFAULT_TRACKER_RECOVERY_THRESHOLD_IN_SECONDS, assignment=AssignmentMethod.SEQUENTIAL, match_metric=MatchMetric.IOU, max_center_distance=DEFAULT_TRACKER_MAX_CENTER_DISTANCE, update_workers=DEFAULT_TRACKER_UPDATE_WORKERS, clock=None, evict_lost=True, max_tracked_objects=DEFAULT_TRACKER_MAX_TRACKED_OBJECTS, eviction=EvictionPolicy.OLDEST, tracker_type=DEFAULT_TRACKER_TYPE):
         '''
         Initializes ther receiver with an empty list of tracked objects.
+
+        When update_workers is greater than 1, the per-object OpenCV tracker
+        updates of each frame are spread across a pool of that many threads
+        kept for the lifetime of the receiver (see close). Results do not
+        depend on the number of workers.
+
+        By default each incoming detection is matched on its own to the known
+        object it overlaps the most (AssignmentMethod.SEQUENTIAL). With
+        AssignmentMethod.GREEDY or AssignmentMethod.HUNGARIAN all detections
+        of a frame are matched at once, using costs measured by match_metric,
+        and every known object is matched to at most one detection.
+
+        Tracked objects measure time with clock, which is told about every
+        frame the receiver is called with, so a FrameClock or a MediaClock
+        makes recovery_threshold_in_seconds count video time and tracking
+        results independent of processing speed. It defaults to a new
+        MonotonicClock, which measures real time.
+
+        With evict_lost, objects that went LOST are removed on the next frame
+        (they cannot be recovered, so they would only be updated in vain).
+        When max_tracked_objects is greater than 0 and adding new objects
+        brings their number above it, objects are evicted according to the
+        eviction policy. The order of tracked_objects is not kept when objects
+        are removed. evicted_objects counts the objects removed by either.
+
+        Each object is followed by an OpenCV tracker of the given tracker_type
+        (a TrackerType, or a function returning new OpenCV trackers).
         '''
+        self.tracker_factory = tracker_factory(tracker_type)
+        if eviction not in (EvictionPolicy.OLDEST, EvictionPolicy.LEAST_CONFIDENT):
+            raise ValueError(
+                "{} is not a valid eviction policy.".format(eviction))
         self.tracked_objects = list()
-        self.index = rtree.index.Index()
+        self.evict_lost = evict_lost
+        self.max_tracked_objects = max_tracked_objects
+        self.eviction = eviction
+        self.evicted_objects = 0
+        self._positions = dict()
+        self.clock = clock if clock else MonotonicClock()
+        self.index = TrackedObjectIndex()
         self.box_iou_threshold = DEFAULT_TRACKER_IOU_THRESHOLD
         self.recovery_threshold_in_seconds = recovery_threshold_in_seconds
+        self.assignment = assignment
+        self.match_metric = match_metric
+        self.max_center_distance = max_center_distance
+        self.last_assignment = None
+        self._update_executor = None
+        if update_workers > 1:
+            self._update_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=update_workers)
 
     def __call__(self, frame):
-        self.add(frame.detected_objects, frame)
-        self.update(frame)
-        return VideoFrame(
-            frame.pixels,
-            detected_objects=frame.detected_objects,
-            tracked_objects=self.tracked_objects
-        )
+        self.clock.observe(frame)
+        if self.evict_lost:
+            self.evicted_objects = self.evicted_objects + \
+                self.remove_lost_objects()
+        # Static frames (see MotionGate) keep the previous frame's results.
+        if not frame.is_static:
+            self.add(frame.detected_objects, frame)
+            self.update(frame)
+        frame.tracked_objects = _tracked_objects_for_frame(self.tracked_objects)
+        return frame
 
     def get(self, bounding_box):
         '''
         Returns a tracked object for the given bounding box if one is present.
         '''
-        intersections = self.index.intersection(
-            bounding_box.as_left_bottom_right_top(),
-            objects=True
-        )
-        intersections = filter(
-            lambda xsect: self.tracked_objects[xsect.id].last_known_location.iou(
-                bounding_box) > self.box_iou_threshold,
-            intersections
+        candidates = self.index.intersection(
+            bounding_box.as_left_bottom_right_top()
         )
-        intersections = sorted(
-            intersections,
-            key=lambda xsect: self.tracked_objects[xsect.id].last_known_location.iou(
-                bounding_box
-            ),
-            reverse=True
-        )
-        if len(intersections) > 0:
-            tracked_object_index = intersections[0].id
-            return self.tracked_objects[tracked_object_index]
+        if not candidates:
+            return None
+
+        ious = BoxArray.from_boxes([bounding_box]).iou(
+            BoxArray.from_boxes(
+                [candidate.last_known_location for candidate in candidates])
+        )[0]
+        best = int(numpy.argmax(ious))
+        if ious[best] > self.box_iou_threshold:
+            return candidates[best]
 
         return None
 
     def add(self, detected_objects, frame):
         bounding_boxes = list()
         try:
-            bounding_boxes = map(lambda do: do.bounding_box, detected_objects)
+            bounding_boxes = [do.bounding_box for do in detected_objects]
         except TypeError:
             raise Exception(
                 "Parameter detected_objects must be an iterable of DetectedObject instances."
             )
 
-        boxes_and_objects = map(
-            lambda box: (box, self.get(box)),
-            bounding_boxes
-        )
+        if not bounding_boxes:
+            return list()
 
+        if self.assignment != AssignmentMethod.SEQUENTIAL:
+            result = self._add_assigned(bounding_boxes, frame)
+        else:
+            result = self._add_sequential(bounding_boxes, frame)
+
+        if self.max_tracked_objects > 0:
+            overflow = len(self.tracked_objects) - self.max_tracked_objects
+            if overflow > 0:
+                self.remove(select_for_eviction(
+                    self.tracked_objects, overflow, self.eviction))
+                self.evicted_objects = self.evicted_objects + overflow
+        return result
+
+    def _add_sequential(self, bounding_boxes, frame):
         result = list()
-        for (box, tracked_object) in boxes_and_objects:
+
+        # Each detection is only matched against the known objects the index
+        # finds around it, since objects it does not touch have an IOU of 0.
+        # Objects created or recovered by an earlier detection of this call
+        # sit exactly on that detection's box, so they are matched through
+        # the detection-to-detection IOU matrix instead.
+        detection_ious = BoxArray.from_boxes(bounding_boxes).iou(
+            BoxArray.from_boxes(bounding_boxes))
+        claimed_rows = list()
+        claimed_objects = list()
+        claimed_ids = set()
+
+        for (row, box) in enumerate(bounding_boxes):
+            tracked_object = None
+            best_iou = self.box_iou_threshold
+            candidates = [
+                candidate for candidate in self.index.intersection(
+                    box.as_left_bottom_right_top())
+                if id(candidate) not in claimed_ids
+            ]
+            if candidates:
+                ious = BoxArray.from_boxes([box]).iou(BoxArray.from_boxes(
+                    [candidate.last_known_location for candidate in candidates]
+                ))[0]
+                best = int(numpy.argmax(ious))
+                if ious[best] > best_iou:
+                    (tracked_object, best_iou) = (candidates[best], ious[best])
+            if claimed_rows:
+                ious = detection_ious[row, claimed_rows]
+                claimed = int(numpy.argmax(ious))
+                if ious[claimed] > best_iou:
+                    tracked_object = claimed_objects[claimed]
+
             if not tracked_object:
                 # The bounding box did not intersect (above an IOU) with any
                 # known objects, so this means this is a new object that needs
                 # to be tracked.
-                result.append(self._append_box(box, frame))
+                tracked_object = self._append_box(box, frame)
+                result.append(tracked_object)
+                claimed_rows.append(row)
+                claimed_objects.append(tracked_object)
+                claimed_ids.add(id(tracked_object))
                 continue
 
             if tracked_object.state == TrackedObjectState.TRACKING:
@@ -217,58 +779,217 @@ class OpencvObjectTracker(object):
                 # Looks like the known object could not be recovered, so a
                 # brand-new object should be created for the incoming bounding
                 # box.
-                result.append(self._append_box(box, frame))
+                tracked_object = self._append_box(box, frame)
+                result.append(tracked_object)
+            else:
+                self.index.move(tracked_object)
+            claimed_rows.append(row)
+            claimed_objects.append(tracked_object)
+            claimed_ids.add(id(tracked_object))
+
+        return result
+
+    def _add_assigned(self, bounding_boxes, frame):
+        # LOST objects cannot be recovered, so they do not take part in the
+        # assignment.
+        candidates = [
+            tracked_object for tracked_object in self.tracked_objects
+            if tracked_object.state != TrackedObjectState.LOST
+        ]
+        detections = BoxArray.from_boxes(bounding_boxes)
+        tracks = BoxArray.from_boxes(
+            [tracked_object.last_known_location for tracked_object in candidates])
+        (cost, feasible) = match_cost(
+            detections,
+            tracks,
+            metric=self.match_metric,
+            iou_threshold=self.box_iou_threshold,
+            max_distance=self.max_center_distance
+        )
+        assignment = assign(cost, feasible, method=self.assignment)
+        self.last_assignment = assignment
+
+        result = list()
+        for (row, column) in assignment.matches:
+            tracked_object = candidates[column]
+            if tracked_object.state == TrackedObjectState.TRACKING:
+                continue
+            (recovered, _) = tracked_object.attempt_recovery(
+                bounding_boxes[row], frame)
+            if recovered:
+                self.index.move(tracked_object)
+
+        # An unmatched detection overlapping a known object (or one created
+        # for an earlier unmatched detection) is a duplicate of it rather
+        # than a new object.
+        overlaps = detections.iou(tracks) > self.box_iou_threshold
+        duplicates = detections.iou(detections) > self.box_iou_threshold
+        created_rows = list()
+        for row in assignment.unmatched_detections:
+            if overlaps[row].any() or duplicates[row, created_rows].any():
                 continue
+            result.append(self._append_box(bounding_boxes[row], frame))
+            created_rows.append(row)
 
         return result
 
     def remove_lost_objects(self):
-        objects_to_remove = filter(
-            lambda tracked_object: tracked_object.state == TrackedObjectState.LOST,
-            self.tracked_objects
-        )
+        '''
+        Removes the LOST objects and returns how many there were.
+        '''
+        objects_to_remove = [
+            tracked_object for tracked_object in self.tracked_objects
+            if tracked_object.state == TrackedObjectState.LOST
+        ]
         self.remove(objects_to_remove)
+        return len(objects_to_remove)
 
     def remove(self, objects_to_remove):
-        for tracked_object in objects_to_remove:
-            self.tracked_objects.remove(tracked_object)
-        self.index = self._create_index()
+        for tracked_object in list(objects_to_remove):
+            # The last object takes the place of the removed one, so that
+            # removing does not shift the rest of the list.
+            position = self._positions.pop(id(tracked_object))
+            last = self.tracked_objects.pop()
+            if last is not tracked_object:
+                self.tracked_objects[position] = last
+                self._positions[id(last)] = position
+            self.index.remove(tracked_object)
 
     def _append_box(self, box, frame):
         tracked_obj = OpencvTrackedObject(
             str(uuid.uuid4()),
             box,
             frame,
-            self.recovery_threshold_in_seconds
+            self.recovery_threshold_in_seconds,
+            self.clock,
+            self.tracker_factory
         )
         self._append_tracked_object(tracked_obj)
         return tracked_obj
 
     def _append_tracked_object(self, tracked_obj):
+        self._positions[id(tracked_obj)] = len(self.tracked_objects)
         self.tracked_objects.append(tracked_obj)
+        self.index.add(tracked_obj)
+
+    def update(self, frame):
+        tracked_objects = list(self.tracked_objects)
+        if self._update_executor and len(tracked_objects) > 1:
+            # Only the OpenCV tracker updates (which release the GIL) run on
+            # the pool; state changes are applied afterwards in list order.
+            results = list(self._update_executor.map(
+                lambda tracked_obj: tracked_obj._track(frame),
+                tracked_objects
+            ))
+        else:
+            results = [
+                tracked_obj._track(frame) for tracked_obj in tracked_objects
+            ]
 
-        # NOTE: The id of the object in the index is its index in the
-        # tracked_objects list. This is because the rtree index expects an int.
-        self.index.add(
-            len(self.tracked_objects) - 1,
-            tracked_obj.last_known_location.as_left_bottom_right_top()
+        for (tracked_obj, result) in zip(tracked_objects, results):
+            tracked_obj._apply_tracking_result(result)
+            self.index.move(tracked_obj)
+        return self.tracked_objects
+
+    def close(self):
+        '''
+        Shuts down the receiver's update worker threads, if any.
+        '''
+        if self._update_executor:
+            self._update_executor.shutdown()
+            self._update_executor = None
+
+    def __del__(self):
+        self.close()
+
+
+class TrackerBenchmark(object):
+    '''
+    How an OpenCV tracker type fared in benchmark_trackers: the time it took
+    to initialize, the mean and worst time per update, the fraction of frames
+    on which it reported the object found (success_rate) and its mean IOU
+    with the reference boxes.
+    '''
+
+    def __init__(self, tracker_type, frames, init_seconds, update_seconds, max_update_seconds, success_rate, mean_iou):
+        self.tracker_type = tracker_type
+        self.frames = frames
+        self.init_seconds = init_seconds
+        self.update_seconds = update_seconds
+        self.max_update_seconds = max_update_seconds
+        self.success_rate = success_rate
+        self.mean_iou = mean_iou
+
+    def __str__(self):
+        return "TrackerBenchmark({}, init {:.2f}ms, update {:.2f}ms (max {:.2f}ms), success {:.0%}, IOU {:.2f})".format(
+            self.tracker_type,
+            self.init_seconds * 1e3,
+            self.update_seconds * 1e3,
+            self.max_update_seconds * 1e3,
+            self.success_rate,
+            self.mean_iou
         )
 
-    def _create_index(self):
-        if not self.tracked_objects:
-            return rtree.index.Index()
 
-        def index_data_generator():
-            for (tracked_index, tracked_obj) in enumerate(self.tracked_objects):
-                yield (
-                    tracked_index,
-                    tracked_obj.last_known_location.as_left_bottom_right_top(),
-                    None
-                )
-        return rtree.index.Index('tracker', index_data_generator())
+def benchmark_trackers(url, detector, tracker_types=TrackerType.ALL, frame_count=None):
+    '''
+    Measures how long each of the given tracker types takes to initialize and
+    to update, and how well it follows an object, on the video at url (for
+    instance test/data/clip.m4v with a CascadeDetector).
 
-    def update(self, frame):
-        for tracked_obj in self.tracked_objects:
-            tracked_obj.update(frame)
-        self.index = self._create_index()
-        return self.tracked_objects
+    The detector runs on every frame to provide reference boxes. Trackers
+    start on the first box detected and, on every later frame the detector
+    found something on, score the IOU of their box with the closest
+    reference box (0 when they lost the object).
+
+    Returns a TrackerBenchmark per tracker type this OpenCV build provides,
+    in the given order.
+    '''
+    frames = list()
+    for frame in VideoCaptureGenerator(url):
+        if frame_count is not None and len(frames) >= frame_count:
+            break
+        frames.append((frame.pixels, [
+            detected.bounding_box for detected in detector.detect(frame.pixels)
+        ]))
+    start = next(
+        (index for (index, (_, boxes)) in enumerate(frames) if boxes), None)
+    if start is None:
+        raise ValueError("The detector found nothing to track in {}.".format(url))
+
+    results = list()
+    for tracker_type in tracker_types:
+        try:
+            factory = tracker_factory(tracker_type)
+        except ValueError:
+            continue
+        (pixels, boxes) = frames[start]
+        started = _now()
+        tracker = factory()
+        tracker.init(image=pixels, boundingBox=boxes[0].as_origin_and_size())
+        init_seconds = _now() - started
+
+        durations = list()
+        found = 0
+        ious = list()
+        for (pixels, boxes) in frames[start + 1:]:
+            started = _now()
+            (ok, box) = tracker.update(pixels)
+            durations.append(_now() - started)
+            if ok:
+                found = found + 1
+            if boxes:
+                ious.append(max(
+                    BoundingBox(*box).iou(reference) for reference in boxes
+                ) if ok else 0.0)
+
+        results.append(TrackerBenchmark(
+            tracker_type,
+            len(durations),
+            init_seconds,
+            sum(durations) / len(durations) if durations else 0.0,
+            max(durations) if durations else 0.0,
+            float(found) / len(durations) if durations else 0.0,
+            sum(ious) / len(ious) if ious else 0.0
+        ))
+    return results
@@ -1,6 +1,17 @@
+import cv2
+import datetime
+import itertools
+import json
+import numpy
 import unittest
 import os
+import pickle
+import random
+import shutil
 import sys
+import tempfile
+import threading
+import time
 
 if __name__ == '__main__':
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
@@ -8,6 +19,23 @@ if __name__ == '__main__':
 from eighttrack import *
 
 
+class PixelValueDetector(Detector):
+    '''
+    Detects a single object whose x coordinate is the first pixel value.
+    '''
+
+    def detect(self, pixels):
+        return [DetectedObject('pixel', 0.99, BoundingBox(pixels[0, 0], 0, 1, 1))]
+
+
+def pixel_value_frames(count):
+    for index in range(count):
+        yield VideoFrame(
+            numpy.full((48, 64), index, dtype=numpy.uint8),
+            detected_objects=set()
+        )
+
+
 class BoundingBoxTest(unittest.TestCase):
     def test_simple(self):
         box = BoundingBox(10, 20, 300, 400)
@@ -119,6 +147,178 @@ class BoundingBoxTest(unittest.TestCase):
         self.assertAlmostEqual(box1.union(box2), 30*30, delta=0.1)
 
 
+class BoxArrayTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(8)
+        self.boxes = [
+            BoundingBox(
+                random.randint(0, 100),
+                random.randint(0, 100),
+                random.randint(0, 50),
+                random.randint(0, 50)
+            )
+            for _ in range(20)
+        ]
+        self.others = self.boxes[:5] + [BoundingBox(500, 500, 10, 10)]
+
+    def assertMatrix(self, matrix, scalar):
+        self.assertEqual(matrix.shape, (len(self.boxes), len(self.others)))
+        for (row, box) in enumerate(self.boxes):
+            for (column, other) in enumerate(self.others):
+                self.assertAlmostEqual(
+                    matrix[row, column], scalar(box, other), places=6)
+
+    def test_round_trip(self):
+        array = BoxArray.from_boxes(self.boxes)
+        self.assertEqual(len(array), 20)
+        self.assertEqual(array.to_boxes(), self.boxes)
+        self.assertEqual(array[3], self.boxes[3])
+        self.assertEqual(array[2:4].to_boxes(), self.boxes[2:4])
+
+    def test_empty(self):
+        array = BoxArray.from_boxes([])
+        self.assertEqual(len(array), 0)
+        self.assertEqual(array.to_boxes(), [])
+        self.assertEqual(
+            array.iou(BoxArray.from_boxes(self.others)).shape, (0, 6))
+
+    def test_intersection(self):
+        self.assertMatrix(
+            BoxArray.from_boxes(self.boxes).intersection(
+                BoxArray.from_boxes(self.others)),
+            lambda box, other: box.intersection(other)
+        )
+
+    def test_union(self):
+        self.assertMatrix(
+            BoxArray.from_boxes(self.boxes).union(
+                BoxArray.from_boxes(self.others)),
+            lambda box, other: box.union(other)
+        )
+
+    def test_iou(self):
+        self.assertMatrix(
+            BoxArray.from_boxes(self.boxes).iou(
+                BoxArray.from_boxes(self.others)),
+            lambda box, other: box.iou(other)
+        )
+
+    def test_distance(self):
+        self.assertMatrix(
+            BoxArray.from_boxes(self.boxes).distance(
+                BoxArray.from_boxes(self.others)),
+            lambda box, other: box - other
+        )
+
+
+def best_matches(cost, feasible):
+    '''
+    Brute forces the largest set of feasible matches with the lowest cost.
+    '''
+    (rows, columns) = cost.shape
+    best = (0, 0.0, [])
+    for permutation in itertools.permutations(range(max(rows, columns)), rows):
+        matches = [
+            (row, column) for (row, column) in enumerate(permutation)
+            if column < columns and feasible[row, column]
+        ]
+        total = sum(cost[row, column] for (row, column) in matches)
+        if (len(matches), -total) > (best[0], -best[1]):
+            best = (len(matches), total, matches)
+    return best[2]
+
+
+class AssignTest(unittest.TestCase):
+    def setUp(self):
+        self.cost = numpy.array([
+            [0.1, 0.2],
+            [0.15, 0.9],
+            [0.5, 0.5],
+        ])
+
+    def test_greedy(self):
+        assignment = assign(self.cost, method=AssignmentMethod.GREEDY)
+        self.assertEqual(assignment.matches, [(0, 0), (2, 1)])
+        self.assertEqual(assignment.unmatched_detections, [1])
+        self.assertEqual(assignment.unmatched_tracks, [])
+
+    def test_hungarian(self):
+        assignment = assign(self.cost, method=AssignmentMethod.HUNGARIAN)
+        self.assertEqual(assignment.matches, [(0, 1), (1, 0)])
+        self.assertEqual(assignment.unmatched_detections, [2])
+
+    def test_hungarian_optimal(self):
+        random_state = numpy.random.RandomState(8)
+        for _ in range(50):
+            cost = random_state.rand(4, 3)
+            assignment = assign(cost)
+            total = sum(cost[row, column] for (row, column) in assignment.matches)
+            best = min(
+                sum(cost[rows[column], column] for column in range(3))
+                for rows in itertools.permutations(range(4), 3)
+            )
+            self.assertAlmostEqual(total, best)
+
+    def test_infeasible(self):
+        feasible = numpy.array([
+            [False, False],
+            [True, False],
+            [False, False],
+        ])
+        for method in (AssignmentMethod.GREEDY, AssignmentMethod.HUNGARIAN):
+            assignment = assign(self.cost, feasible, method=method)
+            self.assertEqual(assignment.matches, [(1, 0)])
+            self.assertEqual(assignment.unmatched_detections, [0, 2])
+            self.assertEqual(assignment.unmatched_tracks, [1])
+
+    def test_empty(self):
+        assignment = assign(numpy.zeros((0, 3)))
+        self.assertEqual(assignment.matches, [])
+        self.assertEqual(assignment.unmatched_tracks, [0, 1, 2])
+
+    def test_invalid_method(self):
+        with self.assertRaises(ValueError) as context:
+            assign(self.cost, method=AssignmentMethod.SEQUENTIAL)
+
+    def test_match_cost(self):
+        detections = BoxArray.from_boxes([
+            BoundingBox(0, 0, 10, 10),
+            BoundingBox(100, 100, 10, 10),
+        ])
+        tracks = BoxArray.from_boxes([BoundingBox(3, 4, 10, 10)])
+
+        (cost, feasible) = match_cost(detections, tracks, iou_threshold=0.2)
+        self.assertAlmostEqual(cost[0, 0], 1 - 42 / 182.0)
+        self.assertEqual(feasible.tolist(), [[True], [False]])
+
+        (cost, feasible) = match_cost(
+            detections, tracks, metric=MatchMetric.DISTANCE, max_distance=0.5)
+        self.assertAlmostEqual(cost[0, 0], 5 / (200 ** 0.5))
+        self.assertEqual(feasible.tolist(), [[True], [False]])
+
+    def test_hungarian_sparse(self):
+        # Sparse problems are solved group by group, which must give matches
+        # as good as solving the whole matrix at once.
+        rng = numpy.random.RandomState(0)
+        for _ in range(200):
+            (rows, columns) = rng.randint(1, 7, size=2)
+            cost = rng.rand(rows, columns)
+            feasible = rng.rand(rows, columns) < 0.3
+            matches = assign(cost, feasible).matches
+            self.assertEqual(
+                len(set(row for (row, _) in matches)), len(matches))
+            self.assertEqual(
+                len(set(column for (_, column) in matches)), len(matches))
+            for (row, column) in matches:
+                self.assertTrue(feasible[row, column])
+            best = best_matches(cost, feasible)
+            self.assertEqual(len(matches), len(best))
+            self.assertAlmostEqual(
+                sum(cost[row, column] for (row, column) in matches),
+                sum(cost[row, column] for (row, column) in best)
+            )
+
+
 class DetectedObjectTest(unittest.TestCase):
     def test_default_state(self):
         detected_object = DetectedObject(
@@ -138,6 +338,44 @@ class DetectedObjectTest(unittest.TestCase):
         )
         self.assertIsNotNone(detected_object.object_id)
 
+    def test_lazy_object_id(self):
+        box = BoundingBox(10, 20, 30, 40)
+        first = DetectedObject('person', 0.85, box)
+        second = DetectedObject('person', 0.85, box)
+        self.assertEqual(first, first)
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(set([first, second])), 2)
+        self.assertIsNone(first._object_id)
+
+        object_id = first.object_id
+        self.assertEqual(first.object_id, object_id)
+        self.assertEqual(first, DetectedObject('person', 0.85, box, object_id))
+        self.assertNotEqual(first, second)
+
+    def test_pickle(self):
+        detected_object = DetectedObject(
+            'person', 0.85, BoundingBox(10, 20, 30, 40))
+        copy = pickle.loads(pickle.dumps(detected_object))
+        self.assertEqual(copy, detected_object)
+        self.assertEqual(copy.object_id, detected_object.object_id)
+        self.assertEqual(hash(copy), hash(detected_object))
+
+    def test_frame_containers(self):
+        first = VideoFrame(None)
+        second = VideoFrame(None)
+        first.detected_objects.add(
+            DetectedObject('person', 0.85, BoundingBox(10, 20, 30, 40)))
+        self.assertEqual(second.detected_objects, set())
+        self.assertIsNot(first.tracked_objects, second.tracked_objects)
+
+    def test_slots(self):
+        detected_object = DetectedObject(
+            'person', 0.85, BoundingBox(10, 20, 30, 40))
+        with self.assertRaises(AttributeError):
+            detected_object.extra = True
+        with self.assertRaises(AttributeError):
+            VideoFrame(None).extra = True
+
 
 class TrackedObjectTest(unittest.TestCase):
     def test_default_state(self):
@@ -163,6 +401,66 @@ class TrackedObjectTest(unittest.TestCase):
         self.assertLess(tracked_object.age_in_seconds(), 1.0)
         self.assertEqual(tracked_object.total_distance_traveled(), 0.0)
 
+    def test_equality(self):
+        box = BoundingBox(11, 21, 30, 40)
+        tracked_object = TrackedObject(None, box)
+        self.assertEqual(tracked_object, tracked_object)
+        self.assertNotEqual(tracked_object, TrackedObject(None, box))
+        self.assertEqual(
+            tracked_object,
+            TrackedObject(tracked_object.object_id, box)
+        )
+        copy = pickle.loads(pickle.dumps(tracked_object))
+        self.assertEqual(copy, tracked_object)
+        self.assertEqual(hash(copy), hash(tracked_object))
+
+    def test_frame_clock(self):
+        clock = FrameClock(fps=10)
+        clock.observe(VideoFrame(None))
+        tracked_object = TrackedObject(
+            "someobjectid",
+            BoundingBox(11, 21, 30, 40),
+            recovery_threshold_in_seconds=2,
+            clock=clock
+        )
+        self.assertEqual(tracked_object.age_in_seconds(), 0.0)
+
+        frame = VideoFrame(None)
+        frame.frame_index = 15
+        clock.observe(frame)
+        self.assertEqual(tracked_object.age_in_seconds(), 1.5)
+        tracked_object.report_missing()
+        self.assertEqual(tracked_object.state, TrackedObjectState.MISSING)
+
+        # Frames without an index come right after the previous one.
+        for _ in range(6):
+            clock.observe(VideoFrame(None))
+        self.assertEqual(clock.frame_index, 21)
+        tracked_object.report_missing()
+        self.assertEqual(tracked_object.state, TrackedObjectState.LOST)
+
+    def test_media_clock(self):
+        clock = MediaClock()
+        tracked_object = TrackedObject(
+            "someobjectid",
+            BoundingBox(11, 21, 30, 40),
+            recovery_threshold_in_seconds=2,
+            clock=clock
+        )
+        frame = VideoFrame(None)
+        frame.media_timestamp = 1.25
+        clock.observe(frame)
+        clock.observe(VideoFrame(None))
+        self.assertEqual(tracked_object.seconds_since_last_known_location(), 1.25)
+
+        tracked_object.set_last_known_location(BoundingBox(12, 21, 30, 40))
+        self.assertEqual(tracked_object.seconds_since_last_known_location(), 0.0)
+        self.assertEqual(tracked_object.age_in_seconds(), 1.25)
+
+    def test_invalid_frame_clock(self):
+        with self.assertRaises(ValueError):
+            FrameClock(fps=0)
+
 
 class VideoCaptureGeneratorTest(unittest.TestCase):
     def test_read_frame(self):
@@ -186,6 +484,142 @@ class VideoCaptureGeneratorTest(unittest.TestCase):
             frame_count = frame_count + 1
         self.assertEqual(frame_count, 496)
 
+    def clip_path(self):
+        return os.path.join(os.path.dirname(__file__), 'data', 'clip.m4v')
+
+    def test_prefetch(self):
+        expected = [
+            int(frame.pixels.sum())
+            for frame in VideoCaptureGenerator(self.clip_path())
+        ]
+        seen = []
+        Pipeline(VideoCaptureGenerator(self.clip_path(), prefetch=4)) \
+            .add(lambda frame: seen.append(int(frame.pixels.sum())) or frame) \
+            .run()
+        self.assertEqual(seen, expected)
+
+    def test_prefetch_reuses_released_buffers(self):
+        generator = VideoCaptureGenerator(self.clip_path(), prefetch=2, buffers=3)
+        buffers = set()
+        for (index, frame) in enumerate(generator):
+            buffers.add(id(frame.pixels))
+            frame.release()
+            if index == 50:
+                break
+        generator.close()
+        # The frames queued ahead plus the ring of recycled buffers.
+        self.assertLessEqual(len(buffers), 2 + 3 + 1)
+
+    def test_ready(self):
+        self.assertTrue(VideoCaptureGenerator(self.clip_path()).ready())
+
+        generator = VideoCaptureGenerator(self.clip_path(), prefetch=2)
+        while not generator.ready():
+            time.sleep(0.01)
+        frames = list(generator)
+        self.assertTrue(generator.ready())
+        self.assertEqual(len(frames), 496)
+        generator.close()
+
+    def test_prefetch_without_release(self):
+        generator = VideoCaptureGenerator(self.clip_path(), prefetch=2)
+        frames = [next(generator) for _ in range(10)]
+        generator.close()
+        self.assertEqual(len(set(id(frame.pixels) for frame in frames)), 10)
+
+    def test_prefetch_bogus_file(self):
+        generator = VideoCaptureGenerator('bogus_file.m4v', prefetch=2)
+        self.assertEqual(list(generator), [])
+        with self.assertRaises(StopIteration) as context:
+            next(generator)
+
+    def slow_read(self, generator):
+        sums = list()
+        for frame in generator:
+            sums.append(int(frame.pixels.sum()))
+            frame.release()
+            time.sleep(0.002)
+        return sums
+
+    def test_live_drop_oldest(self):
+        expected = [
+            int(frame.pixels.sum())
+            for frame in VideoCaptureGenerator(self.clip_path())
+        ]
+        generator = VideoCaptureGenerator(self.clip_path(), live=True)
+        sums = self.slow_read(generator)
+        self.assertGreater(generator.dropped_frames, 0)
+        self.assertEqual(len(sums) + generator.dropped_frames, 496)
+        self.assertEqual(sums[-1], expected[-1])
+
+    def test_live_drop_newest(self):
+        expected = [
+            int(frame.pixels.sum())
+            for frame in VideoCaptureGenerator(self.clip_path())
+        ]
+        generator = VideoCaptureGenerator(
+            self.clip_path(), live=True, prefetch=3,
+            drop_policy=DropPolicy.DROP_NEWEST)
+        sums = self.slow_read(generator)
+        self.assertGreater(generator.dropped_frames, 0)
+        self.assertEqual(len(sums) + generator.dropped_frames, 496)
+        self.assertEqual(sums[:3], expected[:3])
+
+    def test_invalid_drop_policy(self):
+        with self.assertRaises(ValueError) as context:
+            VideoCaptureGenerator(self.clip_path(), live=True, drop_policy='bogus')
+
+    def test_stride(self):
+        expected = [
+            int(frame.pixels.sum())
+            for frame in VideoCaptureGenerator(self.clip_path())
+        ][::5]
+        for prefetch in (0, 2):
+            generator = VideoCaptureGenerator(
+                self.clip_path(), prefetch=prefetch, stride=5)
+            self.assertEqual(
+                [int(frame.pixels.sum()) for frame in generator], expected)
+            self.assertEqual(generator.skipped_frames, 496 - len(expected))
+            self.assertEqual(generator.dropped_frames, 0)
+
+    def test_start_end(self):
+        expected = [
+            (frame.frame_index, int(frame.pixels.sum()))
+            for frame in VideoCaptureGenerator(self.clip_path())
+        ]
+        self.assertEqual([index for (index, _) in expected], list(range(496)))
+        for prefetch in (0, 2):
+            generator = VideoCaptureGenerator(
+                self.clip_path(), prefetch=prefetch, start=100, end=150)
+            self.assertEqual(
+                [(frame.frame_index, int(frame.pixels.sum()))
+                 for frame in generator],
+                expected[100:150]
+            )
+
+        # The clip runs at 30 frames per second.
+        generator = VideoCaptureGenerator(
+            self.clip_path(),
+            stride=3,
+            start=datetime.timedelta(seconds=5),
+            end=datetime.timedelta(seconds=6)
+        )
+        self.assertEqual(
+            [(frame.frame_index, int(frame.pixels.sum())) for frame in generator],
+            expected[150:180:3]
+        )
+
+    def test_media_timestamp(self):
+        generator = VideoCaptureGenerator(self.clip_path(), start=100, end=103)
+        timestamps = [frame.media_timestamp for frame in generator]
+        # The clip runs at 30 frames per second.
+        for (timestamp, expected) in zip(timestamps, (100, 101, 102)):
+            self.assertAlmostEqual(timestamp, expected / 30.0, places=2)
+
+    def test_invalid_start(self):
+        with self.assertRaises(ValueError):
+            VideoCaptureGenerator(self.clip_path(), start=-1)
+
     def test_bogus_file_loop(self):
         generator = VideoCaptureGenerator('bogus_file.m4v')
         frame_count = 0
@@ -201,5 +635,1180 @@ class VideoCaptureGeneratorTest(unittest.TestCase):
             next(generator)
 
 
+class PipelineTest(unittest.TestCase):
+    def test_serial(self):
+        seen = []
+        Pipeline(iter(range(5))).add(lambda x: x * 2).add(seen.append).run()
+        self.assertEqual(seen, [0, 2, 4, 6, 8])
+
+    def test_invalid_mode(self):
+        with self.assertRaises(ValueError) as context:
+            Pipeline(iter(range(5))).add(lambda x: x).run(mode='bogus')
+
+    def test_threaded_keeps_order(self):
+        def jitter(x):
+            time.sleep(random.random() / 1000.0)
+            return x
+
+        seen = []
+        Pipeline(iter(range(100))) \
+            .add(jitter) \
+            .add(StepGroup(jitter, lambda x: x + 1)) \
+            .add(seen.append) \
+            .run(mode=PipelineMode.THREADED, queue_size=2)
+        self.assertEqual(seen, list(range(1, 101)))
+
+    def test_threaded_backpressure(self):
+        lock = threading.Lock()
+        counts = {'produced': 0, 'consumed': 0, 'max_ahead': 0}
+
+        def source():
+            for index in range(50):
+                with lock:
+                    counts['produced'] += 1
+                    counts['max_ahead'] = max(
+                        counts['max_ahead'],
+                        counts['produced'] - counts['consumed']
+                    )
+                yield index
+
+        def slow_sink(x):
+            time.sleep(0.001)
+            with lock:
+                counts['consumed'] += 1
+            return x
+
+        Pipeline(source()).add(lambda x: x).add(slow_sink).run(
+            mode=PipelineMode.THREADED, queue_size=1)
+        self.assertEqual(counts['consumed'], 50)
+        # One frame waiting in each of the two queues, one in each step, one
+        # in the final queue and one being produced.
+        self.assertLessEqual(counts['max_ahead'], 6)
+
+    def test_threaded_step_error(self):
+        def failing(x):
+            if x == 3:
+                raise KeyError(x)
+            return x
+
+        with self.assertRaises(KeyError) as context:
+            Pipeline(iter(range(1000))).add(failing).add(lambda x: x).run(
+                mode=PipelineMode.THREADED)
+
+    def test_threaded_source_error(self):
+        def source():
+            yield 1
+            raise IOError('bad source')
+
+        seen = []
+        with self.assertRaises(IOError) as context:
+            Pipeline(source()).add(seen.append).run(
+                mode=PipelineMode.THREADED)
+        self.assertEqual(seen, [1])
+
+    def test_threaded_base_exceptions(self):
+        def interrupted(x):
+            if x == 3:
+                raise KeyboardInterrupt()
+            return x
+
+        def exiting():
+            yield 1
+            raise SystemExit(1)
+
+        class InterruptedStream(object):
+            def imap(self, frames):
+                for frame in frames:
+                    raise KeyboardInterrupt()
+
+        # They reach run rather than ending the worker thread silently.
+        with self.assertRaises(KeyboardInterrupt):
+            Pipeline(iter(range(1000))).add(interrupted).add(lambda x: x).run(
+                mode=PipelineMode.THREADED)
+        with self.assertRaises(SystemExit):
+            Pipeline(exiting()).add(lambda x: x).run(mode=PipelineMode.THREADED)
+        with self.assertRaises(KeyboardInterrupt):
+            Pipeline(iter(range(10))).add(InterruptedStream()).run(
+                mode=PipelineMode.THREADED)
+
+
+class ParallelDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.detector = ParallelDetector(
+            PixelValueDetector(), workers=2, max_pending=3)
+
+    def tearDown(self):
+        self.detector.close()
+
+    def detected_x(self, frame):
+        return [detected.bounding_box.x for detected in frame.detected_objects]
+
+    def test_detect(self):
+        objects = self.detector.detect(numpy.full((4, 4), 7, numpy.uint8))
+        self.assertEqual(len(objects), 1)
+        self.assertEqual(objects[0].bounding_box, BoundingBox(7, 0, 1, 1))
+
+    def test_call(self):
+        frame = next(pixel_value_frames(1))
+        self.assertEqual(self.detected_x(self.detector(frame)), [0])
+
+    def test_frame_size_change(self):
+        self.detector.detect(numpy.zeros((4, 4), numpy.uint8))
+        objects = self.detector.detect(numpy.full((400, 400), 9, numpy.uint8))
+        self.assertEqual(objects[0].bounding_box.x, 9)
+
+    def test_detect_batch(self):
+        # More images than shared memory buffers.
+        images = [numpy.full((4, 4), value, numpy.uint8) for value in range(10)]
+        self.assertEqual(
+            [objects[0].bounding_box.x for objects in self.detector.detect_batch(images)],
+            list(range(10))
+        )
+
+    def test_pipeline_order(self):
+        for mode in (PipelineMode.SERIAL, PipelineMode.THREADED):
+            seen = []
+            Pipeline(pixel_value_frames(20)) \
+                .add(self.detector) \
+                .add(lambda frame: seen.extend(self.detected_x(frame))) \
+                .run(mode=mode)
+            self.assertEqual(seen, list(range(20)))
+
+    def test_interleaved_imap(self):
+        # Both calls keep max_pending frames in flight at once, more than
+        # the buffers the detector keeps.
+        first = self.detector.imap(pixel_value_frames(6))
+        second = self.detector.imap(pixel_value_frames(6))
+        seen = ([], [])
+        for _ in range(6):
+            seen[0].extend(self.detected_x(next(first)))
+            seen[1].extend(self.detected_x(next(second)))
+        self.assertEqual(seen, (list(range(6)), list(range(6))))
+        self.assertEqual(self.detector._buffers.qsize(), 3)
+
+    def test_static_frames_of_shared_streams(self):
+        first = list(pixel_value_frames(4))
+        for frame in first[1:]:
+            frame.is_static = True
+        second = [VideoFrame(numpy.full((4, 4), 5, numpy.uint8))]
+
+        first_stream = self.detector.imap(iter(first))
+        self.assertEqual(self.detected_x(next(first_stream)), [0])
+        self.assertEqual(
+            [self.detected_x(frame) for frame in self.detector.imap(iter(second))],
+            [[5]]
+        )
+        # The static frames of the first stream keep its own detections.
+        self.assertEqual(
+            [self.detected_x(frame) for frame in first_stream],
+            [[0], [0], [0]]
+        )
+
+    def test_pipeline_step_error_after_detector(self):
+        def failing(frame):
+            raise ValueError()
+
+        with self.assertRaises(ValueError) as context:
+            Pipeline(pixel_value_frames(20)) \
+                .add(self.detector) \
+                .add(failing) \
+                .run(mode=PipelineMode.THREADED)
+
+
+class CountingDetector(Detector):
+    def __init__(self, seconds=0.0):
+        self.frames = list()
+        self.seconds = seconds
+
+    def detect(self, pixels):
+        self.frames.append(int(pixels[0, 0]))
+        time.sleep(self.seconds)
+        return [DetectedObject('pixel', 0.99, BoundingBox(0, 0, 1, 1))]
+
+
+class FakeTracker(object):
+    def __init__(self, *states):
+        self.tracked_objects = list()
+        for state in states:
+            tracked_object = TrackedObject(None, BoundingBox(0, 0, 1, 1))
+            tracked_object.state = state
+            self.tracked_objects.append(tracked_object)
+
+
+class DetectionSchedulerTest(unittest.TestCase):
+    def run_frames(self, scheduler, count=10):
+        return [scheduler(frame) for frame in pixel_value_frames(count)]
+
+    def test_interval(self):
+        detector = CountingDetector()
+        frames = self.run_frames(DetectionScheduler(detector, interval=3))
+        self.assertEqual(detector.frames, [0, 3, 6, 9])
+        self.assertEqual(
+            [frame.detection_skipped for frame in frames[:4]],
+            [False, True, True, False]
+        )
+        self.assertEqual(frames[1].detected_objects, set())
+        self.assertEqual(len(frames[3].detected_objects), 1)
+
+    def test_invalid_interval(self):
+        with self.assertRaises(ValueError) as context:
+            DetectionScheduler(CountingDetector(), interval=0)
+
+    def test_missing(self):
+        detector = CountingDetector()
+        tracker = FakeTracker(
+            TrackedObjectState.TRACKING, TrackedObjectState.MISSING)
+        self.run_frames(DetectionScheduler(
+            detector, interval=3, tracker=tracker), count=4)
+        self.assertEqual(detector.frames, [0, 1, 2, 3])
+
+    def test_lost_ignored(self):
+        detector = CountingDetector()
+        tracker = FakeTracker(
+            TrackedObjectState.TRACKING, TrackedObjectState.LOST)
+        self.run_frames(DetectionScheduler(
+            detector, interval=3, tracker=tracker, min_confidence=0.9), count=4)
+        self.assertEqual(detector.frames, [0, 3])
+
+    def test_min_confidence(self):
+        tracker = FakeTracker(
+            TrackedObjectState.TRACKING,
+            TrackedObjectState.TRACKING,
+            TrackedObjectState.MISSING
+        )
+        detector = CountingDetector()
+        self.run_frames(DetectionScheduler(
+            detector, interval=5, tracker=tracker, detect_on_missing=False,
+            min_confidence=0.5), count=6)
+        self.assertEqual(detector.frames, [0, 5])
+
+        detector = CountingDetector()
+        self.run_frames(DetectionScheduler(
+            detector, interval=5, tracker=tracker, detect_on_missing=False,
+            min_confidence=0.9), count=3)
+        self.assertEqual(detector.frames, [0, 1, 2])
+
+    def test_adaptive(self):
+        scheduler = DetectionScheduler(
+            CountingDetector(seconds=0.02),
+            interval=1,
+            latency_budget_in_seconds=0.005,
+            max_interval=8
+        )
+        self.run_frames(scheduler, count=20)
+        self.assertGreaterEqual(scheduler.interval, 4)
+        self.assertLessEqual(scheduler.interval, 8)
+
+
+class MotionGateTest(unittest.TestCase):
+    def frames(self, values):
+        for value in values:
+            pixels = numpy.zeros((120, 160, 3), dtype=numpy.uint8)
+            pixels[40:80, 60:100] = value
+            yield VideoFrame(pixels, detected_objects=set())
+
+    def test_static(self):
+        gate = MotionGate(threshold=1.0, max_consecutive_skips=10)
+        frames = [gate(frame) for frame in self.frames([0, 0, 1, 200, 200])]
+        self.assertEqual(
+            [frame.is_static for frame in frames],
+            [False, True, True, False, True]
+        )
+        self.assertIsNone(frames[0].motion_score)
+        self.assertGreater(frames[3].motion_score, 1.0)
+
+    def test_slow_changes_add_up(self):
+        gate = MotionGate(threshold=10.0)
+        frames = [gate(frame) for frame in self.frames(range(0, 250, 25))]
+        self.assertTrue(frames[1].is_static)
+        self.assertTrue(any(not frame.is_static for frame in frames[1:]))
+
+    def test_max_consecutive_skips(self):
+        gate = MotionGate(max_consecutive_skips=2)
+        frames = [gate(frame) for frame in self.frames([0] * 7)]
+        self.assertEqual(
+            [frame.is_static for frame in frames],
+            [False, True, True, False, True, True, False]
+        )
+
+    def test_detector_reuses_results(self):
+        detector = CountingDetector()
+        gate = MotionGate()
+        frames = [detector(gate(frame)) for frame in pixel_value_frames(3)]
+        self.assertEqual(detector.frames, [0, 2])
+        self.assertEqual(
+            frames[1].detected_objects, frames[0].detected_objects)
+
+    def test_parallel_detector_reuses_results(self):
+        detector = ParallelDetector(PixelValueDetector(), workers=1)
+        gate = MotionGate(threshold=1.5)
+        try:
+            frames = list(detector.imap(
+                gate(frame) for frame in pixel_value_frames(3)
+            ))
+        finally:
+            detector.close()
+        self.assertEqual(
+            [[detected.bounding_box.x for detected in frame.detected_objects]
+             for frame in frames],
+            [[0], [0], [2]]
+        )
+
+
+class NonMaxSuppressionTest(unittest.TestCase):
+    def test_suppression(self):
+        boxes = BoxArray.from_boxes([
+            BoundingBox(0, 0, 10, 10),
+            BoundingBox(1, 0, 10, 10),
+            BoundingBox(50, 50, 10, 10),
+            BoundingBox(0, 1, 10, 10),
+        ])
+        self.assertEqual(
+            non_max_suppression(boxes, [0.5, 0.9, 0.7, 0.9], 0.5), [1, 2])
+        self.assertEqual(
+            non_max_suppression(boxes, [0.5, 0.9, 0.7, 0.9], 0.95), [1, 3, 2, 0])
+
+    def test_empty(self):
+        self.assertEqual(non_max_suppression(BoxArray.from_boxes([]), [], 0.5), [])
+
+
+class SquareDetector(Detector):
+    '''
+    Detects the bounding boxes of white pixels, like a detector would.
+    '''
+
+    def __init__(self):
+        self.shapes = list()
+
+    def detect(self, pixels):
+        self.shapes.append(pixels.shape)
+        (count, _, stats, _) = cv2.connectedComponentsWithStats(
+            (pixels == 255).astype(numpy.uint8))
+        return [
+            DetectedObject('square', 0.99, BoundingBox(*stats[label][:4]))
+            for label in range(1, count)
+        ]
+
+
+class TiledDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.pixels = numpy.zeros((300, 500), dtype=numpy.uint8)
+        self.squares = [
+            BoundingBox(10, 10, 20, 20),
+            BoundingBox(190, 120, 20, 20),  # across a vertical and horizontal seam
+            BoundingBox(470, 270, 20, 20),
+        ]
+        for box in self.squares:
+            self.pixels[box.y1:box.y2, box.x1:box.x2] = 255
+
+    def test_tiles(self):
+        detector = TiledDetector(SquareDetector(), tile_size=(200, 150), overlap=50)
+        self.assertEqual(detector.tiles(500, 300), [
+            (0, 0, 200, 150), (150, 0, 350, 150), (300, 0, 500, 150),
+            (0, 75, 200, 225), (150, 75, 350, 225), (300, 75, 500, 225),
+            (0, 150, 200, 300), (150, 150, 350, 300), (300, 150, 500, 300),
+        ])
+        self.assertEqual(detector.tiles(100, 100), [(0, 0, 100, 100)])
+
+    def test_invalid_overlap(self):
+        with self.assertRaises(ValueError) as context:
+            TiledDetector(SquareDetector(), tile_size=(200, 150), overlap=150)
+
+    def test_detect(self):
+        for workers in (None, 3):
+            wrapped = SquareDetector()
+            detector = TiledDetector(
+                wrapped, tile_size=(200, 150), overlap=50, workers=workers)
+            found = sorted(
+                (detected.bounding_box.as_origin_and_size()
+                 for detected in detector.detect(self.pixels)))
+            detector.close()
+            self.assertEqual(
+                found, sorted(box.as_origin_and_size() for box in self.squares))
+            self.assertEqual(len(wrapped.shapes), 9)
+            self.assertTrue(all(
+                shape[0] <= 150 and shape[1] <= 200 for shape in wrapped.shapes))
+
+    def test_no_object_ids(self):
+        # Detections only get an object_id when one is asked for.
+        detector = TiledDetector(SquareDetector(), tile_size=(200, 150), overlap=50)
+        for detected in detector.detect(self.pixels):
+            self.assertIsNone(detected._object_id)
+
+
+def frame_sums(frames):
+    return [(frame.frame_index, int(frame.pixels.sum())) for frame in frames]
+
+
+class ScanTest(unittest.TestCase):
+    def clip_path(self):
+        return os.path.join(os.path.dirname(__file__), 'data', 'clip.m4v')
+
+    def test_scan(self):
+        expected = frame_sums(VideoCaptureGenerator(self.clip_path()))
+        self.assertEqual(
+            list(scan(self.clip_path(), frame_sums, segments=3, workers=2)),
+            expected
+        )
+
+    def test_scan_stride_range(self):
+        expected = frame_sums(VideoCaptureGenerator(
+            self.clip_path(), stride=7, start=10, end=400))
+        for segments in (1, 4, 100):
+            self.assertEqual(
+                list(scan(self.clip_path(), frame_sums, segments=segments,
+                          workers=2, stride=7, start=10, end=400)),
+                expected
+            )
+
+    def test_scan_invalid(self):
+        # Bad arguments are rejected by the call itself, as by the
+        # VideoCaptureGenerator constructor, not on the first result.
+        with self.assertRaises(ValueError):
+            scan(self.clip_path(), frame_sums, stride=0)
+        with self.assertRaises(ValueError):
+            scan(self.clip_path(), frame_sums, start=-1)
+        with self.assertRaises(ValueError):
+            scan(self.clip_path(), frame_sums, end=-5)
+        with self.assertRaises(IOError):
+            scan('bogus.mp4', frame_sums)
+
+    def test_scan_ranges(self):
+        from eighttrack import _scan_ranges
+        self.assertEqual(
+            _scan_ranges(0, 100, 4, 1),
+            [(0, 25), (25, 50), (50, 75), (75, 100)]
+        )
+        ranges = _scan_ranges(3, 100, 3, 5)
+        self.assertEqual(ranges[0][0], 3)
+        self.assertEqual(ranges[-1][1], 100)
+        for (start, _) in ranges:
+            self.assertEqual((start - 3) % 5, 0)
+        self.assertEqual(_scan_ranges(10, 12, 8, 1), [(10, 11), (11, 12)])
+
+
+class DetectorTest(unittest.TestCase):
+    def test_merges_in_place(self):
+        frame = next(pixel_value_frames(1))
+        existing = DetectedObject('other', 0.5, BoundingBox(5, 5, 1, 1))
+        detected_objects = frame.detected_objects
+        detected_objects.add(existing)
+
+        self.assertIs(PixelValueDetector()(frame), frame)
+        self.assertIs(frame.detected_objects, detected_objects)
+        self.assertEqual(len(frame.detected_objects), 2)
+        self.assertIn(existing, frame.detected_objects)
+
+
+class SelectForEvictionTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FrameClock()
+        self.tracked_objects = list()
+        for index in range(4):
+            frame = VideoFrame(None)
+            frame.frame_index = index
+            self.clock.observe(frame)
+            self.tracked_objects.append(TrackedObject(
+                str(index), BoundingBox(index * 10, 0, 5, 5), clock=self.clock))
+
+    def test_oldest(self):
+        self.assertEqual(
+            select_for_eviction(self.tracked_objects, 2, EvictionPolicy.OLDEST),
+            self.tracked_objects[:2]
+        )
+        self.assertEqual(
+            select_for_eviction(self.tracked_objects, 0, EvictionPolicy.OLDEST),
+            []
+        )
+
+    def test_least_confident(self):
+        (first, second, third, fourth) = self.tracked_objects
+        third.report_missing()
+        fourth.state = TrackedObjectState.LOST
+        first.set_last_known_location(BoundingBox(1, 0, 5, 5))
+        self.assertEqual(
+            select_for_eviction(
+                self.tracked_objects, 3, EvictionPolicy.LEAST_CONFIDENT),
+            [fourth, third, second]
+        )
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            select_for_eviction(self.tracked_objects, 1, 'bogus')
+
+
+def moving_boxes(index):
+    return [
+        BoundingBox(10 + 5 * index, 20, 30, 30),
+        BoundingBox(300 - 4 * index, 100 + 2 * index, 40, 40),
+    ]
+
+
+def detection_frame(index, boxes, detection_skipped=False):
+    frame = VideoFrame(None, detected_objects=set(
+        DetectedObject('box', 0.9, box) for box in boxes))
+    frame.frame_index = index
+    frame.detection_skipped = detection_skipped
+    return frame
+
+
+class KalmanObjectTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tracker = KalmanObjectTracker(
+            recovery_threshold_in_seconds=3, clock=FrameClock())
+
+    def locations(self):
+        return sorted(
+            tracked_object.last_known_location.as_origin_and_size()
+            for tracked_object in self.tracker.tracked_objects
+        )
+
+    def test_constant_velocity(self):
+        self.tracker(detection_frame(0, moving_boxes(0)))
+        tracked_objects = list(self.tracker.tracked_objects)
+        self.assertEqual(len(tracked_objects), 2)
+        for tracked_object in tracked_objects:
+            self.assertIsInstance(tracked_object.object_id, str)
+
+        for index in range(1, 30):
+            # Detection only runs on every third frame, the objects coast on
+            # their predicted motion in between.
+            skipped = index % 3 != 0
+            frame = self.tracker(detection_frame(
+                index, [] if skipped else moving_boxes(index), skipped))
+            self.assertIs(frame.tracked_objects, self.tracker.tracked_objects)
+            self.assertEqual(
+                sorted(map(id, frame.tracked_objects)),
+                sorted(map(id, tracked_objects))
+            )
+            for tracked_object in frame.tracked_objects:
+                self.assertEqual(
+                    tracked_object.state, TrackedObjectState.TRACKING)
+
+        self.assertEqual(self.locations(), sorted(
+            box.as_origin_and_size() for box in moving_boxes(29)))
+
+    def test_missing_and_lost(self):
+        self.tracker(detection_frame(0, moving_boxes(0)[:1]))
+        (tracked_object,) = self.tracker.tracked_objects
+        for index in range(1, 4):
+            self.tracker(detection_frame(index, []))
+            self.assertEqual(tracked_object.state, TrackedObjectState.MISSING)
+        self.tracker(detection_frame(4, []))
+        self.assertEqual(tracked_object.state, TrackedObjectState.LOST)
+        self.assertEqual(self.tracker.tracked_objects, [tracked_object])
+
+        self.tracker(detection_frame(5, []))
+        self.assertEqual(self.tracker.tracked_objects, [])
+        self.assertEqual(self.tracker.evicted_objects, 1)
+        self.assertEqual(len(self.tracker.means), 0)
+
+    def test_recovery(self):
+        for index in range(5):
+            self.tracker(detection_frame(index, moving_boxes(index)[:1]))
+        (tracked_object,) = self.tracker.tracked_objects
+        self.tracker(detection_frame(5, []))
+        self.assertEqual(tracked_object.state, TrackedObjectState.MISSING)
+        self.tracker(detection_frame(6, moving_boxes(6)[:1]))
+        self.assertEqual(self.tracker.tracked_objects, [tracked_object])
+        self.assertEqual(tracked_object.state, TrackedObjectState.TRACKING)
+
+    def test_remove(self):
+        boxes = [BoundingBox(100 * index, 0, 50, 50) for index in range(4)]
+        self.tracker(detection_frame(0, boxes))
+        (first, second, third, fourth) = sorted(
+            self.tracker.tracked_objects,
+            key=lambda tracked_object: tracked_object.last_known_location.x
+        )
+        self.tracker.remove([second, first])
+        self.assertEqual(len(self.tracker.tracked_objects), 2)
+        for (position, tracked_object) in enumerate(self.tracker.tracked_objects):
+            self.assertEqual(tracked_object.position, position)
+        self.assertEqual(self.locations(), [
+            (200, 0, 50, 50), (300, 0, 50, 50)])
+
+        self.tracker(detection_frame(1, boxes))
+        self.assertEqual(len(self.tracker.tracked_objects), 4)
+        self.assertIn(third, self.tracker.tracked_objects)
+        self.assertIn(fourth, self.tracker.tracked_objects)
+
+    def test_max_tracked_objects(self):
+        tracker = KalmanObjectTracker(max_tracked_objects=2)
+        tracker(detection_frame(0, [BoundingBox(0, 0, 50, 50)]))
+        (oldest,) = tracker.tracked_objects
+        tracker(detection_frame(1, [
+            BoundingBox(0, 0, 50, 50),
+            BoundingBox(100, 0, 50, 50),
+            BoundingBox(200, 0, 50, 50),
+        ]))
+        self.assertEqual(len(tracker.tracked_objects), 2)
+        self.assertNotIn(oldest, tracker.tracked_objects)
+        self.assertEqual(tracker.evicted_objects, 1)
+
+    def test_invalid_assignment(self):
+        with self.assertRaises(ValueError):
+            KalmanObjectTracker(assignment=AssignmentMethod.SEQUENTIAL)
+
+    def test_threaded_pipeline(self):
+        def frames():
+            for index in range(20):
+                # A second object shows up halfway through.
+                boxes = moving_boxes(index)[:1 if index < 10 else 2]
+                yield detection_frame(index, boxes)
+
+        def seen(frame):
+            time.sleep(0.002)
+            seen_objects.append(sorted(
+                tracked.last_known_location.as_origin_and_size()
+                for tracked in frame.tracked_objects
+            ))
+            return frame
+
+        expected = []
+        for frame in frames():
+            self.tracker(frame)
+            expected.append(self.locations())
+
+        seen_objects = []
+        self.tracker = KalmanObjectTracker(
+            recovery_threshold_in_seconds=3, clock=FrameClock())
+        Pipeline(frames()) \
+            .add(self.tracker) \
+            .add(seen) \
+            .run(mode=PipelineMode.THREADED, queue_size=4)
+
+        # The tracker runs ahead of the slow step, which still sees every
+        # frame as the tracker left it.
+        self.assertEqual(len(seen_objects[0]), 1)
+        self.assertEqual(seen_objects, expected)
+
+
+class PassThroughStream(object):
+    def imap(self, frames):
+        for frame in frames:
+            yield frame
+
+
+class DroppingSource(object):
+    dropped_frames = 3
+
+    def __init__(self, count):
+        self.frames = iter(range(count))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.frames)
+
+    next = __next__  # for Python 2
+
+
+class PipelineStatsTest(unittest.TestCase):
+    def slow(self, frame):
+        time.sleep(0.002)
+        return frame
+
+    def test_serial(self):
+        stats = PipelineStats()
+        Pipeline(iter(range(20))) \
+            .add(self.slow) \
+            .add(PassThroughStream()) \
+            .run(stats=stats)
+
+        self.assertEqual(stats.frames, 20)
+        self.assertEqual(
+            [stage.name for stage in stats.stages],
+            ['source', '1:slow', '2:PassThroughStream']
+        )
+        for stage in stats.stages:
+            self.assertEqual(stage.count, 20)
+        (p50, p95, p99) = stats.stage('1:slow').percentiles()
+        self.assertGreaterEqual(p50, 0.002)
+        self.assertLessEqual(p50, p95)
+        self.assertLessEqual(p95, p99)
+        # The stream step does not get charged for the slow step upstream.
+        self.assertLess(
+            stats.stage('2:PassThroughStream').percentiles()[2], 0.001)
+        self.assertGreater(stats.stage('1:slow').throughput(), 0)
+        self.assertGreater(stats.throughput(), 0)
+
+    def test_threaded(self):
+        stats = PipelineStats()
+        Pipeline(iter(range(20))) \
+            .add(self.slow) \
+            .add(PassThroughStream()) \
+            .run(mode=PipelineMode.THREADED, queue_size=4, stats=stats)
+
+        self.assertEqual(stats.frames, 20)
+        self.assertEqual(stats.stage('1:slow').count, 20)
+        self.assertEqual(stats.stage('2:PassThroughStream').count, 20)
+        self.assertGreaterEqual(stats.stage('1:slow').percentiles([50])[0], 0.002)
+        self.assertLessEqual(stats.stage('1:slow').max_queue_depth, 4)
+        self.assertIsNotNone(stats.stage('2:PassThroughStream').queue_depth)
+
+    def test_report(self):
+        reports = []
+        stats = PipelineStats(
+            report_interval_in_seconds=0, report=reports.append)
+        Pipeline(DroppingSource(5)).add(lambda frame: frame).run(stats=stats)
+
+        # Once per frame with an interval of 0, and once at the end.
+        self.assertEqual(len(reports), 6)
+        self.assertEqual(
+            [report['frames'] for report in reports], [1, 2, 3, 4, 5, 5])
+        self.assertEqual(reports[-1]['dropped_frames'], 3)
+        self.assertEqual(
+            [stage['name'] for stage in reports[-1]['stages']],
+            ['source', '1:<lambda>']
+        )
+        self.assertEqual(json.loads(stats.to_json())['frames'], 5)
+
+    def test_empty_stage(self):
+        stage = StageStats('step')
+        self.assertEqual(stage.percentiles(), [None, None, None])
+        self.assertIsNone(stage.throughput())
+        self.assertIsNone(stage.to_dict()['mean_seconds'])
+
+
+class RecordingHook(PipelineHook):
+    def __init__(self):
+        self.calls = []
+
+    def start(self, source):
+        self.calls.append(('start',))
+
+    def before(self, stage, frame):
+        self.calls.append(('before', stage, frame))
+
+    def after(self, stage, frame, started, seconds):
+        self.calls.append(('after', stage, frame))
+
+    def frame_done(self, frame):
+        self.calls.append(('frame_done', frame))
+
+    def finish(self):
+        self.calls.append(('finish',))
+
+
+class PipelineHookTest(unittest.TestCase):
+    def add_one(self, frame):
+        return frame + 1
+
+    def test_serial(self):
+        hook = RecordingHook()
+        Pipeline(iter([10, 20])).add(self.add_one).add_hook(hook).run()
+
+        self.assertEqual(hook.calls, [
+            ('start',),
+            ('before', 'source', None),
+            ('after', 'source', 10),
+            ('before', '1:add_one', 10),
+            ('after', '1:add_one', 11),
+            ('frame_done', 11),
+            ('before', 'source', None),
+            ('after', 'source', 20),
+            ('before', '1:add_one', 20),
+            ('after', '1:add_one', 21),
+            ('frame_done', 21),
+            ('before', 'source', None),
+            ('finish',),
+        ])
+
+    def test_threaded(self):
+        hook = RecordingHook()
+        Pipeline(iter(range(10))) \
+            .add(self.add_one) \
+            .add(PassThroughStream()) \
+            .add_hook(hook) \
+            .run(mode=PipelineMode.THREADED)
+
+        self.assertEqual(hook.calls[0], ('start',))
+        self.assertEqual(hook.calls[-1], ('finish',))
+        self.assertEqual(
+            [call[1] for call in hook.calls if call[0] == 'frame_done'],
+            list(range(1, 11))
+        )
+        for stage in ('source', '1:add_one', '2:PassThroughStream'):
+            self.assertEqual(
+                len([call for call in hook.calls if call[:2] == ('after', stage)]),
+                10
+            )
+
+    def test_finish_on_error(self):
+        hook = RecordingHook()
+
+        def fail(frame):
+            raise RuntimeError("step failed")
+
+        with self.assertRaises(RuntimeError):
+            Pipeline(iter(range(3))).add(fail).add_hook(hook).run()
+        self.assertEqual(hook.calls[-1], ('finish',))
+
+    def test_stats_hook(self):
+        stats = PipelineStats()
+        pipeline = Pipeline(iter(range(5))).add(self.add_one).add_hook(stats)
+        pipeline.run()
+
+        self.assertEqual(stats.frames, 5)
+        self.assertEqual(stats.stage('1:add_one').count, 5)
+
+
+class PipelineTracerTest(unittest.TestCase):
+    def run_traced(self, tracer, mode=PipelineMode.SERIAL, frames=10):
+        Pipeline(iter([VideoFrame(None) for _ in range(frames)])) \
+            .add(lambda frame: frame) \
+            .add(PassThroughStream()) \
+            .add_hook(tracer) \
+            .run(mode=mode)
+
+    def spans(self, tracer):
+        return [event for event in tracer.events() if event['ph'] == 'X']
+
+    def test_serial(self):
+        tracer = PipelineTracer()
+        self.run_traced(tracer)
+
+        spans = self.spans(tracer)
+        self.assertEqual(len(spans), 30)
+        self.assertEqual(
+            [span['name'] for span in spans[:3]],
+            ['source', '1:<lambda>', '2:PassThroughStream']
+        )
+        self.assertEqual([span['args']['frame'] for span in spans[:3]], [0, 0, 0])
+        for span in spans:
+            self.assertGreaterEqual(span['dur'], 0)
+
+        frames = [
+            event for event in tracer.events() if event['cat'] == 'frame']
+        self.assertEqual(len(frames), 20)
+        self.assertEqual(
+            [(event['ph'], event['id']) for event in frames[:2]],
+            [('b', 0), ('e', 0)]
+        )
+        self.assertLessEqual(frames[0]['ts'], spans[0]['ts'])
+
+    def test_threaded(self):
+        tracer = PipelineTracer()
+        self.run_traced(tracer, mode=PipelineMode.THREADED)
+
+        self.assertEqual(len(self.spans(tracer)), 30)
+        names = dict(
+            (event['tid'], event['args']['name'])
+            for event in tracer.to_dict()['traceEvents'] if event['ph'] == 'M'
+        )
+        for span in self.spans(tracer):
+            self.assertEqual(names[span['tid']], 'eighttrack ' + span['name'])
+
+    def test_sample_every(self):
+        tracer = PipelineTracer(sample_every=4)
+        self.run_traced(tracer)
+
+        self.assertEqual(
+            sorted(set(span['args']['frame'] for span in self.spans(tracer))),
+            [0, 4, 8]
+        )
+        with self.assertRaises(ValueError):
+            PipelineTracer(sample_every=0)
+
+    def test_capacity(self):
+        tracer = PipelineTracer(capacity=10)
+        self.run_traced(tracer, frames=100)
+
+        events = tracer.events()
+        self.assertEqual(len(events), 10)
+        # The last frame's events are kept.
+        self.assertEqual(events[-1]['id'], 99)
+
+    def test_save(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'trace.json')
+        try:
+            self.run_traced(PipelineTracer(path=path))
+            with open(path) as trace:
+                events = json.load(trace)['traceEvents']
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(len([event for event in events if event['ph'] == 'X']), 30)
+
+
+class ReadyAfter(object):
+    '''
+    A source whose frames are only ready after a number of calls to ready.
+    '''
+
+    def __init__(self, frames, not_ready):
+        self.frames = iter(frames)
+        self.not_ready = not_ready
+
+    def ready(self):
+        self.not_ready = self.not_ready - 1
+        return self.not_ready < 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.frames)
+
+    next = __next__  # for Python 2
+
+
+class MultiStreamRunnerTest(unittest.TestCase):
+    def recorder(self, seen, name):
+        def record(frame):
+            seen.append((name, frame))
+            return frame
+        return record
+
+    def test_run(self):
+        seen = []
+        runner = MultiStreamRunner(workers=4)
+        for name in ('a', 'b', 'c'):
+            runner.add(
+                Pipeline(iter(range(50))).add(self.recorder(seen, name)),
+                name=name
+            )
+        runner.run()
+
+        self.assertEqual(runner.streams, ['a', 'b', 'c'])
+        for name in ('a', 'b', 'c'):
+            self.assertEqual(runner.frames(name), 50)
+            self.assertEqual(
+                [frame for (seen_name, frame) in seen if seen_name == name],
+                list(range(50))
+            )
+        with self.assertRaises(KeyError):
+            runner.frames('d')
+
+    def test_round_robin(self):
+        seen = []
+        runner = MultiStreamRunner(workers=1)
+        runner.add(Pipeline(iter(range(3))).add(self.recorder(seen, 'a')))
+        runner.add(Pipeline(iter(range(3))).add(self.recorder(seen, 'b')))
+        runner.run()
+
+        self.assertEqual([name for (name, _) in seen], ['a', 'b'] * 3)
+        self.assertEqual(runner.streams, [0, 1])
+
+    def test_ready(self):
+        seen = []
+        runner = MultiStreamRunner(workers=1)
+        runner.add(Pipeline(ReadyAfter(range(2), 3)).add(self.recorder(seen, 'slow')))
+        runner.add(Pipeline(iter(range(2))).add(self.recorder(seen, 'fast')))
+        runner.run()
+
+        self.assertEqual(
+            [name for (name, _) in seen], ['fast', 'fast', 'slow', 'slow'])
+
+    def test_error(self):
+        def fail(frame):
+            if frame == 5:
+                raise RuntimeError("camera unplugged")
+            return frame
+
+        runner = MultiStreamRunner(workers=2)
+        runner.add(Pipeline(iter(range(20))).add(fail), name='broken')
+        runner.add(Pipeline(iter(range(20))).add(lambda frame: frame), name='fine')
+        with self.assertRaises(RuntimeError):
+            runner.run()
+
+        self.assertEqual(list(runner.errors), ['broken'])
+        self.assertEqual(runner.frames('broken'), 5)
+        self.assertEqual(runner.frames('fine'), 20)
+
+    def test_hooks(self):
+        (first, second) = (PipelineStats(), PipelineStats())
+        runner = MultiStreamRunner(workers=2)
+        runner.add(Pipeline(iter(range(7))).add(lambda frame: frame).add_hook(first))
+        runner.add(Pipeline(iter(range(3))).add(lambda frame: frame).add_hook(second))
+        runner.run()
+
+        self.assertEqual(first.frames, 7)
+        self.assertEqual(second.frames, 3)
+        self.assertEqual(second.stage('1:<lambda>').count, 3)
+
+    def test_stop(self):
+        runner = MultiStreamRunner(workers=2)
+
+        def stop(frame):
+            if frame == 10:
+                runner.stop()
+            return frame
+
+        runner.add(Pipeline(itertools.count()).add(stop))
+        runner.add(Pipeline(itertools.count()).add(lambda frame: frame))
+        runner.run()
+
+        self.assertGreaterEqual(runner.frames(0), 10)
+
+    def test_shared_parallel_detector(self):
+        # Each stream keeps max_pending frames in flight on the detector.
+        detector = ParallelDetector(PixelValueDetector(), workers=2)
+        seen = ([], [])
+        runner = MultiStreamRunner(workers=2)
+        try:
+            for index in range(2):
+                runner.add(Pipeline(pixel_value_frames(20))
+                           .add(detector)
+                           .add(lambda frame, seen=seen[index]: seen.extend(
+                               detected.bounding_box.x
+                               for detected in frame.detected_objects) or frame))
+            runner.run()
+        finally:
+            detector.close()
+
+        self.assertEqual(seen, (list(range(20)), list(range(20))))
+
+
+class BatchRecordingDetector(PixelValueDetector):
+    def __init__(self, fail=False):
+        self.batches = list()
+        self.fail = fail
+
+    def detect_batch(self, images):
+        self.batches.append([int(pixels[0, 0]) for pixels in images])
+        if self.fail:
+            raise ValueError("bad batch")
+        return super(BatchRecordingDetector, self).detect_batch(images)
+
+
+class BatchingDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.recorder = BatchRecordingDetector()
+
+    def detected_x(self, frame):
+        return [detected.bounding_box.x for detected in frame.detected_objects]
+
+    def test_detect_batch(self):
+        images = [numpy.full((4, 4), value, numpy.uint8) for value in range(3)]
+        self.assertEqual(
+            [objects[0].bounding_box.x for objects in PixelValueDetector().detect_batch(images)],
+            [0, 1, 2]
+        )
+
+        detector = BatchingDetector(self.recorder, batch_size=2)
+        self.assertEqual(
+            [objects[0].bounding_box.x for objects in detector.detect_batch(images)],
+            [0, 1, 2]
+        )
+        detector.close()
+        self.assertEqual(self.recorder.batches, [[0, 1], [2]])
+
+    def test_batch_size(self):
+        detector = BatchingDetector(
+            self.recorder, batch_size=4, max_delay_in_seconds=60)
+        results = [None] * 4
+
+        def detect(value):
+            results[value] = detector.detect(
+                numpy.full((4, 4), value, numpy.uint8))
+
+        threads = [
+            threading.Thread(target=detect, args=(value,)) for value in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        detector.close()
+
+        self.assertEqual(len(self.recorder.batches), 1)
+        self.assertEqual(sorted(self.recorder.batches[0]), [0, 1, 2, 3])
+        self.assertEqual(
+            [objects[0].bounding_box.x for objects in results], [0, 1, 2, 3])
+
+    def test_max_delay(self):
+        detector = BatchingDetector(
+            self.recorder, batch_size=8, max_delay_in_seconds=0.05)
+        started = time.time()
+        objects = detector.detect(numpy.full((4, 4), 5, numpy.uint8))
+        elapsed = time.time() - started
+        detector.close()
+
+        self.assertEqual(objects[0].bounding_box.x, 5)
+        self.assertEqual(self.recorder.batches, [[5]])
+        self.assertGreaterEqual(elapsed, 0.04)
+        self.assertLess(elapsed, 1)
+
+    def test_pipeline(self):
+        detector = BatchingDetector(
+            self.recorder, batch_size=4, max_delay_in_seconds=60)
+        for mode in (PipelineMode.SERIAL, PipelineMode.THREADED):
+            self.recorder.batches = list()
+            seen = []
+            Pipeline(pixel_value_frames(10)) \
+                .add(detector) \
+                .add(lambda frame: seen.extend(self.detected_x(frame))) \
+                .run(mode=mode)
+            self.assertEqual(seen, list(range(10)))
+            self.assertEqual(
+                self.recorder.batches, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+        detector.close()
+
+    def test_streams(self):
+        detector = BatchingDetector(
+            self.recorder, batch_size=3, max_delay_in_seconds=0.01)
+        seen = [[] for _ in range(3)]
+        runner = MultiStreamRunner(workers=3)
+        for index in range(3):
+            runner.add(Pipeline(pixel_value_frames(8))
+                       .add(detector)
+                       .add(lambda frame, seen=seen[index]: seen.extend(self.detected_x(frame)) or frame))
+        runner.run()
+        detector.close()
+
+        self.assertEqual(seen, [list(range(8))] * 3)
+        self.assertEqual(
+            sorted(value for batch in self.recorder.batches for value in batch),
+            sorted(list(range(8)) * 3)
+        )
+
+    def test_latency(self):
+        detector = BatchingDetector(
+            self.recorder, batch_size=4, max_delay_in_seconds=0.01)
+        read = []
+
+        def frames():
+            for frame in pixel_value_frames(20):
+                time.sleep(0.005)
+                read.append(frame)
+                yield frame
+
+        behind = [len(read) - 1 - index
+                  for (index, frame) in enumerate(detector.imap(frames()))]
+        detector.close()
+
+        # Frames are handed on once their batch is done, rather than once
+        # max_pending frames wait behind them.
+        self.assertEqual(detector.max_pending, 8)
+        self.assertLess(max(behind[:10]), 8)
+        self.assertLess(sum(behind) / float(len(behind)), 4)
+
+    def test_static_frames(self):
+        detector = BatchingDetector(self.recorder, batch_size=2)
+        frames = list(pixel_value_frames(4))
+        frames[1].is_static = True
+        frames[2].is_static = True
+        self.assertEqual(
+            [self.detected_x(frame) for frame in detector.imap(iter(frames))],
+            [[0], [0], [0], [3]]
+        )
+        detector.close()
+
+    def test_error(self):
+        detector = BatchingDetector(BatchRecordingDetector(fail=True), batch_size=1)
+        with self.assertRaises(ValueError):
+            detector.detect(numpy.zeros((4, 4), numpy.uint8))
+        detector.close()
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            BatchingDetector(self.recorder, batch_size=0)
+        with self.assertRaises(ValueError):
+            BatchingDetector(self.recorder, workers=0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,267 @@
+import asyncio
+import concurrent.futures
+import itertools
+import unittest
+import os
+import sys
+import threading
+import time
+
+if __name__ == '__main__':
+    sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from eighttrack import *
+from eighttrack.aio import *
+
+
+async def numbers(count, closed=None):
+    try:
+        for number in range(count):
+            await asyncio.sleep(0)
+            yield number
+    finally:
+        if closed is not None:
+            closed.append(True)
+
+
+async def double(number):
+    await asyncio.sleep(0)
+    return number * 2
+
+
+class Collect(object):
+    def __init__(self):
+        self.numbers = []
+        self.threads = set()
+
+    def __call__(self, number):
+        self.numbers.append(number)
+        self.threads.add(threading.current_thread())
+        return number
+
+
+class AsyncPipelineTest(unittest.TestCase):
+    def run_async(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+    def test_async_source(self):
+        collect = Collect()
+        self.run_async(AsyncPipeline(numbers(20))
+                       .add(double)
+                       .add(lambda number: number + 1)
+                       .add(collect)
+                       .run())
+
+        self.assertEqual(collect.numbers, [number * 2 + 1 for number in range(20)])
+        # Plain steps run on the executor, off the event loop thread.
+        self.assertNotIn(threading.main_thread(), collect.threads)
+
+    def test_sync_source(self):
+        collect = Collect()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            self.run_async(AsyncPipeline(iter(range(20)), executor=executor)
+                           .add(double)
+                           .add(collect)
+                           .run(queue_size=2))
+        finally:
+            executor.shutdown()
+
+        self.assertEqual(collect.numbers, [number * 2 for number in range(20)])
+        self.assertEqual(len(collect.threads), 1)
+
+    def test_tracker_snapshots(self):
+        def frames():
+            for index in range(10):
+                frame = VideoFrame(None, detected_objects=set([DetectedObject(
+                    'box', 0.9, BoundingBox(10 + 5 * index, 20, 30, 30))]))
+                frame.frame_index = index
+                yield frame
+
+        seen = []
+
+        async def slow(frame):
+            await asyncio.sleep(0.002)
+            seen.append(frame.tracked_objects[0].last_known_location.x)
+            return frame
+
+        tracker = KalmanObjectTracker(clock=FrameClock())
+        expected = [
+            tracker(frame).tracked_objects[0].last_known_location.x
+            for frame in frames()
+        ]
+
+        tracker = KalmanObjectTracker(clock=FrameClock())
+        self.run_async(AsyncPipeline(frames()).add(tracker).add(slow).run())
+        # The tracker runs ahead of the slow step, which still sees every
+        # frame as the tracker left it.
+        self.assertEqual(seen, expected)
+
+    def test_coroutine_object_step(self):
+        class Doubler(object):
+            async def __call__(self, number):
+                return number * 2
+
+        collect = Collect()
+        self.run_async(AsyncPipeline(numbers(3)).add(Doubler()).add(collect).run())
+        self.assertEqual(collect.numbers, [0, 2, 4])
+
+    def test_many_pipelines(self):
+        collects = [Collect() for _ in range(10)]
+
+        async def run_all():
+            await asyncio.gather(*[
+                AsyncPipeline(numbers(50)).add(double).add(collect).run()
+                for collect in collects
+            ])
+
+        self.run_async(run_all())
+        for collect in collects:
+            self.assertEqual(collect.numbers, [number * 2 for number in range(50)])
+
+    def test_hooks(self):
+        stats = PipelineStats()
+        self.run_async(AsyncPipeline(numbers(10))
+                       .add(double)
+                       .add(lambda number: number)
+                       .add_hook(stats)
+                       .run())
+
+        self.assertEqual(stats.frames, 10)
+        self.assertEqual(
+            [stage.name for stage in stats.stages],
+            ['source', '1:double', '2:<lambda>']
+        )
+        for stage in stats.stages:
+            self.assertEqual(stage.count, 10)
+
+    def test_step_error(self):
+        closed = []
+
+        async def fail(number):
+            if number == 3:
+                raise ValueError("bad frame")
+            return number
+
+        with self.assertRaises(ValueError):
+            self.run_async(AsyncPipeline(numbers(1000, closed)).add(fail).run())
+        self.assertEqual(closed, [True])
+
+    def test_source_error(self):
+        def frames():
+            yield 1
+            raise ValueError("camera unplugged")
+
+        with self.assertRaises(ValueError):
+            self.run_async(AsyncPipeline(frames()).add(double).run())
+
+    def test_stop(self):
+        collect = Collect()
+        pipeline = AsyncPipeline(itertools.count())
+
+        async def stop_at_five(number):
+            if number == 5:
+                pipeline.stop()
+            return number
+
+        self.run_async(pipeline.add(stop_at_five).add(collect).run())
+        # The frames read before stop was called still go through every step.
+        self.assertGreaterEqual(len(collect.numbers), 6)
+        self.assertEqual(collect.numbers, list(range(len(collect.numbers))))
+
+    def test_stop_waiting_source(self):
+        closed = []
+
+        async def forever():
+            try:
+                yield 0
+                await asyncio.Event().wait()
+            finally:
+                closed.append(True)
+
+        async def run():
+            pipeline = AsyncPipeline(forever())
+            collect = Collect()
+            task = asyncio.ensure_future(pipeline.add(collect).run())
+            while not collect.numbers:
+                await asyncio.sleep(0.001)
+            pipeline.stop()
+            await task
+            return collect.numbers
+
+        self.assertEqual(self.run_async(run()), [0])
+        self.assertEqual(closed, [True])
+
+    def test_stop_reading_sync_source(self):
+        created = []
+        released = []
+        reading = []
+
+        def frames():
+            for index in itertools.count():
+                reading.append(True)
+                time.sleep(0.02)
+                frame = VideoFrame(None)
+                frame.frame_index = index
+                frame._release = lambda index=index: released.append(index)
+                created.append(index)
+                reading.pop()
+                yield frame
+
+        pipeline = AsyncPipeline(frames())
+
+        async def stop_at_two(frame):
+            if frame.frame_index == 2:
+                pipeline.stop()
+            return frame
+
+        self.run_async(pipeline.add(stop_at_two).run())
+        # The read under way when stop was called is finished, and its frame
+        # goes through the steps like the others.
+        self.assertEqual(reading, [])
+        self.assertGreaterEqual(len(created), 3)
+        self.assertEqual(released, created)
+
+    def test_cancel(self):
+        closed = []
+        hook = RunHook()
+
+        async def run():
+            task = asyncio.ensure_future(
+                AsyncPipeline(numbers(10 ** 9, closed))
+                .add(double)
+                .add_hook(hook)
+                .run())
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        self.run_async(run())
+        self.assertEqual(closed, [True])
+        self.assertEqual(hook.calls, ['start', 'finish'])
+
+    def test_invalid(self):
+        class StreamOnly(object):
+            def imap(self, frames):
+                return frames
+
+        with self.assertRaises(ValueError):
+            AsyncPipeline(numbers(1)).add(StreamOnly())
+        with self.assertRaises(ValueError):
+            self.run_async(AsyncPipeline(numbers(1)).run(queue_size=0))
+
+
+class RunHook(PipelineHook):
+    def __init__(self):
+        self.calls = []
+
+    def start(self, source):
+        self.calls.append('start')
+
+    def finish(self):
+        self.calls.append('finish')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,237 @@
+import numpy
 import unittest
 import os
+import pickle
 import sys
 import cv2
+import itertools
+import threading
 
 if __name__ == '__main__':
     sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from eighttrack import *
 from eighttrack.opencv import *
+from eighttrack.opencv import _ClassifierPool
+
+HAAR_PATH = os.path.join(
+    getattr(cv2, 'data', None) and cv2.data.haarcascades or '',
+    'haarcascade_frontalface_default.xml'
+)
+if not os.path.isfile(HAAR_PATH):
+    HAAR_PATH = CASCADE_FACE_DETECTOR_DEFAULT_XML_PATH
+
+
+@unittest.skipUnless(os.path.isfile(HAAR_PATH), 'no face cascade available')
+class CascadeDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = VideoCaptureGenerator(os.path.join(
+            os.path.dirname(__file__),
+            'data',
+            'clip.m4v'
+        ))
+        self.detector = CascadeDetector(haar_path=HAAR_PATH)
+
+    def test_invalid_path(self):
+        with self.assertRaises(ValueError) as context:
+            CascadeDetector(haar_path='bogus.xml')
+
+    def test_pickle(self):
+        detector = pickle.loads(pickle.dumps(self.detector))
+        self.assertEqual(detector.haar_path, HAAR_PATH)
+        self.assertFalse(detector.classifier.empty())
+
+        pixels = next(self.generator).pixels
+        self.assertEqual(
+            set(detected.bounding_box for detected in detector.detect(pixels)),
+            set(detected.bounding_box for detected in self.detector.detect(pixels))
+        )
+
+    def test_shared_classifier(self):
+        other = CascadeDetector(haar_path=HAAR_PATH, min_neighbors=3)
+        self.assertIs(other.classifier, self.detector.classifier)
+        self.assertIs(
+            pickle.loads(pickle.dumps(other)).classifier,
+            self.detector.classifier
+        )
+
+    def test_classifier_pool(self):
+        pool = _ClassifierPool(HAAR_PATH, 2)
+        first = pool.get()
+        self.assertIs(first, pool.first)
+        # A second search at once gets a classifier of its own.
+        second = pool.get()
+        self.assertIsNot(second, first)
+        self.assertFalse(second.empty())
+
+        # Once size classifiers are in use, searches wait for one.
+        taken = []
+        thread = threading.Thread(target=lambda: taken.append(pool.get()))
+        thread.start()
+        thread.join(0.05)
+        self.assertEqual(taken, [])
+        pool.put(second)
+        thread.join()
+        self.assertEqual(taken, [second])
+
+    def test_streams(self):
+        # Every stream gets a detector and a tracker of its own, backed by
+        # the same classifier.
+        trackers = [OpencvObjectTracker() for _ in range(3)]
+        runner = MultiStreamRunner(workers=2)
+        for tracker in trackers:
+            runner.add(Pipeline(VideoCaptureGenerator(os.path.join(
+                os.path.dirname(__file__), 'data', 'clip.m4v'), end=30))
+                       .add(CascadeDetector(haar_path=HAAR_PATH))
+                       .add(tracker))
+        runner.run()
+
+        for (name, tracker) in zip(runner.streams, trackers):
+            self.assertEqual(runner.frames(name), 30)
+            self.assertEqual(len(tracker.tracked_objects), 1)
+
+    def face_boxes(self, detector, pixels):
+        return [detected.bounding_box for detected in detector.detect(pixels)]
+
+    def test_downscaled(self):
+        pixels = next(self.generator).pixels
+        (full,) = self.face_boxes(
+            CascadeDetector(haar_path=HAAR_PATH, scale_factor=1.1), pixels)
+        for grayscale in (False, True):
+            (downscaled,) = self.face_boxes(CascadeDetector(
+                haar_path=HAAR_PATH,
+                scale_factor=1.1,
+                scale=0.5,
+                min_size=(8, 8),
+                grayscale=grayscale
+            ), pixels)
+            self.assertGreater(downscaled.iou(full), 0.7)
+
+    def test_grayscale(self):
+        pixels = next(self.generator).pixels
+        self.assertEqual(
+            self.face_boxes(
+                CascadeDetector(haar_path=HAAR_PATH, grayscale=True), pixels),
+            self.face_boxes(self.detector, pixels)
+        )
+
+    def test_regions(self):
+        pixels = next(self.generator).pixels
+        (face,) = self.face_boxes(self.detector, pixels)
+        around_face = BoundingBox(face.x - 40, face.y - 40, 140, 140)
+
+        detector = CascadeDetector(haar_path=HAAR_PATH, regions=[
+            around_face,
+            BoundingBox(face.x - 20, face.y - 20, 120, 120),
+        ])
+        (found,) = self.face_boxes(detector, pixels)
+        self.assertGreater(found.iou(face), 0.7)
+
+        detector = CascadeDetector(
+            haar_path=HAAR_PATH, regions=[BoundingBox(0, 0, 100, 100)])
+        self.assertEqual(self.face_boxes(detector, pixels), [])
+
+    def test_tracker_regions(self):
+        tracker = OpencvObjectTracker()
+        detector = CascadeDetector(haar_path=HAAR_PATH, tracker=tracker, border=20)
+        self.assertIsNone(detector.regions_of_interest(320, 240))
+
+        tracker.tracked_objects.append(
+            TrackedObject('face', BoundingBox(150, 60, 50, 50)))
+        self.assertEqual(sorted(detector.regions_of_interest(320, 240)), [
+            (0, 0, 320, 20),
+            (0, 20, 20, 220),
+            (0, 220, 320, 240),
+            (125, 35, 225, 135),
+            (300, 20, 320, 220),
+        ])
+
+        pixels = next(self.generator).pixels
+        (face,) = self.face_boxes(self.detector, pixels)
+        (found,) = self.face_boxes(detector, pixels)
+        self.assertGreater(found.iou(face), 0.7)
+
+        tracker.tracked_objects[0].set_last_known_location(
+            BoundingBox(20, 150, 20, 20))
+        self.assertEqual(self.face_boxes(detector, pixels), [])
+
+    def test_full_search(self):
+        tracker = OpencvObjectTracker()
+        tracker.tracked_objects.append(
+            TrackedObject('face', BoundingBox(20, 150, 20, 20)))
+        detector = CascadeDetector(
+            haar_path=HAAR_PATH, tracker=tracker, full_search_interval=3)
+        self.assertIsNone(detector.regions_of_interest(320, 240, True))
+
+        # The face away from the tracked object is found every third frame.
+        pixels = next(self.generator).pixels
+        self.assertEqual(
+            [len(self.face_boxes(detector, pixels)) for _ in range(6)],
+            [0, 0, 1, 0, 0, 1]
+        )
+
+        detector.full_search_interval = 0
+        self.assertEqual(
+            [len(self.face_boxes(detector, pixels)) for _ in range(3)],
+            [0, 0, 0]
+        )
+
+    def test_parallel(self):
+        frames = [next(self.generator) for _ in range(4)]
+        expected = [
+            set(detected.bounding_box for detected in self.detector.detect(
+                frame.pixels))
+            for frame in frames
+        ]
+        parallel = ParallelDetector(self.detector, workers=2)
+        try:
+            detected = [
+                set(detected.bounding_box for detected in frame.detected_objects)
+                for frame in parallel.imap(
+                    VideoFrame(frame.pixels, detected_objects=set())
+                    for frame in frames
+                )
+            ]
+        finally:
+            parallel.close()
+        self.assertEqual(detected, expected)
+
+
+class TrackedObjectIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = TrackedObjectIndex(cell_size=32)
+        self.first = TrackedObject('first', BoundingBox(10, 10, 20, 20))
+        self.second = TrackedObject('second', BoundingBox(100, 100, 50, 50))
+        self.index.add(self.first)
+        self.index.add(self.second)
+
+    def test_intersection(self):
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.intersection((0, 0, 15, 15)), [self.first])
+        self.assertEqual(self.index.intersection((0, 0, 200, 200)),
+                         [self.first, self.second])
+        self.assertEqual(self.index.intersection((31, 31, 99, 99)), [])
+
+    def test_intersection_touching(self):
+        self.assertEqual(self.index.intersection((30, 30, 40, 40)), [self.first])
+
+    def test_move(self):
+        self.first.set_last_known_location(BoundingBox(300, 300, 20, 20))
+        self.index.move(self.first)
+        self.assertEqual(self.index.intersection((0, 0, 50, 50)), [])
+        self.assertEqual(
+            self.index.intersection((290, 290, 310, 310)), [self.first])
+
+        self.first.set_last_known_location(BoundingBox(305, 305, 20, 20))
+        self.index.move(self.first)
+        self.assertEqual(
+            self.index.intersection((321, 321, 330, 330)), [self.first])
+
+    def test_remove(self):
+        self.index.remove(self.second)
+        self.assertEqual(len(self.index), 1)
+        self.assertNotIn(self.second, self.index)
+        self.assertEqual(self.index.intersection((0, 0, 200, 200)), [self.first])
 
 
 class OpencvTrackedObjectTest(unittest.TestCase):
@@ -120,6 +344,82 @@ class OpencvObjectTrackerTest(unittest.TestCase):
     def test_default_state(self):
         self.assertEqual(self.tracker.tracked_objects, list())
 
+    def detections(self, count):
+        return [
+            DetectedObject('face', 0.99, BoundingBox(10 + 60 * index, 10, 50, 50))
+            for index in range(count)
+        ]
+
+    def test_remove(self):
+        added = self.tracker.add(self.detections(4), next(self.generator))
+        self.tracker.remove([added[1]])
+        self.assertEqual(
+            self.tracker.tracked_objects, [added[0], added[3], added[2]])
+        self.assertNotIn(added[1], self.tracker.index)
+        self.tracker.remove([added[2], added[0]])
+        self.assertEqual(self.tracker.tracked_objects, [added[3]])
+        self.tracker.remove([added[3]])
+        self.assertEqual(self.tracker.tracked_objects, [])
+        self.assertEqual(len(self.tracker.index), 0)
+
+    def test_evict_lost(self):
+        frame = next(self.generator)
+        frame.detected_objects = set(self.detections(2))
+        self.tracker(frame)
+        (lost, kept) = self.tracker.tracked_objects
+        lost.state = TrackedObjectState.LOST
+
+        # LOST objects are still handed on with the frame they went LOST on.
+        self.tracker(next(self.generator))
+        self.assertEqual(self.tracker.tracked_objects, [kept])
+        self.assertEqual(self.tracker.evicted_objects, 1)
+
+        tracker = OpencvObjectTracker(evict_lost=False)
+        tracker.add(self.detections(1), next(self.generator))
+        tracker.tracked_objects[0].state = TrackedObjectState.LOST
+        tracker(next(self.generator))
+        self.assertEqual(len(tracker.tracked_objects), 1)
+
+    def test_max_tracked_objects(self):
+        tracker = OpencvObjectTracker(
+            max_tracked_objects=2, clock=FrameClock())
+        added = tracker.add(self.detections(3), next(self.generator))
+        self.assertEqual(tracker.tracked_objects, [added[2], added[1]])
+        self.assertEqual(tracker.evicted_objects, 1)
+        self.assertEqual(len(tracker.index), 2)
+
+        tracker = OpencvObjectTracker(
+            max_tracked_objects=2,
+            eviction=EvictionPolicy.LEAST_CONFIDENT,
+            clock=FrameClock()
+        )
+        added = tracker.add(self.detections(2), next(self.generator))
+        added[0].report_missing()
+        (new,) = tracker.add(
+            [DetectedObject('face', 0.99, BoundingBox(200, 150, 50, 50))],
+            next(self.generator)
+        )
+        self.assertEqual(tracker.tracked_objects, [new, added[1]])
+
+    def test_invalid_eviction(self):
+        with self.assertRaises(ValueError):
+            OpencvObjectTracker(eviction='bogus')
+
+    def test_clock(self):
+        tracker = OpencvObjectTracker(clock=FrameClock(fps=30))
+        frame = next(self.generator)
+        frame.detected_objects = set(
+            [DetectedObject('face', 0.99, BoundingBox(153, 59, 54, 54))])
+        self.assertIs(tracker(frame), frame)
+        self.assertIs(frame.tracked_objects, tracker.tracked_objects)
+        (tracked_object,) = tracker.tracked_objects
+        self.assertIs(tracked_object.clock, tracker.clock)
+
+        for frame in itertools.islice(self.generator, 59):
+            tracker(frame)
+        self.assertEqual(tracker.clock.frame_index, 59)
+        self.assertAlmostEqual(tracked_object.age_in_seconds(), 59 / 30.0)
+
     def test_add_single(self):
         objects_added = self.tracker.add(
             [DetectedObject('face', 0.99, self.first_bounding_box)],
@@ -130,6 +430,8 @@ class OpencvObjectTrackerTest(unittest.TestCase):
 
         tracked_object = list(objects_added)[0]
         self.assertIsNotNone(tracked_object.object_id)
+        # Objects made by the tracker have string ids, e.g. for JSON.
+        self.assertIsInstance(tracked_object.object_id, str)
         self.assertEqual(tracked_object.state, TrackedObjectState.TRACKING)
         self.assertEqual(
             tracked_object.first_known_location,
@@ -202,6 +504,118 @@ class OpencvObjectTrackerTest(unittest.TestCase):
             tracked_object.last_known_location
         )
 
+    def test_add_crowd(self):
+        random_state = numpy.random.RandomState(8)
+        frame = VideoFrame(
+            random_state.randint(0, 255, (480, 640, 3)).astype(numpy.uint8))
+        boxes = [
+            BoundingBox(column * 60, row * 60, 40, 40)
+            for row in range(8)
+            for column in range(10)
+        ]
+        # Every box is detected twice, slightly shifted the second time.
+        detected = [DetectedObject('face', 0.99, box) for box in boxes] + [
+            DetectedObject('face', 0.99, BoundingBox(box.x + 2, box.y, 40, 40))
+            for box in boxes
+        ]
+        objects_added = self.tracker.add(detected, frame)
+        self.assertEqual(len(objects_added), len(boxes))
+        self.assertEqual(
+            [tracked.first_known_location for tracked in objects_added],
+            boxes
+        )
+        self.assertEqual(self.tracker.add(detected, frame), [])
+        self.assertIs(self.tracker.get(boxes[5]), objects_added[5])
+
+    def test_add_recovers_missing(self):
+        random_state = numpy.random.RandomState(8)
+        frame = VideoFrame(
+            random_state.randint(0, 255, (480, 640, 3)).astype(numpy.uint8))
+        (missing, tracking) = self.tracker.add([
+            DetectedObject('face', 0.99, BoundingBox(100, 100, 40, 40)),
+            DetectedObject('face', 0.99, BoundingBox(400, 300, 40, 40)),
+        ], frame)
+        missing.state = TrackedObjectState.MISSING
+
+        # The recovered object is found at its new location by the next
+        # detection, which is a duplicate rather than a new object.
+        added = self.tracker.add([
+            DetectedObject('face', 0.99, BoundingBox(104, 100, 40, 40)),
+            DetectedObject('face', 0.99, BoundingBox(105, 100, 40, 40)),
+            DetectedObject('face', 0.99, BoundingBox(250, 300, 40, 40)),
+        ], frame)
+        self.assertEqual(
+            [tracked.first_known_location for tracked in added],
+            [BoundingBox(250, 300, 40, 40)]
+        )
+        self.assertEqual(missing.state, TrackedObjectState.TRACKING)
+        self.assertEqual(missing.last_known_location, BoundingBox(104, 100, 40, 40))
+        self.assertIs(self.tracker.get(BoundingBox(104, 100, 40, 40)), missing)
+        self.assertEqual(len(self.tracker.tracked_objects), 3)
+
+    def test_add_assigned(self):
+        random_state = numpy.random.RandomState(8)
+        frame = VideoFrame(
+            random_state.randint(0, 255, (480, 640, 3)).astype(numpy.uint8))
+        boxes = [BoundingBox(100, 100, 40, 40), BoundingBox(300, 100, 40, 40)]
+        for method in (AssignmentMethod.GREEDY, AssignmentMethod.HUNGARIAN):
+            tracker = OpencvObjectTracker(assignment=method)
+            tracker.add([DetectedObject('face', 0.99, box) for box in boxes], frame)
+            self.assertEqual(len(tracker.tracked_objects), 2)
+
+            # Two detections of the first object and one new object.
+            added = tracker.add([
+                DetectedObject('face', 0.99, BoundingBox(104, 100, 40, 40)),
+                DetectedObject('face', 0.99, BoundingBox(101, 100, 40, 40)),
+                DetectedObject('face', 0.99, BoundingBox(500, 300, 40, 40)),
+            ], frame)
+            self.assertEqual(
+                [tracked.first_known_location for tracked in added],
+                [BoundingBox(500, 300, 40, 40)]
+            )
+            self.assertEqual(tracker.last_assignment.matches, [(1, 0)])
+            self.assertEqual(tracker.last_assignment.unmatched_detections, [0, 2])
+            self.assertEqual(tracker.last_assignment.unmatched_tracks, [1])
+            self.assertEqual(len(tracker.tracked_objects), 3)
+
+    def test_update_workers(self):
+        def moving_squares():
+            random_state = numpy.random.RandomState(8)
+            background = random_state.randint(
+                0, 64, (240, 320, 3)).astype(numpy.uint8)
+            for index in range(15):
+                pixels = background.copy()
+                for square in range(6):
+                    x = 10 + square * 50 + index
+                    y = 20 + (square % 3) * 70 + index // 2
+                    pixels[y:y + 30, x:x + 30] = 50 * (square % 4) + 100
+                yield VideoFrame(pixels)
+
+        detected = [
+            DetectedObject(
+                'square',
+                0.99,
+                BoundingBox(
+                    10 + square * 50, 20 + (square % 3) * 70, 30, 30)
+            )
+            for square in range(6)
+        ]
+        locations = list()
+        for workers in (1, 4):
+            tracker = OpencvObjectTracker(update_workers=workers)
+            frames = moving_squares()
+            tracker.add(detected, next(frames))
+            history = list()
+            for frame in frames:
+                tracker.update(frame)
+                history.append([
+                    (tracked.state, tracked.last_known_location.as_origin_and_size())
+                    for tracked in tracker.tracked_objects
+                ])
+            tracker.close()
+            locations.append(history)
+        self.assertEqual(locations[0], locations[1])
+
     def test_two_objects_crossing_paths(self):
         animation = VideoCaptureGenerator(os.path.join(
             os.path.dirname(__file__),
@@ -260,5 +674,66 @@ class OpencvObjectTrackerTest(unittest.TestCase):
         )
 
 
+class FixedBoxDetector(Detector):
+    '''
+    Detects the face of the first frame of clip.m4v on every frame.
+    '''
+
+    def detect(self, pixels):
+        return [DetectedObject('face', 0.99, BoundingBox(153, 59, 54, 54))]
+
+
+class TrackerTypeTest(unittest.TestCase):
+    def clip_path(self):
+        return os.path.join(os.path.dirname(__file__), 'data', 'clip.m4v')
+
+    def test_tracker_factory(self):
+        self.assertIs(
+            tracker_factory(cv2.TrackerKCF_create), cv2.TrackerKCF_create)
+        self.assertIsNotNone(tracker_factory(TrackerType.KCF)())
+        with self.assertRaises(ValueError):
+            tracker_factory('Bogus')
+
+    def test_tracker_type(self):
+        with self.assertRaises(ValueError):
+            OpencvObjectTracker(tracker_type='Bogus')
+
+        created = []
+
+        def factory():
+            created.append(cv2.TrackerKCF_create())
+            return created[-1]
+
+        tracker = OpencvObjectTracker(tracker_type=factory)
+        generator = VideoCaptureGenerator(self.clip_path())
+        frame = next(generator)
+        frame.detected_objects = set(FixedBoxDetector().detect(frame.pixels))
+        tracker(frame)
+        tracker(next(generator))
+        self.assertEqual(len(created), 1)
+        self.assertEqual(
+            tracker.tracked_objects[0].state, TrackedObjectState.TRACKING)
+
+    def test_benchmark_trackers(self):
+        results = benchmark_trackers(
+            self.clip_path(),
+            FixedBoxDetector(),
+            tracker_types=[TrackerType.KCF, 'Bogus', TrackerType.MIL],
+            frame_count=10
+        )
+        self.assertEqual(
+            [result.tracker_type for result in results],
+            [TrackerType.KCF, TrackerType.MIL]
+        )
+        for result in results:
+            self.assertEqual(result.frames, 9)
+            self.assertGreater(result.init_seconds, 0.0)
+            self.assertGreater(result.update_seconds, 0.0)
+            self.assertGreaterEqual(
+                result.max_update_seconds, result.update_seconds)
+            self.assertEqual(result.success_rate, 1.0)
+            self.assertGreater(result.mean_iou, 0.5)
+
+
 if __name__ == '__main__':
     unittest.main()